@@ -0,0 +1,136 @@
+# Runs the docker collector against fake_docker.FakeDocker: usage read
+# from cgroup v2 directories, the stats?stream=false fallback for the
+# containers without one, 404 and 500 answers, timeouts, and the pooled
+# connections including the retry when the daemon closed an idle one.
+# Needs no Docker.
+#
+#   python bench/check_docker.py
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import fake_docker
+
+# config is read on import, the cgroups have to be looked for in the fake sysfs
+ROOT = tempfile.mkdtemp(prefix="exporter-check-")
+SYS_ROOT = os.path.join(ROOT, "sys")
+SOCKET = os.path.join(ROOT, "docker.sock")
+os.environ["EXPORTER_SYS_ROOT"] = SYS_ROOT
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import containers  # noqa: E402
+import procfs  # noqa: E402
+
+MiB = fake_docker.MiB
+# Containers 0 and 1 have a visible cgroup, the others go through the stats API
+CGROUPS = (0, 1)
+GONE = 4
+FAILING = 5
+CONTAINERS = 6
+
+failures = []
+
+
+def check(what, actual, expected):
+    if actual != expected:
+        failures.append(what)
+        print(f"FAIL {what}: {actual!r}, expected {expected!r}")
+
+
+def collect(docker, connections=2, timeout=2.0):
+    async def run():
+        client = containers.DockerClient(SOCKET, connections=connections, timeout=timeout)
+        try:
+            first = await containers.collect(client)
+            second = await containers.collect(client)
+        finally:
+            await client.close()
+        return first, second
+
+    docker.start()
+    try:
+        return asyncio.run(run())
+    finally:
+        docker.stop()
+
+
+def usage_values(usage):
+    return None if usage is None else (
+        usage.cpu_seconds, usage.memory_usage, usage.memory_limit, usage.pids,
+        usage.block_read, usage.block_written, usage.rx_bytes, usage.tx_bytes)
+
+
+def check_usage():
+    docker = fake_docker.FakeDocker(SOCKET, CONTAINERS, gone=(GONE,), failing=(FAILING,))
+    first, second = collect(docker)
+    usages = {container.name: usage for container, usage in first}
+    check("containers", [container.name for container, _ in first], [f"container-{i}" for i in range(CONTAINERS)])
+    check("labels", first[0][0].labels, (fake_docker.container_id(0)[:12], "container-0",
+                                         "registry.example.com/app:1.0"))
+
+    host_memory = procfs.read_memory().ram_total
+    cgroup = usages["container-0"]
+    check("cgroup values", usage_values(cgroup)[:6], (2.5, 2 * MiB, host_memory, 2, 1001, 2002))
+    check("cgroup network read", cgroup.rx_bytes is not None and cgroup.tx_bytes is not None, True)
+    check("cgroup memory limit", usages["container-1"].memory_limit, 512 * MiB)
+
+    stats = usages["container-2"]
+    check("stats values", usage_values(stats), (4.5, 3 * MiB, fake_docker.HOST_MEMORY, 3, 3 * 4096 + 1, 3 * 8192,
+                                                301, 602))
+    check("gone container", usages["container-4"], None)
+    check("failing container", usages["container-5"], None)
+    check("stats only without cgroup", docker.stats_requests(), [2, 2, 3, 3, 4, 4, 5, 5])
+    check("one-shot stats", all("stream=false" in target for target in docker.requests if "/stats" in target), True)
+    check("second collection", [usage_values(usage) for _, usage in second],
+          [usage_values(usage) for _, usage in first])
+    check("connections pooled", docker.connections, 2)
+
+
+def check_retry():
+    # The daemon closes every connection after one response
+    docker = fake_docker.FakeDocker(SOCKET, CONTAINERS, requests_per_connection=1)
+    first, second = collect(docker)
+    check("retried on closed connections", [usage is not None for _, usage in second], [True] * CONTAINERS)
+    check("new connection per request", docker.connections, len(docker.requests))
+
+
+def check_timeout():
+    docker = fake_docker.FakeDocker(SOCKET, CONTAINERS, stats_delay=0.5)
+    first, _ = collect(docker, timeout=0.2)
+    check("stats timed out", [usage is not None for _, usage in first], [True, True] + [False] * (CONTAINERS - 2))
+
+
+def check_daemon_gone():
+    client = containers.DockerClient(SOCKET)
+    check("unavailable", client.available(), False)
+    try:
+        asyncio.run(containers.collect(client))
+    except OSError:
+        pass
+    else:
+        check("raises without daemon", False, True)
+
+
+def main():
+    # The failing stats below are provoked, their warnings are expected
+    logging.disable(logging.WARNING)
+    try:
+        fake_docker.write_cgroup(SYS_ROOT, 0, os.getpid())
+        fake_docker.write_cgroup(SYS_ROOT, 1, os.getpid(), memory_max=512 * MiB)
+        check_usage()
+        check_retry()
+        check_timeout()
+        check_daemon_gone()
+    finally:
+        shutil.rmtree(ROOT)
+    if failures:
+        sys.exit(1)
+    print("Docker collector OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Runs the NVML backend against fake_nvml.FakeLibrary: the ctypes
+# structures and byref arguments, return code handling, per-device
+# snapshots and readings, and the fallback when NVML fails. Needs no GPU.
+#
+#   python bench/check_nvml.py
+import asyncio
+import logging
+import math
+import os
+import sys
+
+import fake_nvml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import nvml  # noqa: E402
+import nvsmi  # noqa: E402
+
+failures = []
+
+
+def check(what, actual, expected):
+    same = actual == expected or (
+        isinstance(actual, float) and isinstance(expected, float) and math.isnan(actual) and math.isnan(expected))
+    if not same:
+        failures.append(what)
+        print(f"FAIL {what}: {actual!r}, expected {expected!r}")
+
+
+class FallbackBackend(object):
+    """Records how often collections fell back to it"""
+    name = "fallback"
+
+    def __init__(self):
+        self.snapshots = 0
+
+    def available(self):
+        return True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def snapshot(self):
+        self.snapshots += 1
+        return nvsmi.GPUSnapshot([], [], subprocesses=1)
+
+    async def snapshot_async(self):
+        return self.snapshot()
+
+    def readings(self):
+        return None
+
+
+def backend(library, fallback=None):
+    return nvml.NVMLBackend(fallback=fallback, nvml=nvml.NVML(library))
+
+
+def check_snapshot():
+    library = fake_nvml.FakeLibrary([
+        fake_nvml.FakeDevice(0, processes=[(4242, 512 * 1024 * 1024)]),
+        fake_nvml.FakeDevice(1, utilization=97, memory_used_mib=40960, power_mw=398250, clocks=(1200, 1300, 1500),
+                             pstate=2, fan_speed=55, throttle_reasons=0x04),
+    ])
+    snapshot = backend(library).snapshot()
+    check("snapshot GPUs", [gpu.id for gpu in snapshot.gpus], ["0", "1"])
+    check("no subprocesses", snapshot.subprocesses, 0)
+    gpu = snapshot.gpus[1]
+    check("uuid", gpu.uuid, "GPU-00000001-1111-2222-3333-444444444444")
+    check("name", gpu.name, "NVIDIA A100-SXM4-80GB")
+    check("driver", gpu.driver, "535.104.05")
+    check("utilization", gpu.gpu_util, 97.0)
+    check("memory used MiB", gpu.mem_used, 40960.0)
+    check("memory free MiB", gpu.mem_free, 40960.0)
+    check("power draw W", gpu.power_draw, 398.25)
+    check("power limit W", gpu.power_limit, 400.0)
+    check("graphics clock", gpu.clocks_current_graphics, 1200.0)
+    check("SM clock", gpu.clocks_current_sm, 1300.0)
+    check("memory clock", gpu.clocks_current_memory, 1500.0)
+    check("pstate", gpu.pstate, "P2")
+    check("fan speed", gpu.fan_speed, 55.0)
+    check("memory temperature", gpu.temperature_memory, 45.0)
+    check("power cap throttling", gpu.clocks_throttle_reasons_sw_power_cap, True)
+    check("idle throttling", gpu.clocks_throttle_reasons_gpu_idle, False)
+    # Not supported by the fake, so NaN or [N/A] rather than an error
+    check("fan without fan", snapshot.gpus[0].fan_speed, float("nan"))
+    check("vbios", gpu.vbios_version, "[N/A]")
+    check("processes", [(p.pid, p.gpu_id, p.used_memory) for p in snapshot.processes], [(4242, "0", 512.0)])
+    check("handles cached", library.calls.get("nvmlDeviceGetHandleByIndex_v2"), 2)
+    backend_ = backend(library)
+    backend_.snapshot()
+    backend_.snapshot()
+    check("handles reused", library.calls.get("nvmlDeviceGetHandleByIndex_v2"), 4)
+
+    readings = backend(library).readings()
+    check("reading fields", readings[1].values, (97.0, 398.25, 1300.0, 1500.0, 1200.0, 40.0))
+    check("reading labels", (readings[1].id, readings[1].name), ("1", "NVIDIA A100-SXM4-80GB"))
+
+
+def check_fallback():
+    fallback = FallbackBackend()
+    missing = backend(fake_nvml.FakeLibrary([fake_nvml.FakeDevice(0)], initialized=False), fallback)
+    check("available through the fallback", missing.available(), True)
+    check("uninitialized uses the fallback", missing.snapshot().subprocesses, 1)
+    check("no readings without NVML", missing.readings(), None)
+
+    fallback = FallbackBackend()
+    library = fake_nvml.FakeLibrary([fake_nvml.FakeDevice(0)])
+    lost = backend(library, fallback)
+    check("NVML first", len(lost.snapshot().gpus), 1)
+    library.error = fake_nvml.NVML_ERROR_GPU_IS_LOST
+    check("lost GPU uses the fallback", lost.snapshot().subprocesses, 1)
+    check("fallback once", fallback.snapshots, 1)
+    library.error = None
+    enumerations = library.calls.get("nvmlDeviceGetHandleByIndex_v2")
+    check("NVML again", len(lost.snapshot().gpus), 1)
+    check("re-enumerated", library.calls.get("nvmlDeviceGetHandleByIndex_v2"), enumerations + 1)
+
+    library.error = fake_nvml.NVML_ERROR_GPU_IS_LOST
+    try:
+        backend(library).snapshot()
+    except nvml.NVMLError as e:
+        check("error code", e.code, fake_nvml.NVML_ERROR_GPU_IS_LOST)
+        check("error message", str(e), "NVML error 15: GPU is lost")
+    else:
+        check("raises without fallback", False, True)
+
+
+def check_async():
+    library = fake_nvml.FakeLibrary([fake_nvml.FakeDevice(0), fake_nvml.FakeDevice(1)])
+    snapshot = asyncio.run(backend(library).snapshot_async())
+    check("async snapshot", [gpu.id for gpu in snapshot.gpus], ["0", "1"])
+    fallback = FallbackBackend()
+    uninitialized = backend(fake_nvml.FakeLibrary(initialized=False), fallback)
+    check("async fallback", asyncio.run(uninitialized.snapshot_async()).subprocesses, 1)
+
+
+def main():
+    # The NVML failures below are provoked, their tracebacks are expected
+    logging.disable(logging.ERROR)
+    check_snapshot()
+    check_fallback()
+    check_async()
+    if failures:
+        sys.exit(1)
+    print("NVML backend OK")
+
+
+if __name__ == "__main__":
+    main()
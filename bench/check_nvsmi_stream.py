@@ -0,0 +1,125 @@
+# Runs the nvidia-smi stream backend against the fake nvidia-smi from
+# fixtures.py: records arriving from the -lms loop, restarts with backoff
+# when the loop exits or stalls, and a hanging compute-apps query that
+# must not keep the supervisor from restarting the loop. Needs no GPU.
+#
+#   python bench/check_nvsmi_stream.py
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import fixtures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import nvsmi  # noqa: E402
+
+GPUS = 2
+INTERVAL_MS = 50
+STALL_TIMEOUT = 0.5
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 0.4
+
+failures = []
+
+
+def check(what, actual, expected):
+    if actual != expected:
+        failures.append(what)
+        print(f"FAIL {what}: {actual!r}, expected {expected!r}")
+
+
+class Restarts(logging.Handler):
+    """Collects the reason and backoff of every restart the backend logs"""
+
+    def __init__(self):
+        super().__init__()
+        self.restarts = []
+
+    def emit(self, record):
+        if record.msg.startswith("nvidia-smi stream"):
+            self.restarts.append(record.args)
+
+    def reasons(self):
+        return [reason.split(" ")[0] for reason, _ in self.restarts]
+
+    def backoffs(self):
+        return [backoff for _, backoff in self.restarts]
+
+
+def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def fresh(backend):
+    return len(backend.readings() or []) == GPUS
+
+
+def check_stream(directory, backend, restarts):
+    check("records arrive", until(lambda: fresh(backend)), True)
+    check("processes polled", until(lambda: len(backend.snapshot().processes) == 4), True)
+    check("GPU ids", [gpu.id for gpu in backend.snapshot().gpus], ["0", "1"])
+    check("no restarts while healthy", restarts.restarts, [])
+
+    fixtures.set_nvidia_smi_mode(directory, "exit")
+    check("restarts after exits", until(lambda: len(restarts.restarts) >= 4), True)
+    check("exit reason", set(restarts.reasons()), {"exited"})
+    check("backoff doubles up to the maximum", restarts.backoffs()[:4], [0.1, 0.2, 0.4, 0.4])
+    fixtures.set_nvidia_smi_mode(directory)
+    check("records again after exits", until(lambda: fresh(backend)), True)
+
+    del restarts.restarts[:]
+    fixtures.set_nvidia_smi_mode(directory, "stall")
+    check("stall detected", until(lambda: restarts.restarts, timeout=3 * STALL_TIMEOUT + 1), True)
+    check("stall reason", restarts.reasons()[:1], ["stalled"])
+    check("backoff reset by records", restarts.backoffs()[:1], [MIN_BACKOFF])
+    check("stalled GPUs dropped", until(lambda: not backend.readings()), True)
+    fixtures.set_nvidia_smi_mode(directory)
+    check("records again after the stall", until(lambda: fresh(backend)), True)
+
+
+def check_hanging_query(directory, backend, restarts):
+    del restarts.restarts[:]
+    fixtures.set_nvidia_smi_mode(directory, "hang")
+    # Let the supervisor get stuck in the compute-apps query, then kill the loop
+    time.sleep(0.3)
+    backend._child.kill()
+    check("restarted despite a hanging query", until(lambda: restarts.restarts, timeout=3 * STALL_TIMEOUT + 1), True)
+    check("processes kept", len(backend.snapshot().processes), 4)
+    fixtures.set_nvidia_smi_mode(directory)
+    check("records again after the hang", until(lambda: fresh(backend)), True)
+
+
+def main():
+    restarts = Restarts()
+    logger = logging.getLogger(nvsmi.__name__)
+    logger.addHandler(restarts)
+    # The restarts below are provoked, only the handler should see them
+    logger.propagate = False
+    with tempfile.TemporaryDirectory(prefix="exporter-check-") as directory:
+        fixtures.write_nvidia_smi(directory, GPUS, 4)
+        os.environ["PATH"] = directory + os.pathsep + os.environ.get("PATH", "")
+        backend = nvsmi.NvidiaSmiStreamBackend(
+            interval_ms=INTERVAL_MS, process_interval=0.1, stall_timeout=STALL_TIMEOUT,
+            min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+        )
+        backend.start()
+        try:
+            check_stream(directory, backend, restarts)
+            check_hanging_query(directory, backend, restarts)
+        finally:
+            backend.stop()
+    if failures:
+        sys.exit(1)
+    print("nvidia-smi stream backend OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Runs the remote_write pusher against fake_remote_write.FakeReceiver:
+# batching of intervals into one request, keeping requests in the WAL
+# while the receiver fails or drops connections, replaying them oldest
+# first once it recovers, and the WAL staying within its size limit.
+#
+#   python bench/check_remote_write.py
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import fake_remote_write
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import metrics  # noqa: E402
+import remote_write  # noqa: E402
+import scheduler  # noqa: E402
+
+INTERVAL = 0.05
+BATCH = 3
+SERIES = 20
+# Timestamp of the first step, one step per interval and second
+START = 1700000000
+
+STEP = metrics.Gauge("check_step", "Number of the interval the sample was collected in", ("series",))
+
+failures = []
+
+
+def check(what, actual, expected):
+    if actual != expected:
+        failures.append(what)
+        print(f"FAIL {what}: {actual!r}, expected {expected!r}")
+
+
+class FakeScheduler(object):
+    """One background collector whose snapshot changes every interval, the WAL size measured as it goes"""
+
+    def __init__(self, wal):
+        self.wal = wal
+        self.steps = 0
+        self.wal_bytes = []
+
+    async def scrape(self, names=None):
+        # The previous write_and_flush has finished, the WAL is trimmed
+        self.wal_bytes.append(sum(os.path.getsize(path) for path in self.wal.segments()))
+        self.steps += 1
+        metric_set = metrics.MetricSet()
+        for series in range(SERIES):
+            metric_set.add(STEP, self.steps, (str(series),))
+        snapshot = scheduler.CollectorSnapshot("step", START + self.steps, metric_set, b"")
+        return scheduler.Scrape([snapshot], [], metrics.MetricSet())
+
+
+def until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(INTERVAL / 5)
+    return True
+
+
+def steps(requests):
+    """Step numbers of each request, in the order the receiver accepted them"""
+    return [[timestamp // 1000 - START for timestamp in request.timestamps("check_step")] for request in requests]
+
+
+def check_batching(receiver, collector, wal):
+    check("requests arrive", until(lambda: len(receiver.accepted) >= 3), True)
+    accepted = steps(receiver.accepted[:3])
+    check("intervals per request", [len(request) for request in accepted], [BATCH] * 3)
+    check("consecutive intervals", [request[-1] - request[0] for request in accepted], [BATCH - 1] * 3)
+    labels, samples = receiver.accepted[0].series[0]
+    check("labels", labels, {"__name__": "check_step", "series": "0", "job": "check", "instance": "host:8754"})
+    check("series per request", len(receiver.accepted[0].series), SERIES)
+    check("sample values", [value for _, value in samples], [float(step) for step in accepted[0]])
+    check("metadata", receiver.accepted[0].metadata,
+          [(remote_write.METADATA_TYPES["gauge"], "check_step", STEP.documentation)])
+    check("headers", receiver.bad_headers, 0)
+
+
+def check_outage(receiver, collector, wal, status):
+    accepted = len(receiver.accepted)
+    attempts = receiver.attempts
+    receiver.fail(status)
+    check(f"requests kept while failing with {status}", until(lambda: len(wal.segments()) >= 4), True)
+    check(f"retried while failing with {status}", receiver.attempts > attempts, True)
+    receiver.recover()
+    check(f"WAL drained after {status}", until(lambda: not wal.segments() and len(receiver.accepted) > accepted + 4),
+          True)
+    return steps(receiver.accepted[accepted:])
+
+
+def check_replay(receiver, collector, wal):
+    replayed = check_outage(receiver, collector, wal, 503)
+    flat = [step for request in replayed for step in request]
+    check("replayed oldest first", flat, sorted(flat))
+    check("nothing lost", flat, list(range(flat[0], flat[0] + len(flat))))
+
+    replayed = check_outage(receiver, collector, wal, None)
+    flat = [step for request in replayed for step in request]
+    check("replayed oldest first after dropped connections", flat, sorted(flat))
+    check("nothing lost after dropped connections", flat, list(range(flat[0], flat[0] + len(flat))))
+
+
+def check_wal_limit(receiver, collector, wal):
+    receiver.fail(503)
+    check("requests kept", until(lambda: wal.segments()), True)
+    # Room for three requests, a longer outage drops the oldest
+    request_bytes = os.path.getsize(wal.segments()[0])
+    wal.max_bytes = 3 * request_bytes + request_bytes // 2
+    first = collector.steps
+    limited = len(collector.wal_bytes)
+    check("long outage", until(lambda: collector.steps >= first + 10 * BATCH), True)
+    check("WAL within its limit", max(collector.wal_bytes[limited:]) <= wal.max_bytes, True)
+    check("oldest requests dropped", len(wal.segments()) <= 3, True)
+    accepted = len(receiver.accepted)
+    newest = collector.steps
+    receiver.recover()
+    check("WAL drained after the long outage", until(lambda: not wal.segments()), True)
+    flat = [step for request in steps(receiver.accepted[accepted:]) for step in request]
+    check("replayed oldest first after dropping", flat, sorted(flat))
+    check("oldest steps dropped", flat[0] > first + BATCH, True)
+    check("newest steps kept", newest - BATCH <= max(flat), True)
+
+
+async def run(receiver, collector, wal):
+    writer = remote_write.RemoteWriter(
+        receiver.url, collector, wal, interval=INTERVAL, batch=BATCH, timeout=2.0,
+        external_labels=(("job", "check"), ("instance", "host:8754")),
+    )
+    await writer.start()
+    try:
+        # The checks wait in a thread, the writer runs on the loop
+        for phase in (check_batching, check_replay, check_wal_limit):
+            await asyncio.to_thread(phase, receiver, collector, wal)
+    finally:
+        await writer.stop()
+
+
+def main():
+    # The failed pushes below are provoked, their warnings are expected
+    logging.disable(logging.ERROR)
+    receiver = fake_remote_write.FakeReceiver()
+    receiver.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="exporter-check-") as directory:
+            wal = remote_write.WAL(directory, 64 * 1024 * 1024)
+            asyncio.run(run(receiver, FakeScheduler(wal), wal))
+    finally:
+        receiver.stop()
+    if failures:
+        sys.exit(1)
+    print("remote_write OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# Stand-in for the Docker Engine: serves /containers/json and
+# /containers/{id}/stats on a Unix socket from a thread of its own, and
+# writes the cgroup v2 directories the daemon would create, so the docker
+# collector can be run without Docker.
+import asyncio
+import hashlib
+import json
+import os
+import threading
+
+MiB = 1024 * 1024
+HOST_MEMORY = 64 * 1024 * MiB
+
+
+def container_id(index):
+    return hashlib.sha256(b"container %d" % index).hexdigest()
+
+
+def summary(index):
+    """Entry of /containers/json"""
+    return {
+        "Id": container_id(index),
+        "Names": [f"/container-{index}"],
+        "Image": "registry.example.com/app:1.0",
+        "State": "running",
+    }
+
+
+def stats(index):
+    """Response of /containers/{id}/stats?stream=false, usage derived from the index"""
+    return {
+        "read": "2024-01-01T00:00:00.000000000Z",
+        "pids_stats": {"current": index + 1},
+        "cpu_stats": {"cpu_usage": {"total_usage": (index + 1) * 1500000000}, "online_cpus": 4},
+        "memory_stats": {"usage": (index + 1) * MiB, "limit": HOST_MEMORY},
+        "blkio_stats": {"io_service_bytes_recursive": [
+            {"major": 259, "minor": 0, "op": "read", "value": (index + 1) * 4096},
+            {"major": 259, "minor": 0, "op": "write", "value": (index + 1) * 8192},
+            {"major": 259, "minor": 1, "op": "Read", "value": 1},
+        ]},
+        "networks": {
+            "eth0": {"rx_bytes": (index + 1) * 100, "tx_bytes": (index + 1) * 200},
+            "eth1": {"rx_bytes": 1, "tx_bytes": 2},
+        },
+    }
+
+
+def write_cgroup(sys_root, index, pid, memory_max=None):
+    """cgroup v2 directory of the container as the systemd cgroup driver creates it
+
+    `pid` is the process whose network namespace the container's network
+    counters are read from, `memory_max` None means unlimited.
+    """
+    directory = os.path.join(sys_root, "fs", "cgroup", "system.slice", f"docker-{container_id(index)}.scope")
+    os.makedirs(directory, exist_ok=True)
+    files = {
+        "cgroup.controllers": "cpuset cpu io memory pids\n",
+        "cgroup.procs": f"{pid}\n",
+        "cpu.stat": f"usage_usec {(index + 1) * 2500000}\nuser_usec 1\nsystem_usec 1\n",
+        "memory.current": f"{(index + 1) * 2 * MiB}\n",
+        "memory.max": "max\n" if memory_max is None else f"{memory_max}\n",
+        "pids.current": f"{index + 2}\n",
+        "io.stat": f"259:0 rbytes={(index + 1) * 1000} wbytes={(index + 1) * 2000} rios=1 wios=1 dbytes=0 dios=0\n"
+                   "259:1 rbytes=1 wbytes=2 rios=1 wios=1 dbytes=0 dios=0\n",
+    }
+    for name, text in files.items():
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(text)
+    return directory
+
+
+class FakeDocker(object):
+    """Docker Engine API on a Unix socket
+
+    `gone` are indexes of containers listed but answering stats with 404,
+    like one that exited in between, `failing` answer with 500. After
+    `requests_per_connection` responses the connection is closed, like the
+    daemon closing idle connections. `connections` and `requests` record
+    what the clients did.
+    """
+
+    def __init__(self, path, containers, gone=(), failing=(), stats_delay=0.0, requests_per_connection=None):
+        self.path = path
+        self.containers = containers
+        self.gone = set(gone)
+        self.failing = set(failing)
+        self.stats_delay = stats_delay
+        self.requests_per_connection = requests_per_connection
+        self.connections = 0
+        self.requests = []
+        self._indexes = {container_id(index): index for index in range(containers)}
+        self._loop = None
+        self._server = None
+        self._handlers = set()
+        self._thread = None
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), name="fake-docker", daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_unix_server(self._handle, self.path))
+        started.set()
+        self._loop.run_forever()
+
+    async def _close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        # Connections still open, e.g. delayed stats a client gave up on
+        for handler in self._handlers:
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def stats_requests(self):
+        """Indexes of the containers whose stats were asked for"""
+        return sorted(self._indexes[target.split("/")[2]] for target in self.requests if "/stats" in target)
+
+    async def _response(self, target):
+        if target.split("?")[0] == "/containers/json":
+            return 200, [summary(index) for index in range(self.containers)]
+        parts = target.split("?")[0].split("/")
+        index = self._indexes.get(parts[2]) if len(parts) == 4 and parts[3] == "stats" else None
+        if index is None:
+            return 404, {"message": "page not found"}
+        if self.stats_delay:
+            await asyncio.sleep(self.stats_delay)
+        if index in self.gone:
+            return 404, {"message": f"No such container: {parts[2]}"}
+        if index in self.failing:
+            return 500, {"message": "cannot get stats"}
+        return 200, stats(index)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._handlers.add(asyncio.current_task())
+        served = 0
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                target = request.split(b" ", 2)[1].decode("ascii")
+                self.requests.append(target)
+                status, document = await self._response(target)
+                body = json.dumps(document).encode("utf-8")
+                # Chunked like the daemon answers stats, split to exercise the reassembly
+                half = len(body) // 2
+                writer.write(
+                    b"HTTP/1.1 %d Fake\r\nContent-Type: application/json\r\nApi-Version: 1.43\r\n"
+                    b"Transfer-Encoding: chunked\r\n\r\n" % status
+                    + b"%x\r\n%s\r\n" % (half, body[:half])
+                    + b"%x\r\n%s\r\n" % (len(body) - half, body[half:])
+                    + b"0\r\n\r\n"
+                )
+                await writer.drain()
+                served += 1
+                if self.requests_per_connection is not None and served >= self.requests_per_connection:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Client gone, or the server stopping
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
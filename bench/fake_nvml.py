@@ -0,0 +1,204 @@
+# Stand-in for libnvidia-ml: answers the NVML calls nvml.py makes from a
+# list of fake devices, filling the ctypes arguments like the C library
+# does, so NVMLBackend can be run without a GPU or driver.
+NVML_SUCCESS = 0
+NVML_ERROR_UNINITIALIZED = 1
+NVML_ERROR_NOT_SUPPORTED = 3
+NVML_ERROR_INSUFFICIENT_SIZE = 7
+NVML_ERROR_GPU_IS_LOST = 15
+
+ERROR_STRINGS = {
+    NVML_ERROR_UNINITIALIZED: b"Uninitialized",
+    NVML_ERROR_NOT_SUPPORTED: b"Not Supported",
+    NVML_ERROR_INSUFFICIENT_SIZE: b"Insufficient Size",
+    NVML_ERROR_GPU_IS_LOST: b"GPU is lost",
+}
+
+
+class FakeDevice(object):
+    def __init__(self, index, utilization=50, memory_used_mib=1024, memory_total_mib=81920, temperature=40,
+                 memory_temperature=45, power_mw=60500, power_limit_mw=400000, clocks=(1410, 1410, 1593),
+                 pstate=0, fan_speed=None, throttle_reasons=0x01, processes=()):
+        self.index = index
+        self.uuid = f"GPU-{index:08x}-1111-2222-3333-444444444444"
+        self.name = "NVIDIA A100-SXM4-80GB"
+        self.serial = f"1323210{index:06d}"
+        self.utilization = utilization
+        self.memory_used = memory_used_mib * 1024 * 1024
+        self.memory_total = memory_total_mib * 1024 * 1024
+        self.temperature = temperature
+        self.memory_temperature = memory_temperature
+        self.power_mw = power_mw
+        self.power_limit_mw = power_limit_mw
+        # graphics, SM and memory clock in MHz
+        self.clocks = clocks
+        self.pstate = pstate
+        # None: the device has no fan, NVML reports it as not supported
+        self.fan_speed = fan_speed
+        self.throttle_reasons = throttle_reasons
+        # (pid, used bytes) of running compute processes
+        self.processes = list(processes)
+
+
+def _set(pointer, value):
+    """Writes value to what a ctypes.byref() argument points to"""
+    pointer._obj.value = value
+
+
+class FakeLibrary(object):
+    """The NVML C functions used by nvml.py, as Python methods
+
+    `initialized` False makes nvmlInit_v2 fail like a machine without a
+    driver, `error` makes every device query return that code, e.g.
+    NVML_ERROR_GPU_IS_LOST. `calls` counts the calls per function.
+    """
+
+    def __init__(self, devices=(), driver="535.104.05", initialized=True):
+        self.devices = list(devices)
+        self.driver = driver
+        self.initialized = initialized
+        self.error = None
+        self.calls = {}
+
+    def __getattribute__(self, name):
+        if name.startswith("nvml"):
+            calls = object.__getattribute__(self, "calls")
+            calls[name] = calls.get(name, 0) + 1
+        return object.__getattribute__(self, name)
+
+    def _device(self, handle):
+        if self.error is not None:
+            return None, self.error
+        return self.devices[handle.value - 1], NVML_SUCCESS
+
+    @staticmethod
+    def _string(value, buffer, size):
+        data = value.encode()
+        if len(data) >= size.value:
+            return NVML_ERROR_INSUFFICIENT_SIZE
+        buffer.value = data
+        return NVML_SUCCESS
+
+    def nvmlErrorString(self, code):
+        return ERROR_STRINGS.get(code, b"Unknown Error")
+
+    def nvmlInit_v2(self):
+        return NVML_SUCCESS if self.initialized else NVML_ERROR_UNINITIALIZED
+
+    def nvmlShutdown(self):
+        return NVML_SUCCESS
+
+    def nvmlSystemGetDriverVersion(self, buffer, size):
+        return self._string(self.driver, buffer, size)
+
+    def nvmlDeviceGetCount_v2(self, count):
+        _set(count, len(self.devices))
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetHandleByIndex_v2(self, index, handle):
+        if index.value >= len(self.devices):
+            return NVML_ERROR_GPU_IS_LOST
+        # Handles are opaque pointers, 0 would read as NULL
+        _set(handle, index.value + 1)
+        return NVML_SUCCESS
+
+    def _device_string(self, handle, buffer, size, attribute):
+        device, code = self._device(handle)
+        return code if device is None else self._string(getattr(device, attribute), buffer, size)
+
+    def nvmlDeviceGetUUID(self, handle, buffer, size):
+        return self._device_string(handle, buffer, size, "uuid")
+
+    def nvmlDeviceGetName(self, handle, buffer, size):
+        return self._device_string(handle, buffer, size, "name")
+
+    def nvmlDeviceGetSerial(self, handle, buffer, size):
+        return self._device_string(handle, buffer, size, "serial")
+
+    def nvmlDeviceGetVbiosVersion(self, handle, buffer, size):
+        return NVML_ERROR_NOT_SUPPORTED
+
+    def nvmlDeviceGetUtilizationRates(self, handle, utilization):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        utilization._obj.gpu = device.utilization
+        utilization._obj.memory = device.memory_used * 100 // device.memory_total
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetMemoryInfo(self, handle, memory):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        memory._obj.total = device.memory_total
+        memory._obj.used = device.memory_used
+        memory._obj.free = device.memory_total - device.memory_used
+        return NVML_SUCCESS
+
+    def _uint(self, handle, pointer, attribute):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        value = getattr(device, attribute)
+        if value is None:
+            return NVML_ERROR_NOT_SUPPORTED
+        _set(pointer, value)
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetCurrentClocksThrottleReasons(self, handle, reasons):
+        return self._uint(handle, reasons, "throttle_reasons")
+
+    def nvmlDeviceGetPerformanceState(self, handle, pstate):
+        return self._uint(handle, pstate, "pstate")
+
+    def nvmlDeviceGetDisplayMode(self, handle, mode):
+        _set(mode, 0)
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetDisplayActive(self, handle, active):
+        _set(active, 0)
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetTemperature(self, handle, sensor, temperature):
+        return self._uint(handle, temperature, "temperature")
+
+    def nvmlDeviceGetFanSpeed(self, handle, speed):
+        return self._uint(handle, speed, "fan_speed")
+
+    def nvmlDeviceGetPowerUsage(self, handle, power):
+        return self._uint(handle, power, "power_mw")
+
+    def nvmlDeviceGetPowerManagementLimit(self, handle, limit):
+        return self._uint(handle, limit, "power_limit_mw")
+
+    def nvmlDeviceGetEnforcedPowerLimit(self, handle, limit):
+        return self._uint(handle, limit, "power_limit_mw")
+
+    def nvmlDeviceGetClockInfo(self, handle, clock, mhz):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        _set(mhz, device.clocks[clock.value])
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetFieldValues(self, handle, count, fields):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        field = fields._obj
+        field.nvmlReturn = NVML_SUCCESS
+        field.value.uiVal = device.memory_temperature
+        return NVML_SUCCESS
+
+    def nvmlDeviceGetComputeRunningProcesses_v3(self, handle, count, infos):
+        device, code = self._device(handle)
+        if device is None:
+            return code
+        available = count._obj.value
+        _set(count, len(device.processes))
+        if infos is None or available < len(device.processes):
+            return NVML_ERROR_INSUFFICIENT_SIZE if device.processes else NVML_SUCCESS
+        for info, (pid, used) in zip(infos, device.processes):
+            info.pid = pid
+            info.usedGpuMemory = used
+        return NVML_SUCCESS
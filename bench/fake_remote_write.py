@@ -0,0 +1,194 @@
+# Stand-in for a Prometheus remote_write receiver: decodes the snappy
+# compressed WriteRequests it is sent, with a decoder of its own rather
+# than the exporter's encoder, and fails and recovers on command.
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def snappy_decompress(data):
+    """Block format as in https://github.com/google/snappy/blob/main/format_description.txt"""
+    length, position = _varint(data, 0)
+    out = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[position:position + extra], "little")
+                position += extra
+            size += 1
+            out += data[position:position + size]
+            position += size
+            continue
+        if kind == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[position]
+            position += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[position:position + 2], "little")
+            position += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[position:position + 4], "little")
+            position += 4
+        if not 0 < offset <= len(out):
+            raise ValueError(f"snappy copy offset {offset} outside {len(out)} bytes")
+        # Copies may overlap what they produce
+        for _ in range(size):
+            out.append(out[-offset])
+    if len(out) != length:
+        raise ValueError(f"snappy block of {len(out)} bytes, header says {length}")
+    return bytes(out)
+
+
+def fields(data):
+    """[(field number, value)] of a protobuf message, length delimited values as bytes"""
+    out = []
+    position = 0
+    while position < len(data):
+        key, position = _varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 1:
+            value = struct.unpack_from("<d", data, position)[0]
+            position += 8
+        elif wire_type == 2:
+            size, position = _varint(data, position)
+            value = data[position:position + size]
+            position += size
+        else:
+            raise ValueError(f"unexpected wire type {wire_type}")
+        out.append((number, value))
+    return out
+
+
+class WriteRequest(object):
+    """series: [(labels dict, [(timestamp ms, value)])], metadata: [(type, name, help)]"""
+
+    def __init__(self, body):
+        self.series = []
+        self.metadata = []
+        for number, value in fields(snappy_decompress(body)):
+            if number == 1:
+                labels = {}
+                samples = []
+                for series_field, part in fields(value):
+                    if series_field == 1:
+                        pair = dict(fields(part))
+                        labels[pair[1].decode("utf-8")] = pair[2].decode("utf-8")
+                    elif series_field == 2:
+                        sample = dict(fields(part))
+                        samples.append((sample.get(2, 0), sample.get(1, 0.0)))
+                self.series.append((labels, samples))
+            elif number == 3:
+                metadata = dict(fields(value))
+                self.metadata.append((
+                    metadata.get(1, 0), metadata[2].decode("utf-8"), metadata.get(4, b"").decode("utf-8")))
+
+    def timestamps(self, name):
+        """Sorted sample timestamps of the series called name"""
+        return sorted({
+            timestamp for labels, samples in self.series if labels.get("__name__") == name
+            for timestamp, _ in samples
+        })
+
+
+class FakeReceiver(object):
+    """remote_write endpoint on localhost, `accepted` holds the decoded requests in arrival order
+
+    fail() answers every request with a status, or with None drops the
+    connection without answering, until recover().
+    """
+
+    def __init__(self):
+        self.accepted = []
+        self.attempts = 0
+        self.failed = 0
+        # Requests missing a header remote_write requires
+        self.bad_headers = 0
+        self._status = 204
+        self._drop = False
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/api/v1/write"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-remote-write", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def fail(self, status=503):
+        with self._lock:
+            self._drop = status is None
+            self._status = status or 503
+
+    def recover(self):
+        with self._lock:
+            self._drop = False
+            self._status = 204
+
+    def _receive(self, handler):
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        with self._lock:
+            self.attempts += 1
+            if (handler.headers.get("Content-Encoding") != "snappy"
+                    or handler.headers.get("Content-Type") != "application/x-protobuf"
+                    or not handler.headers.get("X-Prometheus-Remote-Write-Version")):
+                self.bad_headers += 1
+            if self._drop:
+                self.failed += 1
+                return None
+            if self._status // 100 != 2:
+                self.failed += 1
+                return self._status
+            try:
+                self.accepted.append(WriteRequest(body))
+            except (ValueError, KeyError, IndexError, struct.error):
+                return 400
+            return self._status
+
+    def _handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                status = receiver._receive(self)
+                if status is None:
+                    self.close_connection = True
+                    return
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
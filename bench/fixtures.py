@@ -0,0 +1,177 @@
+# Synthetic host for the benchmarks: a fake nvidia-smi, a procfs root with
+# a generated cpuinfo and mountinfo, directories to mount, and a sysfs root
+# with the cgroups of fake_docker's containers. Everything else in the
+# procfs and sysfs roots links to the real /proc and /sys.
+import os
+import re
+import stat
+
+import fake_docker
+
+# Lines in the formats nvidia-smi prints for NVIDIA_SMI_GET_GPUS and
+# NVIDIA_SMI_GET_PROCS
+GPU_LINE = (
+    "{index}, {uuid}, {utilization}, 81920, {used}, {free}, 535.104.05, NVIDIA A100-SXM4-80GB, "
+    "1323210{index:06d}, Disabled, Disabled, {temperature}, 92.00.36.00.01, [N/A], P0, "
+    "Not Active, Active, Not Active, Not Active, Not Active, Not Active, {memory_temperature}, "
+    "{power:.2f}, 400.00, 400.00, 1410, 1410, 1593"
+)
+PROCESS_LINE = "{pid}, /usr/bin/python3, {uuid}, NVIDIA A100-SXM4-80GB, {used}"
+
+# The word in the mode file, if any, makes it misbehave: "stall" stops a
+# -lms loop printing, "exit" ends it with status 1, and "hang" hangs the
+# compute-apps query.
+NVIDIA_SMI = """#!/bin/sh
+# Prints the devices or compute apps of the benchmark fixture, looping
+# like nvidia-smi with -lms
+mode() {
+    cat "{directory}/mode" 2>/dev/null
+}
+interval=
+previous=
+for argument in "$@"; do
+    [ "$previous" = -lms ] && interval=$argument
+    previous=$argument
+done
+case "$*" in
+*--query-compute-apps*)
+    [ "$(mode)" = hang ] && exec sleep 3600
+    exec cat "{directory}/processes.csv" ;;
+esac
+[ -z "$interval" ] && exec cat "{directory}/gpus.csv"
+seconds=$(printf '%d.%03d' $((interval / 1000)) $((interval % 1000)))
+while :; do
+    case "$(mode)" in
+    stall) exec sleep 3600 ;;
+    exit) exit 1 ;;
+    esac
+    cat "{directory}/gpus.csv" || exit 1
+    sleep "$seconds"
+done
+"""
+
+CPUINFO = """processor\t: {processor}
+vendor_id\t: AuthenticAMD
+cpu family\t: 25
+model\t\t: 1
+model name\t: AMD EPYC 7763 64-Core Processor
+stepping\t: 1
+cpu MHz\t\t: 2450.000
+cache size\t: 512 KB
+physical id\t: {physical_id}
+siblings\t: {siblings}
+core id\t\t: {core_id}
+cpu cores\t: {cores}
+apicid\t\t: {apicid}
+fpu\t\t: yes
+flags\t\t: fpu vme de pse tsc msr pae mce cx8 apic sep mtrr pge mca cmov pat pse36 clflush mmx fxsr sse sse2 ht syscall nx mmxext fxsr_opt pdpe1gb rdtscp lm constant_tsc rep_good nopl nonstop_tsc cpuid extd_apicid aperfmperf pni pclmulqdq monitor ssse3 fma cx16 pcid sse4_1 sse4_2 x2apic movbe popcnt aes xsave avx f16c rdrand lahf_lm cmp_legacy svm extapic cr8_legacy abm sse4a misalignsse 3dnowprefetch osvw ibs skinit wdt tce topoext perfctr_core perfctr_nb bpext perfctr_llc mwaitx cpb cat_l3 cdp_l3 avx2 sha_ni
+
+"""
+
+MOUNTINFO_LINE = "{id} 1 259:{minor} / {mountpoint} rw,relatime shared:{id} - ext4 /dev/nvme{disk}n1p{partition} rw\n"
+
+
+def gpu_uuid(index):
+    return f"GPU-{index:08x}-1111-2222-3333-444444444444"
+
+
+def write_nvidia_smi(directory, gpus, processes):
+    with open(os.path.join(directory, "gpus.csv"), "w") as f:
+        for index in range(gpus):
+            used = 1024 * (index % 64)
+            f.write(GPU_LINE.format(
+                index=index, uuid=gpu_uuid(index), utilization=index * 7 % 101,
+                used=used, free=81920 - used, temperature=30 + index % 50,
+                memory_temperature=40 + index % 40, power=60.5 + index,
+            ) + "\n")
+    with open(os.path.join(directory, "processes.csv"), "w") as f:
+        for number in range(processes if gpus else 0):
+            # pids that do not exist, their user and command line stay empty
+            f.write(PROCESS_LINE.format(
+                pid=4000000 + number, uuid=gpu_uuid(number % gpus), used=256 + number,
+            ) + "\n")
+    path = os.path.join(directory, "nvidia-smi")
+    with open(path, "w") as f:
+        f.write(NVIDIA_SMI.replace("{directory}", directory))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def set_nvidia_smi_mode(directory, mode=None):
+    """Makes the fake nvidia-smi in directory stall, exit or hang, or behave again with None"""
+    path = os.path.join(directory, "mode")
+    if mode is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as f:
+        f.write(mode + "\n")
+
+
+def cpuinfo(threads, sockets=2, threads_per_core=2):
+    cores = max(1, threads // sockets // threads_per_core)
+    text = []
+    for processor in range(threads):
+        physical_id = processor * sockets // threads
+        core_id = processor % cores
+        text.append(CPUINFO.format(
+            processor=processor, physical_id=physical_id, siblings=threads // sockets,
+            core_id=core_id, cores=cores, apicid=processor,
+        ))
+    return "".join(text)
+
+
+def mountinfo(directory, mounts):
+    lines = []
+    for number in range(mounts):
+        mountpoint = os.path.join(directory, f"{number:05d}")
+        os.makedirs(mountpoint, exist_ok=True)
+        lines.append(MOUNTINFO_LINE.format(
+            id=100 + number, minor=number, mountpoint=mountpoint,
+            disk=number // 16, partition=number % 16 + 1,
+        ))
+    return "".join(lines)
+
+
+def write_proc(directory, threads, mounts, mount_directory):
+    for entry in os.listdir("/proc"):
+        if entry not in ("cpuinfo", "self", "thread-self"):
+            os.symlink(os.path.join("/proc", entry), os.path.join(directory, entry))
+    with open(os.path.join(directory, "cpuinfo"), "w") as f:
+        f.write(cpuinfo(threads))
+    os.makedirs(os.path.join(directory, "self"))
+    with open(os.path.join(directory, "self", "mountinfo"), "w") as f:
+        f.write(mountinfo(mount_directory, mounts))
+
+
+def write_sys(directory, containers):
+    """cgroups of every other container, the others are read through the stats API"""
+    for entry in os.listdir("/sys"):
+        if entry != "fs":
+            os.symlink(os.path.join("/sys", entry), os.path.join(directory, entry))
+    for index in range(0, containers, 2):
+        fake_docker.write_cgroup(directory, index, os.getpid())
+
+
+def build(root, gpus=8, gpu_processes=64, threads=512, mounts=1000, containers=50):
+    """Writes the fixture below root and returns the environment to run the exporter in
+
+    The Docker socket is served by fake_docker.FakeDocker, which the caller
+    starts on EXPORTER_DOCKER_SOCKET with the same number of containers.
+    """
+    paths = {name: os.path.join(root, name) for name in ("bin", "proc", "sys", "mnt", "screens")}
+    for path in paths.values():
+        os.makedirs(path)
+    write_nvidia_smi(paths["bin"], gpus, gpu_processes)
+    write_proc(paths["proc"], threads, mounts, paths["mnt"])
+    write_sys(paths["sys"], containers)
+    return {
+        "PATH": paths["bin"] + os.pathsep + os.environ.get("PATH", ""),
+        "EXPORTER_PROC_ROOT": paths["proc"],
+        "EXPORTER_SYS_ROOT": paths["sys"],
+        "EXPORTER_GPU_BACKEND": "nvidia-smi",
+        "EXPORTER_SCREEN_DIRS": paths["screens"],
+        "EXPORTER_DOCKER_SOCKET": os.path.join(root, "docker.sock"),
+        # The default excludes would drop mounts below /var/lib or /snap temp directories
+        "EXPORTER_DISK_MOUNTPOINT_INCLUDE": "^" + re.escape(paths["mnt"]),
+        "EXPORTER_DISK_MOUNTPOINT_EXCLUDE": "",
+    }
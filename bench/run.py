@@ -0,0 +1,214 @@
+# Times every collector and the whole /metrics request against the
+# synthetic host from fixtures.py, and measures their allocations. Results
+# are written as JSON, and compared against an earlier run with --baseline.
+#
+#   python bench/run.py --output baseline.json
+#   python bench/run.py --baseline baseline.json --output current.json
+import argparse
+import asyncio
+import gc
+import inspect
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_docker
+import fixtures
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the collectors and /metrics")
+    parser.add_argument("--gpus", type=int, default=8)
+    parser.add_argument("--gpu-processes", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=512)
+    parser.add_argument("--mounts", type=int, default=1000)
+    parser.add_argument("--containers", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per benchmark")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this earlier result file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="exit with 1 if a benchmark is more than this factor slower than in the baseline")
+    return parser.parse_args()
+
+
+async def call(function):
+    result = function()
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def measure(function, repeat):
+    """Wall times of repeat runs after a warm-up, then the allocations of one more run"""
+    await call(function)
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        await call(function)
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await call(function)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "runs": repeat,
+        "min_ms": round(min(times) * 1000, 3),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "max_ms": round(max(times) * 1000, 3),
+        "peak_allocated_bytes": peak - before,
+        "retained_bytes": current - before,
+    }
+
+
+def metrics_request(app, headers=()):
+    """Function running GET /metrics through the ASGI app, without a server"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/metrics",
+        "raw_path": b"/metrics",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8754),
+    }
+
+    async def request():
+        received = []
+        body = []
+        disconnected = asyncio.get_running_loop().create_future()
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # Only a listener for disconnects gets here, the client stays
+            return await disconnected
+
+        async def send(message):
+            if message["type"] == "http.response.start" and message["status"] != 200:
+                raise RuntimeError(f"/metrics returned {message['status']}")
+            if message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        await app(scope, receive, send)
+        return b"".join(body)
+
+    return request
+
+
+async def run(args):
+    import main
+
+    benchmarks = {}
+    for function in main.COLLECTORS.values():
+        benchmarks[function.__name__] = function
+    # Only runs when CPUs go on/offline, parses the 512 thread cpuinfo
+    benchmarks["cpu_info_prometheus_metrics"] = main.cpu_info_prometheus_metrics
+
+    results = {}
+    async with main.lifespan(main.app):
+        for name, function in benchmarks.items():
+            results[name] = await measure(function, args.repeat)
+            print(f"{name:45} {results[name]['median_ms']:10.3f} ms", file=sys.stderr)
+        for name, headers in (
+            ("GET /metrics", ()),
+            ("GET /metrics gzip", (("accept-encoding", "gzip"),)),
+        ):
+            request = metrics_request(main.app, headers)
+            results[name] = await measure(request, args.repeat)
+            results[name]["response_bytes"] = len(await request())
+            print(f"{name:45} {results[name]['median_ms']:10.3f} ms", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of each fastest run, returns the names slower than threshold
+
+    The fastest of several runs is the least disturbed by other load on the
+    machine, medians vary too much for a fixed threshold.
+    """
+    slower = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None or not before["min_ms"]:
+            continue
+        ratio = result["min_ms"] / before["min_ms"]
+        allocated = result["peak_allocated_bytes"] - before["peak_allocated_bytes"]
+        marker = " SLOWER" if ratio > threshold else ""
+        print(f"{name:45} {before['min_ms']:10.3f} -> {result['min_ms']:10.3f} ms "
+              f"({ratio:5.2f}x, peak allocations {allocated:+d} bytes){marker}")
+        if ratio > threshold:
+            slower.append(name)
+    return slower
+
+
+def main():
+    args = parse_args()
+    parameters = {
+        "gpus": args.gpus,
+        "gpu_processes": args.gpu_processes,
+        "threads": args.threads,
+        "mounts": args.mounts,
+        "containers": args.containers,
+        "repeat": args.repeat,
+    }
+    with tempfile.TemporaryDirectory(prefix="exporter-bench-") as root:
+        # config is read on import, the environment has to be in place first
+        os.environ.update(fixtures.build(
+            root, gpus=args.gpus, gpu_processes=args.gpu_processes,
+            threads=args.threads, mounts=args.mounts, containers=args.containers,
+        ))
+        # Every collector runs during the request, nothing is pushed or federated
+        for name in ("GPU", "DISK", "DISKIO", "CPU", "HOST", "DOCKER", "MEMORY", "NETWORK", "PROCESSES", "SCREEN"):
+            os.environ[f"EXPORTER_INTERVAL_{name}"] = "0"
+        for name in ("EXPORTER_REMOTE_WRITE_URL", "EXPORTER_FEDERATION_TARGETS"):
+            os.environ.pop(name, None)
+        sys.path.insert(0, SRC)
+        docker = fake_docker.FakeDocker(os.environ["EXPORTER_DOCKER_SOCKET"], args.containers)
+        docker.start()
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            docker.stop()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": parameters,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            print(f"Baseline was run with {baseline.get('parameters')}, not {parameters}", file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+# Caches values that are expensive to build but rarely change, rebuilding
+# them only when a cheap fingerprint of their inputs changes.
+import threading
+
+
+class FingerprintCache(object):
+    def __init__(self, fingerprint, build):
+        # fingerprint: cheap function whose result changes with the inputs
+        # build: function producing the cached value
+        self.fingerprint = fingerprint
+        self.build = build
+        self._key = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        key = self.fingerprint()
+        if self._value is None or key != self._key:
+            with self._lock:
+                if self._value is None or key != self._key:
+                    self._value = self.build()
+                    self._key = key
+        return self._value
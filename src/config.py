@@ -0,0 +1,155 @@
+# Runtime configuration, read once from environment variables at startup.
+import os
+import re
+import socket
+
+
+def env_str(name, default):
+    return os.environ.get(name, default)
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def env_regex(name, default):
+    """Compiled pattern from the environment, None for an empty pattern"""
+    value = os.environ.get(name, default)
+    return re.compile(value) if value else None
+
+
+# Where procfs is mounted, e.g. /host/proc when running in a container
+PROC_ROOT = env_str("EXPORTER_PROC_ROOT", "/proc")
+SYS_ROOT = env_str("EXPORTER_SYS_ROOT", "/sys")
+
+HOST = env_str("EXPORTER_HOST", "0.0.0.0")
+PORT = env_int("EXPORTER_PORT", 8754)
+
+# Seconds between background runs of each collector.
+# An interval of 0 collects inline on every scrape instead.
+COLLECTOR_INTERVALS = {
+    "gpu": env_float("EXPORTER_INTERVAL_GPU", 5),
+    "disk": env_float("EXPORTER_INTERVAL_DISK", 30),
+    "diskio": env_float("EXPORTER_INTERVAL_DISKIO", 5),
+    "cpu": env_float("EXPORTER_INTERVAL_CPU", 5),
+    "host": env_float("EXPORTER_INTERVAL_HOST", 60),
+    "docker": env_float("EXPORTER_INTERVAL_DOCKER", 15),
+    "memory": env_float("EXPORTER_INTERVAL_MEMORY", 5),
+    "network": env_float("EXPORTER_INTERVAL_NETWORK", 5),
+    "processes": env_float("EXPORTER_INTERVAL_PROCESSES", 15),
+    "screen": env_float("EXPORTER_INTERVAL_SCREEN", 15),
+}
+
+# Seconds a collector run may take before it is dropped and reported as failed
+COLLECTOR_TIMEOUTS = {
+    name: env_float(f"EXPORTER_TIMEOUT_{name.upper()}", env_float("EXPORTER_TIMEOUT", 10))
+    for name in COLLECTOR_INTERVALS
+}
+# Size of the thread pool collectors run on
+COLLECTOR_WORKERS = env_int("EXPORTER_COLLECTOR_WORKERS", 4)
+
+# zlib level for gzip encoded responses
+GZIP_LEVEL = env_int("EXPORTER_GZIP_LEVEL", 6)
+
+# Seconds between /proc/stat reads, cpu_utilization is averaged over this window
+CPU_SAMPLE_INTERVAL = env_float("EXPORTER_CPU_SAMPLE_INTERVAL", 1)
+
+# nvml: read libnvidia-ml directly, falling back to nvidia-smi without it
+# nvidia-smi: run once per collection, nvidia-smi-stream: one long-lived
+# nvidia-smi looping every EXPORTER_GPU_STREAM_INTERVAL_MS milliseconds
+GPU_BACKEND = env_str("EXPORTER_GPU_BACKEND", "nvml")
+GPU_STREAM_INTERVAL_MS = env_int("EXPORTER_GPU_STREAM_INTERVAL_MS", 1000)
+# Seconds between the GPU sampler's readings of utilization, power, clocks
+# and temperature, fractions allowed, 0 disables it. Needs the nvml or the
+# nvidia-smi-stream backend; the latter only changes every stream interval.
+GPU_SAMPLE_INTERVAL = env_float("EXPORTER_GPU_SAMPLE_INTERVAL", 0)
+# Seconds of readings the window statistics are computed over
+GPU_SAMPLE_WINDOW = env_float("EXPORTER_GPU_SAMPLE_WINDOW", 15)
+GPU_SAMPLE_QUANTILES = [
+    float(quantile) for quantile in env_str("EXPORTER_GPU_SAMPLE_QUANTILES", "0.5,0.9,0.99").split(",")
+    if quantile.strip()
+]
+
+# Directories holding the per-user S-<user> screen socket directories
+SCREEN_DIRS = env_str("EXPORTER_SCREEN_DIRS", "/run/screen:/var/run/screen:/tmp/screens").split(":")
+
+# Mounts reported by the disk collector. A mount is reported if its fstype
+# and mountpoint match the include patterns (empty matches everything) and
+# neither matches an exclude pattern, patterns are searched anywhere.
+DISK_FSTYPE_INCLUDE = env_regex("EXPORTER_DISK_FSTYPE_INCLUDE", "")
+DISK_FSTYPE_EXCLUDE = env_regex(
+    "EXPORTER_DISK_FSTYPE_EXCLUDE",
+    "^(autofs|binfmt_misc|bpf|cgroup2?|configfs|debugfs|devpts|devtmpfs|efivarfs|fusectl|hugetlbfs"
+    "|mqueue|nsfs|overlay|proc|pstore|ramfs|rpc_pipefs|securityfs|selinuxfs|squashfs|sysfs|tmpfs"
+    "|tracefs|fuse\\.lxcfs|fuse\\.snapfuse|fuse\\.gvfsd-fuse)$",
+)
+DISK_MOUNTPOINT_INCLUDE = env_regex("EXPORTER_DISK_MOUNTPOINT_INCLUDE", "")
+DISK_MOUNTPOINT_EXCLUDE = env_regex(
+    "EXPORTER_DISK_MOUNTPOINT_EXCLUDE", "^/(dev|proc|sys)($|/)|snap|docker|loop|boot|var/lib")
+# Seconds a statvfs may take before its mount is quarantined
+DISK_STAT_TIMEOUT = env_float("EXPORTER_DISK_STAT_TIMEOUT", 2)
+DISK_STAT_WORKERS = env_int("EXPORTER_DISK_STAT_WORKERS", 4)
+# Seconds a timed out mount is skipped for, doubling on every further timeout
+DISK_QUARANTINE_MIN = env_float("EXPORTER_DISK_QUARANTINE_MIN", 30)
+DISK_QUARANTINE_MAX = env_float("EXPORTER_DISK_QUARANTINE_MAX", 900)
+
+# Block devices reported by the disk I/O collector, by kernel name
+DISKIO_DEVICE_INCLUDE = env_regex("EXPORTER_DISKIO_DEVICE_INCLUDE", "")
+DISKIO_DEVICE_EXCLUDE = env_regex("EXPORTER_DISKIO_DEVICE_EXCLUDE", "^(z?ram|loop|fd|sr)\\d+$")
+# Seconds between /proc/diskstats reads for the disk_*_per_second, latency
+# and utilization gauges, 0 only exposes the counters
+DISKIO_SAMPLE_INTERVAL = env_float("EXPORTER_DISKIO_SAMPLE_INTERVAL", 0)
+
+# Network interfaces reported by the network collector
+NETWORK_INTERFACE_INCLUDE = env_regex("EXPORTER_NETWORK_INTERFACE_INCLUDE", "")
+NETWORK_INTERFACE_EXCLUDE = env_regex("EXPORTER_NETWORK_INTERFACE_EXCLUDE", "^veth")
+# Seconds between /proc/net/dev reads for the network_*_per_second and
+# utilization gauges, 0 only exposes the counters
+NETWORK_SAMPLE_INTERVAL = env_float("EXPORTER_NETWORK_SAMPLE_INTERVAL", 0)
+
+# Docker Engine API socket and the number of connections kept open to it
+DOCKER_SOCKET = env_str("EXPORTER_DOCKER_SOCKET", "/var/run/docker.sock")
+DOCKER_CONNECTIONS = env_int("EXPORTER_DOCKER_CONNECTIONS", 8)
+
+# Processes exported by the process collector: the top N by CPU, by
+# resident memory and, if enabled, by I/O (reading /proc/<pid>/io needs root)
+PROCESS_TOP_N = env_int("EXPORTER_PROCESS_TOP_N", 10)
+PROCESS_IO = env_int("EXPORTER_PROCESS_IO", 1) > 0
+# Characters of a command line kept in labels
+PROCESS_CMDLINE_LENGTH = env_int("EXPORTER_PROCESS_CMDLINE_LENGTH", 200)
+
+# Push mode: remote_write endpoint of a Prometheus compatible receiver,
+# empty disables it
+REMOTE_WRITE_URL = env_str("EXPORTER_REMOTE_WRITE_URL", "")
+# Seconds between scrapes pushed, and scrapes sent per request
+REMOTE_WRITE_INTERVAL = env_float("EXPORTER_REMOTE_WRITE_INTERVAL", 15)
+REMOTE_WRITE_BATCH = env_int("EXPORTER_REMOTE_WRITE_BATCH", 4)
+REMOTE_WRITE_TIMEOUT = env_float("EXPORTER_REMOTE_WRITE_TIMEOUT", 10)
+# Requests not yet accepted by the receiver, oldest dropped beyond the limit
+REMOTE_WRITE_WAL_DIR = env_str("EXPORTER_REMOTE_WRITE_WAL_DIR", "remote_write_wal")
+REMOTE_WRITE_WAL_MAX_BYTES = env_int("EXPORTER_REMOTE_WRITE_WAL_MAX_BYTES", 64 * 1024 * 1024)
+# job and instance labels of pushed series, as Prometheus would add them when scraping
+REMOTE_WRITE_JOB = env_str("EXPORTER_REMOTE_WRITE_JOB", "only_prometheus_exporter")
+REMOTE_WRITE_INSTANCE = env_str("EXPORTER_REMOTE_WRITE_INSTANCE", f"{socket.gethostname()}:{PORT}")
+
+# Aggregator mode: comma separated peer exporters (host:port or URL) that
+# /federate scrapes and re-exposes with an instance label, empty disables it
+FEDERATION_TARGETS = [target.strip() for target in env_str("EXPORTER_FEDERATION_TARGETS", "").split(",") if target.strip()]
+# Peers scraped at the same time, and seconds each of them may take
+FEDERATION_CONCURRENCY = env_int("EXPORTER_FEDERATION_CONCURRENCY", 32)
+FEDERATION_TIMEOUT = env_float("EXPORTER_FEDERATION_TIMEOUT", 10)
+
+# /debug/profile and /debug/tracemalloc, off unless set to 1: they show
+# the exporter's internals and let any client keep it busy
+DEBUG_ENDPOINTS = env_int("EXPORTER_DEBUG_ENDPOINTS", 0) > 0
+# Longest profile or allocation trace a request may ask for, in seconds
+DEBUG_MAX_SECONDS = env_float("EXPORTER_DEBUG_MAX_SECONDS", 60)
+# Frames tracemalloc keeps per allocation when tracing from startup, 0
+# only traces while a /debug/tracemalloc request waits
+TRACEMALLOC_FRAMES = env_int("EXPORTER_TRACEMALLOC_FRAMES", 0)
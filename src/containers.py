@@ -0,0 +1,235 @@
+# Container metrics from the Docker daemon and the containers' cgroups.
+# The daemon is only asked for the container list, resource usage is read
+# from cgroup v2 files where they are visible and from the stats API, all
+# containers at once, where they are not.
+import asyncio
+import json
+import logging
+import os
+
+import http_client
+import procfs
+
+logger = logging.getLogger(__name__)
+
+
+HEADERS = (("Accept", "application/json"),)
+
+
+class DockerError(Exception):
+    pass
+
+
+class DockerClient(object):
+    """Docker Engine API client keeping up to `connections` keep-alive connections"""
+
+    def __init__(self, path, connections=8, timeout=5.0):
+        self.path = path
+        self.connections = connections
+        self.timeout = timeout
+        self._pool = http_client.ConnectionPool(self._connect, connections)
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    async def _connect(self):
+        return await http_client.HTTPConnection.open_unix(self.path, host="docker")
+
+    async def _request(self, connection, target):
+        return await asyncio.wait_for(connection.request("GET", target, HEADERS), self.timeout)
+
+    async def get(self, target):
+        """Decoded JSON of a GET, None for 404 (e.g. a container that just exited)"""
+        async with self._pool.slot():
+            connection, reused = await self._pool.acquire()
+            try:
+                try:
+                    status, body = await self._request(connection, target)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The daemon closed the idle connection, retry on a new one
+                    connection.close()
+                    connection = await self._connect()
+                    status, body = await self._request(connection, target)
+            except asyncio.TimeoutError:
+                connection.close()
+                raise DockerError(f"GET {target} timed out after {self.timeout}s")
+            except BaseException:
+                connection.close()
+                raise
+            self._pool.release(connection)
+        if status == 404:
+            return None
+        if status != 200:
+            raise DockerError(f"GET {target} returned {status}: {body[:200]!r}")
+        return json.loads(body)
+
+    async def containers(self):
+        return await self.get("/containers/json")
+
+    async def stats(self, container_id):
+        # one-shot skips the second sample the daemon otherwise waits a
+        # second for, precpu values are not used
+        return await self.get(f"/containers/{container_id}/stats?stream=false&one-shot=true")
+
+    async def close(self):
+        self._pool.close()
+
+
+class Container(object):
+    def __init__(self, summary):
+        self.id = summary["Id"]
+        names = summary.get("Names") or [""]
+        self.name = names[0].lstrip("/")
+        self.image = summary.get("Image", "")
+        self.state = summary.get("State", "")
+
+    @property
+    def labels(self):
+        return (self.id[:12], self.name, self.image)
+
+
+class ContainerUsage(object):
+    def __init__(self, cpu_seconds=None, memory_usage=None, memory_limit=None, pids=None,
+                 block_read=None, block_written=None, rx_bytes=None, tx_bytes=None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_usage = memory_usage
+        self.memory_limit = memory_limit
+        self.pids = pids
+        self.block_read = block_read
+        self.block_written = block_written
+        self.rx_bytes = rx_bytes
+        self.tx_bytes = tx_bytes
+
+
+def cgroup_dir(container_id):
+    """cgroup v2 directory of a container, None if it is not visible"""
+    for relative in (
+        ("fs", "cgroup", "system.slice", f"docker-{container_id}.scope"),  # systemd driver
+        ("fs", "cgroup", "docker", container_id),  # cgroupfs driver
+    ):
+        directory = procfs.sys_path(*relative)
+        if os.path.exists(os.path.join(directory, "cgroup.controllers")):
+            return directory
+    return None
+
+
+def _read(directory, name):
+    with open(os.path.join(directory, name), "r") as f:
+        return f.read()
+
+
+def _keyed(text):
+    """{key: int} from "key value" lines"""
+    values = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(" ")
+        if value.strip().isdigit():
+            values[key] = int(value)
+    return values
+
+
+def _io_bytes(text):
+    # "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0" per device
+    read = written = 0
+    for line in text.splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key == "rbytes":
+                read += int(value)
+            elif key == "wbytes":
+                written += int(value)
+    return read, written
+
+
+def _network_bytes(pid):
+    rx = tx = 0
+    for stat in procfs.parse_net_dev(procfs.read(str(pid), "net", "dev")):
+        if stat.name != "lo":
+            rx += stat.rx_bytes
+            tx += stat.tx_bytes
+    return rx, tx
+
+
+def read_cgroup(directory, host_memory):
+    """ContainerUsage from a cgroup v2 directory, network from the netns of one of its processes"""
+    usage = ContainerUsage()
+    usage.cpu_seconds = _keyed(_read(directory, "cpu.stat")).get("usage_usec", 0) / 1000000
+    usage.memory_usage = int(_read(directory, "memory.current"))
+    limit = _read(directory, "memory.max").strip()
+    # Unlimited containers report the host's memory, as the stats API does
+    usage.memory_limit = host_memory if limit == "max" else int(limit)
+    try:
+        usage.pids = int(_read(directory, "pids.current"))
+    except (OSError, ValueError):
+        pass
+    try:
+        usage.block_read, usage.block_written = _io_bytes(_read(directory, "io.stat"))
+    except OSError:
+        pass
+    pids = _read(directory, "cgroup.procs").split()
+    if pids:
+        try:
+            usage.rx_bytes, usage.tx_bytes = _network_bytes(pids[0])
+        except OSError:
+            pass
+    return usage
+
+
+def usage_from_stats(stats):
+    """ContainerUsage from a stats?stream=false response"""
+    usage = ContainerUsage()
+    total = stats.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage")
+    if total is not None:
+        usage.cpu_seconds = total / 1000000000
+    memory = stats.get("memory_stats") or {}
+    usage.memory_usage = memory.get("usage")
+    usage.memory_limit = memory.get("limit")
+    usage.pids = (stats.get("pids_stats") or {}).get("current")
+    entries = (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+    if entries:
+        usage.block_read = sum(entry["value"] for entry in entries if entry.get("op", "").lower() == "read")
+        usage.block_written = sum(entry["value"] for entry in entries if entry.get("op", "").lower() == "write")
+    networks = stats.get("networks")
+    if networks:
+        usage.rx_bytes = sum(network.get("rx_bytes", 0) for network in networks.values())
+        usage.tx_bytes = sum(network.get("tx_bytes", 0) for network in networks.values())
+    return usage
+
+
+def read_cgroups(containers):
+    """container id -> ContainerUsage for the containers whose cgroup is visible"""
+    usages = {}
+    host_memory = None
+    for container in containers:
+        directory = cgroup_dir(container.id)
+        if directory is None:
+            continue
+        if host_memory is None:
+            host_memory = procfs.read_memory().ram_total
+        try:
+            usages[container.id] = read_cgroup(directory, host_memory)
+        except (OSError, ValueError) as e:
+            # Container stopped while reading, the stats API decides
+            logger.debug("reading cgroup of %s failed: %s", container.id, e)
+    return usages
+
+
+async def collect(client):
+    """[(Container, ContainerUsage or None)] of the running containers"""
+    containers = [Container(summary) for summary in await client.containers()]
+    usages = await asyncio.to_thread(read_cgroups, containers)
+    missing = [container for container in containers if container.id not in usages]
+    if missing:
+        results = await asyncio.gather(
+            *(client.stats(container.id) for container in missing), return_exceptions=True
+        )
+        for container, stats in zip(missing, results):
+            if isinstance(stats, BaseException):
+                if isinstance(stats, asyncio.CancelledError):
+                    raise stats
+                logger.warning("stats of container %s failed: %s", container.name, stats)
+            elif stats is not None:
+                usages[container.id] = usage_from_stats(stats)
+    return [(container, usages.get(container.id)) for container in containers]
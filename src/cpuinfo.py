@@ -30,6 +30,8 @@ import warnings
 import platform
 import inspect
 
+import procfs
+
 is_cpu_amd_intel = False # DEPRECATION WARNING: WILL BE REMOVED IN FUTURE RELEASE
 
 def getoutput(cmd, successful_status=(0,), stacklevel=1):
@@ -90,6 +92,11 @@ class CPUInfoBase(object):
         except:
             pass
 
+    def invalidate(self):
+        """Forget the information shared by all instances and gather it again"""
+        self.__class__.info = None
+        self.__init__()
+
     def __getattr__(self, name):
         if not name.startswith('_'):
             if hasattr(self, '_' + name):
@@ -126,7 +133,7 @@ class LinuxCPUInfo(CPUInfoBase):
         if ok:
             info[0]['uname_m'] = output.strip()
         try:
-            fo = open('/proc/cpuinfo')
+            fo = open(procfs.path('cpuinfo'))
         except EnvironmentError as e:
             warnings.warn(str(e), UserWarning)
         else:
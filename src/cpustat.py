@@ -0,0 +1,71 @@
+# CPU utilization from /proc/stat deltas over a fixed internal window,
+# independent of how many scrapers there are and how often they come.
+import os
+import time
+from array import array
+
+import procfs
+from sampler import Sampler
+
+CLOCK_TICKS = procfs.CLOCK_TICKS
+WIDTH = len(procfs.CPU_TIMES_FIELDS)
+IDLE = procfs.CPU_TIMES_FIELDS.index("idle")
+IOWAIT = procfs.CPU_TIMES_FIELDS.index("iowait")
+# guest time is already counted in user and nice
+GUEST = procfs.CPU_TIMES_FIELDS.index("guest")
+
+
+class CPUSample(object):
+    def __init__(self, timestamp, cpus, jiffies, utilization):
+        self.timestamp = timestamp
+        self.cpus = cpus
+        self.jiffies = jiffies
+        # Busy percent per thread over the last window, None until two reads
+        self.utilization = utilization
+
+    def times(self):
+        """(cpu, mode, seconds) for every thread and psutil.cpu_times() mode"""
+        jiffies = self.jiffies
+        for index, cpu in enumerate(self.cpus):
+            offset = index * WIDTH
+            for field, mode in enumerate(procfs.CPU_TIMES_FIELDS):
+                yield cpu, mode, jiffies[offset + field] / CLOCK_TICKS
+
+
+def utilization(previous, current, threads):
+    """Busy percent per thread between two flat jiffy arrays, like psutil.cpu_percent()"""
+    result = array("d", bytes(8 * threads))
+    for index in range(threads):
+        offset = index * WIDTH
+        total = 0
+        for field in range(GUEST):
+            total += current[offset + field] - previous[offset + field]
+        idle = (current[offset + IDLE] - previous[offset + IDLE]
+                + current[offset + IOWAIT] - previous[offset + IOWAIT])
+        if total > 0:
+            result[index] = round(max(0.0, min(100.0, (total - idle) / total * 100)), 1)
+    return result
+
+
+class CPUSampler(Sampler):
+    name = "cpu-sampler"
+
+    def __init__(self, interval=1.0):
+        super().__init__(interval)
+        self._latest = None
+
+    def available(self):
+        return os.path.exists(procfs.path("stat"))
+
+    def sample(self):
+        cpus, jiffies = procfs.parse_stat_cpus(procfs.read("stat"))
+        previous = self._latest
+        if previous is not None and previous.cpus == cpus:
+            percent = utilization(previous.jiffies, jiffies, len(cpus))
+        else:
+            # First read, or threads went on/offline: start a new window
+            percent = None
+        self._latest = CPUSample(time.time(), cpus, jiffies, percent)
+
+    def latest(self) -> CPUSample:
+        return self._latest
@@ -0,0 +1,84 @@
+# Block device I/O from /proc/diskstats, one read per collection. Rates and
+# latencies are computed by an optional sampler over a fixed window.
+import os
+import time
+
+import procfs
+from sampler import Sampler
+
+# /proc/diskstats counts in 512 byte sectors whatever the device's sector size
+SECTOR_SIZE = 512
+
+
+def read_diskstats():
+    return procfs.parse_diskstats(procfs.read("diskstats"))
+
+
+def device_path(name):
+    """/dev path of a block device, device-mapper devices by their mapper name"""
+    try:
+        mapper_name = procfs.read_sys("block", name, "dm", "name").strip()
+    except OSError:
+        return f"/dev/{name}"
+    return f"/dev/mapper/{mapper_name}" if mapper_name else f"/dev/{name}"
+
+
+class DiskRates(object):
+    def __init__(self, previous, current, seconds):
+        self.read_bytes = (current.sectors_read - previous.sectors_read) * SECTOR_SIZE / seconds
+        self.write_bytes = (current.sectors_written - previous.sectors_written) * SECTOR_SIZE / seconds
+        reads = current.reads - previous.reads
+        writes = current.writes - previous.writes
+        self.reads = reads / seconds
+        self.writes = writes / seconds
+        # Average time a completed request took, 0 without requests
+        self.read_latency = (current.read_ms - previous.read_ms) / 1000 / reads if reads else 0.0
+        self.write_latency = (current.write_ms - previous.write_ms) / 1000 / writes if writes else 0.0
+        # Percent of the window the device was busy
+        busy = (current.io_ms - previous.io_ms) / 1000 / seconds * 100
+        self.utilization = round(max(0.0, min(100.0, busy)), 1)
+
+
+def rates(previous, current, seconds):
+    """name -> DiskRates between two reads, devices that appeared or were reset are left out"""
+    before = {stat.name: stat for stat in previous}
+    result = {}
+    for stat in current:
+        old = before.get(stat.name)
+        if old is None or old.device_number != stat.device_number:
+            continue
+        if stat.sectors_read < old.sectors_read or stat.sectors_written < old.sectors_written:
+            continue
+        result[stat.name] = DiskRates(old, stat, seconds)
+    return result
+
+
+class DiskIOSample(object):
+    def __init__(self, timestamp, monotonic, stats, rates):
+        self.timestamp = timestamp
+        self.monotonic = monotonic
+        self.stats = stats
+        # name -> DiskRates over the last window, None until two reads
+        self.rates = rates
+
+
+class DiskIOSampler(Sampler):
+    """Reads /proc/diskstats every interval seconds, disabled with interval 0"""
+    name = "diskio-sampler"
+
+    def __init__(self, interval=0):
+        super().__init__(interval)
+        self._latest = None
+
+    def available(self):
+        return self.interval > 0 and os.path.exists(procfs.path("diskstats"))
+
+    def sample(self):
+        stats = read_diskstats()
+        now = time.monotonic()
+        previous = self._latest
+        window = rates(previous.stats, stats, now - previous.monotonic) if previous is not None else None
+        self._latest = DiskIOSample(time.time(), now, stats, window)
+
+    def latest(self) -> DiskIOSample:
+        return self._latest
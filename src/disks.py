@@ -0,0 +1,232 @@
+# Space usage of mounted filesystems. statvfs runs on a small pool of our
+# own with a timeout per mount, so a hung network mount is quarantined
+# instead of hanging the collector.
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import procfs
+
+logger = logging.getLogger(__name__)
+
+_octal_escape = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field):
+    # Spaces, tabs, newlines and backslashes are written as \ooo
+    return _octal_escape.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+class Mount(object):
+    def __init__(self, device_number, root, mountpoint, fstype, device):
+        # major:minor of the filesystem, shared by all its bind mounts
+        self.device_number = device_number
+        # Directory of the filesystem mounted at mountpoint
+        self.root = root
+        self.mountpoint = mountpoint
+        self.fstype = fstype
+        self.device = device
+
+    @property
+    def labels(self):
+        return (self.device, self.mountpoint, self.fstype)
+
+    def __repr__(self):
+        return f"Mount({self.device!r}, {self.mountpoint!r}, {self.fstype!r})"
+
+
+def parse_mountinfo(text):
+    # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        try:
+            separator = fields.index("-", 6)
+        except ValueError:
+            continue
+        if len(fields) < separator + 3:
+            continue
+        mounts.append(Mount(
+            fields[2], _unescape(fields[3]), _unescape(fields[4]),
+            fields[separator + 1], _unescape(fields[separator + 2]),
+        ))
+    return mounts
+
+
+def read_mounts():
+    return parse_mountinfo(procfs.read("self", "mountinfo"))
+
+
+class MountFilter(object):
+    """Include and exclude patterns for fstypes and mountpoints, None matches everything"""
+
+    def __init__(self, fstype_include=None, fstype_exclude=None,
+                 mountpoint_include=None, mountpoint_exclude=None):
+        self.fstype_include = fstype_include
+        self.fstype_exclude = fstype_exclude
+        self.mountpoint_include = mountpoint_include
+        self.mountpoint_exclude = mountpoint_exclude
+
+    def __call__(self, mount):
+        return (
+            _matches(self.fstype_include, mount.fstype, True)
+            and not _matches(self.fstype_exclude, mount.fstype, False)
+            and _matches(self.mountpoint_include, mount.mountpoint, True)
+            and not _matches(self.mountpoint_exclude, mount.mountpoint, False)
+        )
+
+
+def _matches(pattern, value, default):
+    return default if pattern is None else pattern.search(value) is not None
+
+
+def unique_mounts(mounts):
+    """First mount of each filesystem directory, bind mounts of it are dropped"""
+    seen = set()
+    unique = []
+    for mount in mounts:
+        key = (mount.device_number, mount.root)
+        if key not in seen:
+            seen.add(key)
+            unique.append(mount)
+    return unique
+
+
+class DiskUsage(object):
+    """Space usage following psutil.disk_usage()"""
+
+    def __init__(self, statvfs):
+        self.total = statvfs.f_blocks * statvfs.f_frsize
+        self.free = statvfs.f_bavail * statvfs.f_frsize
+        self.used = (statvfs.f_blocks - statvfs.f_bfree) * statvfs.f_frsize
+        # Space reserved for root counts neither as used nor as available
+        user_total = self.used + self.free
+        self.percent = round(self.used / user_total * 100, 1) if user_total else 0.0
+
+
+class Quarantine(object):
+    def __init__(self, until, timeouts):
+        self.until = until
+        self.timeouts = timeouts
+
+
+class DiskStats(object):
+    """statvfs of many mounts in parallel, skipping mounts that recently hung"""
+
+    def __init__(self, workers=4, timeout=2, min_backoff=30, max_backoff=900):
+        self.workers = workers
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._executor = None
+        # mountpoint -> Quarantine
+        self._quarantine = {}
+        # mountpoint -> future of a statvfs that is still hanging
+        self._hanging = {}
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # Threads stuck in the kernel on a dead mount cannot be interrupted.
+        # Once they hold every worker the pool is left to them and replaced.
+        if self._executor is None or len(self._hanging) >= self.workers:
+            if self._executor is not None:
+                logger.warning("%d statvfs calls hanging, replacing the disk worker pool", len(self._hanging))
+                self._executor.shutdown(wait=False)
+                self._hanging = {}
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="statvfs")
+        return self._executor
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _quarantined(self, mountpoint, now):
+        quarantine = self._quarantine.get(mountpoint)
+        if quarantine is None:
+            return False
+        if now < quarantine.until:
+            return True
+        future = self._hanging.get(mountpoint)
+        if future is not None and not future.done():
+            # Still stuck in the statvfs that timed out last time
+            self._timed_out(mountpoint, now)
+            return True
+        return False
+
+    def _timed_out(self, mountpoint, now):
+        quarantine = self._quarantine.get(mountpoint)
+        timeouts = quarantine.timeouts + 1 if quarantine is not None else 1
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** (timeouts - 1))
+        self._quarantine[mountpoint] = Quarantine(now + backoff, timeouts)
+        logger.warning("statvfs of %s timed out, skipping it for %gs", mountpoint, backoff)
+
+    @staticmethod
+    def _statvfs(started, mountpoint):
+        # The timeout counts from here, not from the submission, so time
+        # spent queued behind other mounts does not count against a mount
+        started[mountpoint] = time.monotonic()
+        return os.statvfs(mountpoint)
+
+    def _submit(self, started, mountpoint):
+        return self._pool().submit(self._statvfs, started, mountpoint)
+
+    def stat(self, mounts):
+        """[(mount, DiskUsage or None if the mount timed out or is quarantined)]
+
+        Every statvfs gets `timeout` seconds from when a worker starts it.
+        Calls still queued when hung ones hold every worker are moved to a
+        fresh pool, so each mount gets its own try.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for mountpoint, future in list(self._hanging.items()):
+                if future.done():
+                    del self._hanging[mountpoint]
+            # mountpoint -> monotonic time its statvfs started
+            started = {}
+            futures = {}
+            for mount in mounts:
+                if not self._quarantined(mount.mountpoint, now):
+                    futures[mount.mountpoint] = self._submit(started, mount.mountpoint)
+            pending = dict(futures)
+            while pending:
+                now = time.monotonic()
+                for mountpoint, future in list(pending.items()):
+                    if future.done():
+                        del pending[mountpoint]
+                    elif mountpoint in started and now - started[mountpoint] >= self.timeout:
+                        del pending[mountpoint]
+                        self._hanging[mountpoint] = future
+                        self._timed_out(mountpoint, now)
+                if not pending:
+                    break
+                if sum(not future.done() for future in self._hanging.values()) >= self.workers:
+                    # Every worker is stuck, the queued calls would never start
+                    for mountpoint, future in list(pending.items()):
+                        if future.cancel():
+                            pending[mountpoint] = futures[mountpoint] = self._submit(started, mountpoint)
+                deadlines = [started[mountpoint] + self.timeout for mountpoint in pending if mountpoint in started]
+                wait(pending.values(), timeout=max(0.0, min(deadlines, default=now + self.timeout) - now),
+                     return_when=FIRST_COMPLETED)
+            results = []
+            for mount in mounts:
+                future = futures.get(mount.mountpoint)
+                usage = None
+                if future is not None and future.done():
+                    self._quarantine.pop(mount.mountpoint, None)
+                    try:
+                        usage = DiskUsage(future.result())
+                    except OSError as e:
+                        # Unmounted since mountinfo was read, or not permitted
+                        logger.debug("statvfs of %s failed: %s", mount.mountpoint, e)
+                        continue
+                results.append((mount, usage))
+            mounted = {mount.mountpoint for mount in mounts}
+            for mountpoint in list(self._quarantine):
+                if mountpoint not in mounted:
+                    del self._quarantine[mountpoint]
+            return results
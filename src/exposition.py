@@ -0,0 +1,293 @@
+# Turns a scheduler.Scrape into response chunks for the negotiated format
+# and encoding. Pre-rendered snapshots are encoded and compressed once and
+# reused until replaced, only the parts collected during the scrape are
+# encoded per request.
+import io
+import math
+import struct
+import zlib
+
+import protobuf
+from metrics import PREFIX_CACHE_SIZE, REGISTRY, escape_label_value, numeric_value
+
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROTOBUF_CONTENT_TYPE = (
+    "application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited"
+)
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+# Empty final deflate block, ends the stream after the sync-flushed segments
+DEFLATE_END = b"\x03\x00"
+
+
+def parse_accept_params(header):
+    """[(media type or coding, {parameter: value}, q)] from an Accept or Accept-Encoding header"""
+    accepted = []
+    for item in header.split(","):
+        value, *params = item.split(";")
+        value = value.strip().lower()
+        if not value:
+            continue
+        q = 1.0
+        parameters = {}
+        for param in params:
+            key, _, number = param.strip().partition("=")
+            key = key.strip().lower()
+            if key == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+            elif key:
+                parameters[key] = number.strip().strip("\"")
+        accepted.append((value, parameters, q))
+    return accepted
+
+
+def parse_accept(header):
+    """{media type or coding: q} from an Accept or Accept-Encoding header"""
+    return {value: q for value, _, q in parse_accept_params(header)}
+
+
+def accepts_gzip(accept_encoding):
+    accepted = parse_accept(accept_encoding or "")
+    return accepted.get("gzip", accepted.get("*", 0)) > 0
+
+
+class TextFormat(object):
+    """Prometheus text format 0.0.4"""
+    name = "text"
+    content_type = TEXT_CONTENT_TYPE
+    trailer = b""
+
+    def encode(self, metrics, timestamp=None):
+        return metrics.render(timestamp).encode("utf-8")
+
+    def snapshot(self, snapshot):
+        return snapshot.encoded
+
+
+class OpenMetricsFormat(TextFormat):
+    """OpenMetrics 1.0 text format
+
+    Sample lines are the same as in the Prometheus text format apart from
+    timestamps being in seconds, only the metadata differs.
+    """
+    name = "openmetrics"
+    content_type = OPENMETRICS_CONTENT_TYPE
+    trailer = b"# EOF\n"
+
+    def __init__(self):
+        # family -> rendered # TYPE and # HELP lines
+        self._headers = {}
+
+    def header(self, family):
+        header = self._headers.get(family)
+        if header is None:
+            name, type = openmetrics_metadata(family)
+            header = self._headers[family] = (
+                f"# TYPE {name} {type}\n"
+                f"# HELP {name} {escape_label_value(family.documentation)}\n"
+            )
+        return header
+
+    def write(self, out, metrics, timestamp=None):
+        end = f" {timestamp!r}\n" if timestamp is not None else "\n"
+        for family, samples in metrics.families.items():
+            out.write(self.header(family))
+            family.write_samples(out, samples, end)
+
+    def encode(self, metrics, timestamp=None):
+        out = io.StringIO()
+        self.write(out, metrics, timestamp)
+        return out.getvalue().encode("utf-8")
+
+    def snapshot(self, snapshot):
+        return cached_encoding(snapshot, self)
+
+
+def openmetrics_metadata(family):
+    """(family name, type) of a family in OpenMetrics
+
+    OpenMetrics names counter and info families without their _total and
+    _info suffix. A family whose name lacks the suffix, or whose shortened
+    name is taken by another family, is exposed as unknown or gauge under
+    its own name so every sample name stays the same in all formats.
+    """
+    name = family.name
+    if family.type == "counter":
+        if name.endswith("_total") and name[:-6] not in REGISTRY.families:
+            return name[:-6], "counter"
+        return name, "unknown"
+    if family.type == "info":
+        if name.endswith("_info") and name[:-5] not in REGISTRY.families:
+            return name[:-5], "info"
+        return name, "gauge"
+    if family.type == "untyped":
+        return name, "unknown"
+    return name, family.type
+
+
+# MetricType enum and the Metric field carrying the value of each type
+PROTOBUF_TYPES = {
+    "counter": (0, 3),
+    "gauge": (1, 2),
+    "info": (1, 2),
+    "untyped": (3, 5),
+    "histogram": (4, 7),
+}
+
+
+def protobuf_histogram(value):
+    """Histogram message of a HistogramValue, +Inf is implied by the sample count"""
+    buckets = b"".join(
+        protobuf.bytes_field(3, protobuf.uint_field(1, count) + protobuf.double_field(2, bound))
+        for bound, count in value.cumulative()
+        if bound != math.inf
+    )
+    return protobuf.uint_field(1, value.count) + protobuf.double_field(2, value.sum) + buckets
+
+
+class ProtobufFormat(object):
+    """Length delimited io.prometheus.client.MetricFamily messages"""
+    name = "protobuf"
+    content_type = PROTOBUF_CONTENT_TYPE
+    trailer = b""
+
+    def __init__(self):
+        # family -> encoded name, help and type fields
+        self._headers = {}
+        # (family, label values) -> encoded LabelPair fields
+        self._labels = {}
+
+    def header(self, family):
+        header = self._headers.get(family)
+        if header is None:
+            header = self._headers[family] = (
+                protobuf.string_field(1, family.name)
+                + protobuf.string_field(2, family.documentation)
+                + protobuf.uint_field(3, PROTOBUF_TYPES[family.type][0])
+            )
+        return header
+
+    def labels(self, family, labelvalues):
+        key = (family, labelvalues)
+        labels = self._labels.get(key)
+        if labels is None:
+            if len(labelvalues) != len(family.labelnames):
+                raise ValueError(
+                    f"{family.name} expects labels {family.labelnames}, got {len(labelvalues)} values"
+                )
+            labels = b"".join(
+                protobuf.bytes_field(1, protobuf.string_field(1, name) + protobuf.string_field(2, str(value)))
+                for name, value in zip(family.labelnames, labelvalues)
+            )
+            if len(self._labels) >= PREFIX_CACHE_SIZE:
+                self._labels = {}
+            self._labels[key] = labels
+        return labels
+
+    def encode(self, metrics, timestamp=None):
+        end = protobuf.uint_field(6, int(timestamp * 1000)) if timestamp is not None else b""
+        out = []
+        for family, samples in metrics.families.items():
+            value_field = PROTOBUF_TYPES[family.type][1]
+            message = [self.header(family)]
+            for labels, value in samples:
+                if family.type == "histogram":
+                    value = protobuf_histogram(value)
+                else:
+                    value = protobuf.double_field(1, 1.0 if family.type == "info" else numeric_value(value))
+                metric = self.labels(family, labels) + protobuf.bytes_field(value_field, value) + end
+                message.append(protobuf.bytes_field(4, metric))
+            out.append(protobuf.delimited(b"".join(message)))
+        return b"".join(out)
+
+    def snapshot(self, snapshot):
+        return cached_encoding(snapshot, self)
+
+
+TEXT = TextFormat()
+OPENMETRICS = OpenMetricsFormat()
+PROTOBUF = ProtobufFormat()
+
+
+def negotiate(accept):
+    """Format for an Accept header, the text format unless another one is preferred"""
+    best, best_q = TEXT, 0.0
+    # On equal q the more efficient format wins
+    for format, candidates in (
+        (PROTOBUF, ("application/vnd.google.protobuf",)),
+        (OPENMETRICS, ("application/openmetrics-text",)),
+        (TEXT, ("text/plain", "text/*", "*/*")),
+    ):
+        for value, params, q in parse_accept_params(accept or ""):
+            if value not in candidates or q <= best_q:
+                continue
+            if format is PROTOBUF and (
+                params.get("proto") != "io.prometheus.client.MetricFamily"
+                or params.get("encoding") != "delimited"
+            ):
+                continue
+            best, best_q = format, q
+    return best
+
+
+def cached_encoding(snapshot, format):
+    encoded = snapshot.encodings.get(format.name)
+    if encoded is None:
+        encoded = snapshot.encodings[format.name] = format.encode(snapshot.metrics, snapshot.timestamp)
+    return encoded
+
+
+def deflate_segment(data, level):
+    """Raw deflate of data ending on a byte boundary without a final block
+
+    Segments compressed on their own can be concatenated into one stream as
+    none of them refers back past its own start.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def cached_deflate(snapshot, format, level):
+    key = ("deflate", format.name, level)
+    deflated = snapshot.encodings.get(key)
+    if deflated is None:
+        deflated = snapshot.encodings[key] = deflate_segment(format.snapshot(snapshot), level)
+    return deflated
+
+
+def gzip_chunks(segments):
+    """One gzip member from (data, deflated segment of data) pairs"""
+    yield GZIP_HEADER
+    crc = 0
+    size = 0
+    for data, deflated in segments:
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        yield deflated
+    yield DEFLATE_END + struct.pack("<II", crc & 0xffffffff, size & 0xffffffff)
+
+
+def chunks(scrape, format=TEXT, gzip=False, level=6):
+    dynamic = b"".join(format.encode(metrics) for metrics in scrape.dynamic()) + format.trailer
+    if not gzip:
+        return [format.snapshot(snapshot) for snapshot in scrape.snapshots] + [dynamic]
+    segments = [
+        (format.snapshot(snapshot), cached_deflate(snapshot, format, level))
+        for snapshot in scrape.snapshots
+    ]
+    segments.append((dynamic, deflate_segment(dynamic, level)))
+    return list(gzip_chunks(segments))
+
+
+async def gzip_stream(chunks, level=6):
+    """gzip of chunks produced asynchronously, compressed as they arrive"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,336 @@
+# Aggregator mode: scrapes the exporters of other hosts concurrently and
+# re-exposes their samples with an instance label. Peer responses are
+# relabelled line by line as they arrive and grouped by metric family, as
+# the text format wants all samples of a family in one block, and each
+# family is passed on once no target can add to it any more.
+import asyncio
+import logging
+import time
+import zlib
+from urllib.parse import urlsplit
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+HEADERS = (
+    ("Accept", "text/plain; version=0.0.4"),
+    ("Accept-Encoding", "gzip"),
+    ("User-Agent", "only_prometheus_exporter"),
+)
+
+# Bytes of the response gathered before a chunk is written
+CHUNK_BYTES = 65536
+# Sample name suffixes that belong to the family named by the preceding TYPE line
+FAMILY_SUFFIXES = (b"_bucket", b"_sum", b"_count", b"_total", b"_created", b"_info", b"_gcount", b"_gsum")
+
+
+class FederationError(Exception):
+    pass
+
+
+class Target(object):
+    """A peer exporter, given as host:port or as a URL"""
+
+    def __init__(self, spec):
+        url = urlsplit(spec if "://" in spec else f"http://{spec}")
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise ValueError(f"invalid federation target {spec!r}")
+        self.ssl = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.ssl else 80)
+        self.path = (url.path or "/metrics") + (f"?{url.query}" if url.query else "")
+        self.instance = url.netloc
+        self.label = b'instance="' + self.instance.replace("\\", "\\\\").replace('"', '\\"').encode("utf-8") + b'"'
+
+    def __repr__(self):
+        return f"Target({self.instance!r})"
+
+
+class TargetResult(object):
+    def __init__(self, up, duration, samples):
+        self.up = up
+        self.duration = duration
+        self.samples = samples
+
+
+class Family(object):
+    """HELP and TYPE lines of a metric family and the relabelled sample lines of every target"""
+
+    def __init__(self, name):
+        self.name = name
+        # b"HELP" or b"TYPE" -> line
+        self.metadata = {}
+        # Relabeler -> its sample lines, each ending with a newline
+        self.samples = {}
+
+    def owns(self, name):
+        """Whether a sample called name belongs to this family"""
+        return name == self.name or (
+            name.startswith(self.name) and name[len(self.name):] in FAMILY_SUFFIXES)
+
+    def add(self, relabeler, line):
+        buffer = self.samples.get(relabeler)
+        if buffer is None:
+            buffer = self.samples[relabeler] = bytearray()
+        buffer += line
+        buffer += b"\n"
+
+    def text(self):
+        lines = [self.metadata[key] + b"\n" for key in (b"HELP", b"TYPE") if key in self.metadata]
+        lines.extend(self.samples.values())
+        return b"".join(lines)
+
+
+class Families(object):
+    """Families of all targets in the order first seen, each written once no running target can add to it
+
+    Targets of the same exporter write their families in the same order, so
+    a family is usually complete once the slowest target moved past it, and
+    only the families between the slowest and the fastest target are held.
+    """
+
+    def __init__(self):
+        self.relabelers = []
+        # name -> Family not written yet, in the order first seen
+        self._pending = {}
+        self._written = set()
+
+    def relabeler(self, label):
+        relabeler = Relabeler(label, self)
+        self.relabelers.append(relabeler)
+        return relabeler
+
+    def family(self, name):
+        family = self._pending.get(name)
+        if family is None:
+            family = Family(name)
+            if name in self._written:
+                # The target wrote the family in two blocks, the late samples
+                # would be a second block of the family and are dropped
+                logger.debug("samples of the written family %s dropped", name.decode("utf-8", "replace"))
+            else:
+                self._pending[name] = family
+        return family
+
+    def discard(self, relabeler):
+        """Drops the samples of a target that failed from the families not written yet"""
+        for family in self._pending.values():
+            family.samples.pop(relabeler, None)
+
+    def _complete(self, name):
+        return all(
+            relabeler.done or (name in relabeler.seen and relabeler.current != name)
+            for relabeler in self.relabelers
+        )
+
+    def ready(self):
+        """Removes and returns the complete families at the head of the order"""
+        ready = []
+        for name in list(self._pending):
+            if not self._complete(name):
+                break
+            ready.append(self._pending.pop(name))
+            self._written.add(name)
+        return ready
+
+
+class Relabeler(object):
+    """Adds a target's instance label to sample lines of the text format
+
+    Lines go to the target's part of the shared families, so the families
+    of all targets can be written with their HELP and TYPE once, followed by
+    all their samples, as the text format requires. An instance label of
+    the peer's own is kept as exported_instance like Prometheus does.
+    """
+
+    def __init__(self, label, families):
+        self.label = label
+        self.families = families
+        # Names of the families the target wrote so far, and the current one
+        self.seen = set()
+        self.current = None
+        self.done = False
+        self.samples = 0
+        self._family = None
+        self._partial = b""
+
+    def _select(self, name):
+        self._family = self.families.family(name)
+        self.seen.add(name)
+        self.current = name
+        return self._family
+
+    def relabel(self, line, brace, space):
+        if brace < 0 or 0 <= space < brace:
+            return line[:space] + b"{" + self.label + b"}" + line[space:]
+        rest = line[brace + 1:]
+        if rest.startswith(b"}"):
+            return line[:brace + 1] + self.label + rest
+        if rest.startswith(b'instance="') or b',instance="' in rest:
+            # In label values quotes are escaped, so this is the label itself
+            if rest.startswith(b'instance="'):
+                rest = b"exported_" + rest
+            rest = rest.replace(b',instance="', b',exported_instance="', 1)
+        return line[:brace + 1] + self.label + b"," + rest
+
+    def line(self, line):
+        if not line or line.isspace():
+            return
+        if line.startswith(b"#"):
+            fields = line.split(None, 3)
+            if len(fields) >= 3 and fields[1] in (b"HELP", b"TYPE"):
+                family = self._family
+                if family is None or family.name != fields[2]:
+                    family = self._select(fields[2])
+                family.metadata.setdefault(fields[1], line)
+            return
+        brace = line.find(b"{")
+        space = line.find(b" ")
+        if brace < 0 and space < 0:
+            return
+        name = line[:space if brace < 0 or 0 <= space < brace else brace]
+        family = self._family
+        if family is None or not family.owns(name):
+            # A sample without metadata of its own
+            family = self._select(name)
+        family.add(self, self.relabel(line, brace, space))
+        self.samples += 1
+
+    def feed(self, data):
+        """Relabels the complete lines of data, the incomplete last line waits for the next call"""
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.line(line)
+
+    def finish(self):
+        partial, self._partial = self._partial, b""
+        self.line(partial)
+
+
+class Federator(object):
+    """Scrapes targets concurrently, at most `concurrency` at a time, over pooled keep-alive connections"""
+
+    def __init__(self, targets, concurrency=32, timeout=10.0, connections=2):
+        self.targets = list(targets)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._pools = {
+            target.instance: http_client.ConnectionPool(self._connector(target), connections)
+            for target in self.targets
+        }
+        self._semaphore = None
+
+    @staticmethod
+    def _connector(target):
+        async def connect():
+            return await http_client.HTTPConnection.open_tcp(target.host, target.port, ssl=target.ssl or None)
+        return connect
+
+    async def _send(self, pool, target):
+        connection, reused = await pool.acquire()
+        try:
+            status, headers = await connection.send("GET", target.path, HEADERS)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection.close()
+            if not reused:
+                raise
+            # The peer closed the idle connection, retry on a new one
+            connection = await pool.connect()
+            try:
+                status, headers = await connection.send("GET", target.path, HEADERS)
+            except BaseException:
+                connection.close()
+                raise
+        except BaseException:
+            connection.close()
+            raise
+        return connection, status, headers
+
+    async def _fetch(self, target, relabeler, changed):
+        pool = self._pools[target.instance]
+        async with pool.slot():
+            connection, status, headers = await self._send(pool, target)
+            try:
+                body = connection.body(headers)
+                if status != 200:
+                    async for _ in body:
+                        pass
+                    raise FederationError(f"{target.instance} returned {status}")
+                gzipped = headers.get("content-encoding", "").lower() == "gzip"
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+                async for chunk in body:
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    relabeler.feed(chunk)
+                    changed.set()
+                if decompressor is not None:
+                    relabeler.feed(decompressor.flush())
+                relabeler.finish()
+            finally:
+                pool.release(connection)
+
+    async def _scrape(self, target, relabeler, results, changed):
+        up = False
+        async with self._semaphore:
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self._fetch(target, relabeler, changed), self.timeout)
+                up = True
+            except asyncio.TimeoutError:
+                logger.warning("Federation target %s timed out after %gs", target.instance, self.timeout)
+            except (OSError, asyncio.IncompleteReadError, FederationError, zlib.error, ValueError) as e:
+                logger.warning("Federation target %s failed: %s", target.instance, e)
+            finally:
+                results[target.instance] = TargetResult(
+                    up, time.monotonic() - start, relabeler.samples if up else 0)
+                if not up:
+                    relabeler.families.discard(relabeler)
+                relabeler.done = True
+                changed.set()
+
+    async def stream(self, results):
+        """Relabelled text of every target, one block per metric family, results filled per instance
+
+        A family is written as soon as every target moved past it or
+        finished, so only the families the targets are apart are held rather
+        than every target's whole response. Samples of a target that fails
+        part way are dropped from the families not written yet, those it
+        contributed to families already written stay.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        families = Families()
+        changed = asyncio.Event()
+        tasks = [
+            asyncio.ensure_future(self._scrape(target, families.relabeler(target.label), results, changed))
+            for target in self.targets
+        ]
+        try:
+            chunk = []
+            size = 0
+            while True:
+                changed.clear()
+                done = all(task.done() for task in tasks)
+                for family in families.ready():
+                    text = family.text()
+                    chunk.append(text)
+                    size += len(text)
+                if size >= CHUNK_BYTES or (done and chunk):
+                    yield b"".join(chunk)
+                    chunk = []
+                    size = 0
+                if done:
+                    break
+                await changed.wait()
+            for task in tasks:
+                # Raises what a scrape failed with unexpectedly
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
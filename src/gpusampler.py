@@ -0,0 +1,160 @@
+# GPU utilization, power, clocks and temperature read several times a
+# second into fixed-size ring buffers, summarised at scrape time as window
+# minimum, maximum, mean and quantiles. Power draw is integrated into an
+# energy counter between readings.
+import logging
+import math
+import threading
+import time
+from array import array
+
+from nvsmi import READING_FIELDS
+from sampler import Sampler
+
+logger = logging.getLogger(__name__)
+
+WIDTH = len(READING_FIELDS)
+POWER = READING_FIELDS.index("power_draw")
+
+
+def quantile(values, q):
+    """q-quantile of sorted values, interpolated between the closest ranks"""
+    position = q * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class FieldStats(object):
+    def __init__(self, minimum, maximum, mean, quantiles):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        # (q, value) for every configured quantile
+        self.quantiles = quantiles
+
+
+class GPUWindowStats(object):
+    def __init__(self, id, uuid, name, samples, energy, fields):
+        self.id = id
+        self.uuid = uuid
+        self.name = name
+        # Readings in the window
+        self.samples = samples
+        # Joules since the GPU was first read
+        self.energy = energy
+        # READING_FIELDS name -> FieldStats, fields without a finite reading left out
+        self.fields = fields
+
+
+class GPUWindow(object):
+    """The last `capacity` readings of a GPU in flat arrays, oldest overwritten first"""
+
+    def __init__(self, uuid, capacity):
+        self.id = None
+        self.uuid = uuid
+        self.name = None
+        self.capacity = capacity
+        self.values = array("d", bytes(8 * capacity * WIDTH))
+        self.times = array("d", bytes(8 * capacity))
+        self.size = 0
+        self.next = 0
+        self.timestamp = float("-inf")
+        self.power = float("nan")
+        self.energy = 0.0
+
+    def add(self, reading):
+        power = reading.values[POWER]
+        if math.isfinite(power) and math.isfinite(self.power):
+            # Trapezoid between the previous reading and this one
+            self.energy += (self.power + power) / 2 * (reading.timestamp - self.timestamp)
+        self.power = power
+        self.timestamp = reading.timestamp
+        self.id = reading.id
+        self.name = reading.name
+        offset = self.next * WIDTH
+        self.values[offset:offset + WIDTH] = array("d", reading.values)
+        self.times[self.next] = reading.timestamp
+        self.next = (self.next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def columns(self, since):
+        """Finite values per field of the readings taken at or after since, and their number"""
+        values = self.values
+        rows = [row * WIDTH for row in range(self.size) if self.times[row] >= since]
+        columns = [
+            [value for value in (values[offset + field] for offset in rows) if math.isfinite(value)]
+            for field in range(WIDTH)
+        ]
+        return columns, len(rows)
+
+
+def field_stats(values, quantiles):
+    values.sort()
+    return FieldStats(
+        values[0], values[-1], math.fsum(values) / len(values),
+        [(q, quantile(values, q)) for q in quantiles],
+    )
+
+
+class GPUSampler(Sampler):
+    """Reads backend.readings() every interval, keeping `window` seconds per GPU"""
+    name = "gpu-sampler"
+
+    def __init__(self, backend, interval=0.0, window=15.0, quantiles=(0.5, 0.9, 0.99)):
+        super().__init__(interval)
+        self.backend = backend
+        self.window = window
+        self.quantiles = sorted(quantiles)
+        # One spare row, so a reading that comes early does not push the
+        # oldest of the window out
+        self.capacity = max(2, math.ceil(window / interval) + 1) if interval > 0 else 0
+        self._gpus = {}
+        self._lock = threading.Lock()
+
+    def available(self):
+        if self.interval <= 0 or not self.backend.available():
+            return False
+        try:
+            readings = self.backend.readings()
+        except Exception:
+            logger.exception("GPU sampler disabled, reading the GPUs failed")
+            return False
+        if readings is None:
+            logger.warning("GPU sampler disabled, it needs the nvml or the nvidia-smi-stream backend")
+            return False
+        return True
+
+    def sample(self):
+        readings = self.backend.readings() or ()
+        with self._lock:
+            for reading in readings:
+                gpu = self._gpus.get(reading.uuid)
+                if gpu is None:
+                    gpu = self._gpus[reading.uuid] = GPUWindow(reading.uuid, self.capacity)
+                elif reading.timestamp <= gpu.timestamp:
+                    # The stream backend has no newer record yet
+                    continue
+                gpu.add(reading)
+            # Forget GPUs that have not been read for a whole window
+            horizon = time.monotonic() - self.window
+            for uuid in [uuid for uuid, gpu in self._gpus.items() if gpu.timestamp < horizon]:
+                del self._gpus[uuid]
+
+    def latest(self):
+        """GPUWindowStats per GPU over the last window, None while not sampling"""
+        if self._thread is None:
+            return None
+        since = time.monotonic() - self.window
+        with self._lock:
+            # Only copy under the lock, sorting happens outside
+            windows = [(gpu.id, gpu.uuid, gpu.name, gpu.energy) + gpu.columns(since) for gpu in self._gpus.values()]
+        stats = []
+        for id, uuid, name, energy, columns, samples in windows:
+            fields = {
+                field: field_stats(values, self.quantiles)
+                for field, values in zip(READING_FIELDS, columns) if values
+            }
+            stats.append(GPUWindowStats(id, uuid, name, samples, energy, fields))
+        stats.sort(key=lambda gpu: int(gpu.id))
+        return stats
@@ -0,0 +1,126 @@
+# Minimal asyncio HTTP/1.1 client for keep-alive connections to the Docker
+# socket and to peer exporters. Bodies can be read whole or streamed chunk
+# by chunk as they arrive.
+import asyncio
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+class HTTPConnection(object):
+    """One HTTP/1.1 keep-alive connection over a Unix or TCP socket"""
+
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+        self.reusable = True
+
+    @classmethod
+    async def open_unix(cls, path, host="localhost"):
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer, host)
+
+    @classmethod
+    async def open_tcp(cls, host, port, ssl=None):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+        return cls(reader, writer, f"{host}:{port}")
+
+    async def send(self, method, target, headers=()):
+        """Send a request without a body and read the response head, (status, headers)"""
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.host}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ProtocolError(f"malformed status line {status_line!r}")
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        if response_headers.get("connection", "").lower() == "close":
+            self.reusable = False
+        return status, response_headers
+
+    async def body(self, headers):
+        """Chunks of the response body, the connection is only reusable once it is read to the end"""
+        reusable, self.reusable = self.reusable, False
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Trailers end with an empty line as well
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                yield await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                chunk = await self.reader.read(min(remaining, 65536))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # Delimited by the end of the connection
+            reusable = False
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+        self.reusable = reusable
+
+    async def request(self, method, target, headers=()):
+        """(status, body) of a request without a body"""
+        status, response_headers = await self.send(method, target, headers)
+        body = b"".join([chunk async for chunk in self.body(response_headers)])
+        return status, body
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class ConnectionPool(object):
+    """Up to `size` connections in use at a time, idle ones kept open for reuse"""
+
+    def __init__(self, connect, size):
+        # Coroutine function opening a new HTTPConnection
+        self.connect = connect
+        self.size = size
+        self._idle = []
+        self._semaphore = None
+
+    async def acquire(self):
+        """(connection, whether it was reused), callers hold a slot of the pool"""
+        if self._idle:
+            return self._idle.pop(), True
+        return await self.connect(), False
+
+    def release(self, connection):
+        if connection.reusable:
+            self._idle.append(connection)
+        else:
+            connection.close()
+
+    def slot(self):
+        # Created lazily to bind to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        return self._semaphore
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
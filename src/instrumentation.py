@@ -0,0 +1,98 @@
+# The exporter's own costs: how long scrapes and collector runs take, how
+# much is rendered, its memory and CPU time and the time the garbage
+# collector stops it for. nvidia-smi processes are counted by the gpu
+# collector as nvidia_smi_subprocesses_total.
+import collections
+import gc
+import threading
+import time
+
+import psutil
+
+from metrics import MetricSet, counter, gauge, histogram
+
+EXPORTER_SCRAPE_DURATION_SECONDS = histogram(
+    "exporter_scrape_duration_seconds", "Time taken to collect and encode /metrics responses", ("format",))
+EXPORTER_COLLECTOR_RUN_SECONDS = histogram(
+    "exporter_collector_run_seconds", "Durations of collector runs, failed ones included", ("collector",))
+EXPORTER_RESPONSE_BYTES_TOTAL = counter(
+    "exporter_response_bytes_total", "Bytes of /metrics responses rendered, after compression",
+    ("format", "encoding"))
+EXPORTER_RESIDENT_MEMORY_BYTES = gauge(
+    "exporter_resident_memory_bytes", "Resident memory of the exporter")
+EXPORTER_CPU_SECONDS_TOTAL = counter(
+    "exporter_cpu_seconds_total", "CPU time used by the exporter, user and system")
+EXPORTER_GC_PAUSE_SECONDS = histogram(
+    "exporter_gc_pause_seconds", "Time the garbage collector stopped the exporter for, per collection",
+    ("generation",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+class Instrumentation(object):
+    """Running totals of the exporter's own metrics"""
+
+    def __init__(self):
+        self._scrapes = {}
+        self._collector_runs = {}
+        self._response_bytes = {}
+        self._gc_pauses = {}
+        # (generation, seconds) of collections not yet added to _gc_pauses.
+        # GC callbacks run on whichever thread allocated, possibly one
+        # holding the lock, so they only append here; deque appends and
+        # pops are atomic, no pause is lost while metrics() drains it.
+        self._gc_pending = collections.deque()
+        self._gc_started = None
+        self._process = psutil.Process()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._gc_callback not in gc.callbacks:
+            gc.callbacks.append(self._gc_callback)
+
+    def stop(self):
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self._gc_started = time.perf_counter()
+        elif self._gc_started is not None:
+            self._gc_pending.append((info["generation"], time.perf_counter() - self._gc_started))
+            self._gc_started = None
+
+    def _observe(self, values, family, labels, amount):
+        with self._lock:
+            value = values.get(labels)
+            if value is None:
+                value = values[labels] = family.value()
+            value.observe(amount)
+
+    def observe_scrape(self, format, encoding, seconds, size):
+        self._observe(self._scrapes, EXPORTER_SCRAPE_DURATION_SECONDS, (format,), seconds)
+        with self._lock:
+            key = (format, encoding)
+            self._response_bytes[key] = self._response_bytes.get(key, 0) + size
+
+    def observe_collector(self, name, seconds):
+        self._observe(self._collector_runs, EXPORTER_COLLECTOR_RUN_SECONDS, (name,), seconds)
+
+    def metrics(self):
+        metrics = MetricSet()
+        pending = self._gc_pending
+        while pending:
+            generation, seconds = pending.popleft()
+            self._observe(self._gc_pauses, EXPORTER_GC_PAUSE_SECONDS, (generation,), seconds)
+        with self._lock:
+            for family, values in (
+                (EXPORTER_SCRAPE_DURATION_SECONDS, self._scrapes),
+                (EXPORTER_COLLECTOR_RUN_SECONDS, self._collector_runs),
+                (EXPORTER_GC_PAUSE_SECONDS, self._gc_pauses),
+            ):
+                for labels, value in values.items():
+                    metrics.add(family, value.copy(), labels)
+            for labels, size in self._response_bytes.items():
+                metrics.add(EXPORTER_RESPONSE_BYTES_TOTAL, size, labels)
+        with self._process.oneshot():
+            metrics.add(EXPORTER_RESIDENT_MEMORY_BYTES, self._process.memory_info().rss)
+            times = self._process.cpu_times()
+            metrics.add(EXPORTER_CPU_SECONDS_TOTAL, times.user + times.system)
+        return metrics
@@ -1,411 +1,992 @@
+import asyncio
+import logging
+import math
 import os
 import platform
 import re
+import time
+import tracemalloc
+from contextlib import asynccontextmanager
 from datetime import datetime
 import psutil
-from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
 from uvicorn import run
 from cpuinfo import cpu
+import config
+import containers
+import disks
+import diskio
+import exposition
+import federation
+from cache import FingerprintCache
+from instrumentation import Instrumentation
+from cpustat import CPUSampler
+from diskio import DiskIOSampler
+from gpusampler import GPUSampler
+from netdev import NetSampler
+import nvml
 import nvsmi
-try:
-    from screenutils import list_screens
-except ImportError:
-    print("screenutils not installed")
-    def list_screens():
-        return []
-
-
-def get_gpu_prometheus_metrics():
-    metrics = []
-    if nvsmi.is_nvidia_smi_on_path():
-        processes = nvsmi.get_gpu_processes()
-        processes_by_gpu = {}
+import netdev
+import procfs
+import processes
+import profiling
+import remote_write
+import screens
+from metrics import MetricSet, counter, gauge, info, numeric_value
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def create_gpu_backend(name):
+    if name == nvml.NVMLBackend.name:
+        return nvml.NVMLBackend(fallback=nvsmi.NvidiaSmiBackend())
+    if name == nvsmi.NvidiaSmiStreamBackend.name:
+        return nvsmi.NvidiaSmiStreamBackend(
+            interval_ms=config.GPU_STREAM_INTERVAL_MS,
+            process_interval=config.COLLECTOR_INTERVALS["gpu"] or 5,
+        )
+    return nvsmi.create_backend(name)
+
+
+gpu_backend = create_gpu_backend(config.GPU_BACKEND)
+gpu_sampler = GPUSampler(
+    gpu_backend,
+    interval=config.GPU_SAMPLE_INTERVAL,
+    window=config.GPU_SAMPLE_WINDOW,
+    quantiles=config.GPU_SAMPLE_QUANTILES,
+)
+cpu_sampler = CPUSampler(interval=config.CPU_SAMPLE_INTERVAL)
+diskio_sampler = DiskIOSampler(interval=config.DISKIO_SAMPLE_INTERVAL)
+net_sampler = NetSampler(interval=config.NETWORK_SAMPLE_INTERVAL)
+process_infos = processes.ProcessInfoCache(cmdline_length=config.PROCESS_CMDLINE_LENGTH)
+gpu_process_infos = processes.ProcessInfoCache(cmdline_length=config.PROCESS_CMDLINE_LENGTH)
+process_tracker = processes.ProcessTracker(process_infos, top_n=config.PROCESS_TOP_N, io=config.PROCESS_IO)
+docker_client = containers.DockerClient(
+    config.DOCKER_SOCKET,
+    connections=config.DOCKER_CONNECTIONS,
+    timeout=config.COLLECTOR_TIMEOUTS["docker"],
+)
+
+
+async def get_gpu_prometheus_metrics_async():
+    if not gpu_backend.available():
+        return MetricSet()
+    snapshot = await gpu_backend.snapshot_async()
+    # Owners and cgroups of the GPU processes are read from /proc, off the event loop
+    return await asyncio.to_thread(gpu_prometheus_metrics, snapshot)
+
+
+GPU_LABELS = ("id", "uuid", "name")
+
+NVIDIA_SMI_SUBPROCESSES = gauge(
+    "nvidia_smi_subprocesses", "nvidia-smi processes spawned by the last GPU collection")
+NVIDIA_SMI_SUBPROCESSES_TOTAL = counter(
+    "nvidia_smi_subprocesses_total", "nvidia-smi processes spawned since startup")
+NVIDIA_GPU_INFO = info(
+    "nvidia_gpu_info", "GPU driver and memory size", GPU_LABELS + ("driver", "mem_total"))
+NVIDIA_GPU_RUNNING_PROCESSES = gauge(
+    "nvidia_gpu_running_processes", "Compute processes running on the GPU", GPU_LABELS)
+NVIDIA_GPU_PSTATE = gauge(
+    "nvidia_gpu_pstate", "Performance state, 0 is maximum performance", GPU_LABELS)
+NVIDIA_GPU_PROCESS_INFO = info(
+    "nvidia_gpu_process_info", "Compute process running on the GPU, its owner, command line and container",
+    GPU_LABELS + ("pid", "process_name", "used_memory", "user", "cmdline", "container", "cgroup"))
+NVIDIA_GPU_USER_MEMORY_USED = gauge(
+    "nvidia_gpu_user_memory_used", "GPU memory used by the processes of a user on all GPUs in MiB", ("user",))
+NVIDIA_GPU_USER_PROCESSES = gauge(
+    "nvidia_gpu_user_processes", "Compute processes of a user on all GPUs", ("user",))
+NVIDIA_GPU_CONTAINER_MEMORY_USED = gauge(
+    "nvidia_gpu_container_memory_used", "GPU memory used by the processes of a container on all GPUs in MiB",
+    ("container",))
+
+# GPU attribute -> family, one sample per GPU
+NVIDIA_GPU_GAUGES = [
+    (attribute, gauge(name, documentation, GPU_LABELS))
+    for attribute, name, documentation in (
+        ("gpu_util", "nvidia_gpu_utilization", "GPU utilization in percent"),
+        ("mem_used", "nvidia_gpu_memory_used", "Used GPU memory in MiB"),
+        ("mem_free", "nvidia_gpu_memory_free", "Free GPU memory in MiB"),
+        ("mem_total", "nvidia_gpu_memory_total", "Total GPU memory in MiB"),
+        ("mem_util", "nvidia_gpu_memory_utilization", "Used GPU memory in percent"),
+        ("temperature", "nvidia_gpu_temperature", "GPU temperature in degrees Celsius"),
+        ("temperature_memory", "nvidia_gpu_memory_temperature", "GPU memory temperature in degrees Celsius"),
+        ("fan_speed", "nvidia_gpu_fan_speed", "Fan speed in percent"),
+        ("power_draw", "nvidia_gpu_power_draw", "Power draw in watts"),
+        ("power_limit", "nvidia_gpu_power_limit", "Power limit in watts"),
+        ("clocks_throttle_reasons_gpu_idle",
+         "nvidia_gpu_clocks_throttle_reasons_gpu_idle", "Clocks are lowered because the GPU is idle"),
+        ("clocks_throttle_reasons_applications_clocks_setting",
+         "nvidia_gpu_clocks_throttle_reasons_applications_clocks_setting", "Clocks are limited by the applications clocks setting"),
+        ("clocks_throttle_reasons_sw_power_cap",
+         "nvidia_gpu_clocks_throttle_reasons_sw_power_cap", "Clocks are lowered by the software power cap"),
+        ("clocks_throttle_reasons_hw_thermal_slowdown",
+         "nvidia_gpu_clocks_throttle_reasons_hw_thermal_slowdown", "Clocks are lowered by hardware thermal slowdown"),
+        ("clocks_throttle_reasons_hw_power_brake_slowdown",
+         "nvidia_gpu_clocks_throttle_reasons_hw_power_brake_slowdown", "Clocks are lowered by the external power brake"),
+        ("clocks_throttle_reasons_sw_thermal_slowdown",
+         "nvidia_gpu_clocks_throttle_reasons_sw_thermal_slowdown", "Clocks are lowered by software thermal slowdown"),
+        ("clocks_current_graphics", "nvidia_gpu_clocks_current_graphics", "Graphics clock in MHz"),
+        ("clocks_current_sm", "nvidia_gpu_clocks_current_sm", "SM clock in MHz"),
+        ("clocks_current_memory", "nvidia_gpu_clocks_current_memory", "Memory clock in MHz"),
+    )
+]
+
+# Sampled field -> (min, max, mean, quantile) families over the GPU sampler window
+NVIDIA_GPU_WINDOW_GAUGES = [
+    (attribute, (
+        gauge(f"{family.name}_window_min", f"{family.documentation}, lowest over the sampler window", GPU_LABELS),
+        gauge(f"{family.name}_window_max", f"{family.documentation}, highest over the sampler window", GPU_LABELS),
+        gauge(f"{family.name}_window_mean", f"{family.documentation}, mean over the sampler window", GPU_LABELS),
+        gauge(f"{family.name}_window_quantile", f"{family.documentation}, quantiles over the sampler window",
+              GPU_LABELS + ("quantile",)),
+    ))
+    for attribute, family in NVIDIA_GPU_GAUGES if attribute in nvsmi.READING_FIELDS
+]
+NVIDIA_GPU_WINDOW_SAMPLES = gauge(
+    "nvidia_gpu_window_samples", "GPU sampler readings in the window", GPU_LABELS)
+NVIDIA_GPU_ENERGY_JOULES_TOTAL = counter(
+    "nvidia_gpu_energy_joules_total", "Energy used since the GPU sampler first read the GPU, from its power draw",
+    GPU_LABELS)
+
+
+def _pstate_number(pstate):
+    # "P0" -> 0, anything unknown -> NaN
+    return int(pstate[1:]) if pstate[:1] == "P" and pstate[1:].isdigit() else float("nan")
+
+
+def _gpu_process_info(pid):
+    try:
+        return gpu_process_infos.lookup(int(pid))
+    except ValueError:
+        return None
+
+
+def gpu_prometheus_metrics(snapshot):
+    metrics = MetricSet()
+    metrics.add(NVIDIA_SMI_SUBPROCESSES, snapshot.subprocesses)
+    metrics.add(NVIDIA_SMI_SUBPROCESSES_TOTAL, nvsmi.subprocesses_spawned())
+    processes_by_gpu = snapshot.processes_by_gpu()
+    # Resolved once per (pid, starttime), repeated collections only read /proc/<pid>/stat
+    infos = {process.pid: _gpu_process_info(process.pid) for process in snapshot.processes}
+    gpu_process_infos.retain({(info.pid, info.starttime) for info in infos.values() if info is not None})
+    user_memory = {}
+    user_processes = {}
+    container_memory = {}
+    for gpu in snapshot.gpus:
+        labels = (gpu.id, gpu.uuid.replace('GPU-', ''), gpu.name)
+        processes = processes_by_gpu.get(gpu.uuid, [])
+        metrics.add(NVIDIA_GPU_INFO, 1, labels + (gpu.driver, gpu.mem_total))
+        for attribute, family in NVIDIA_GPU_GAUGES:
+            metrics.add(family, getattr(gpu, attribute), labels)
+        metrics.add(NVIDIA_GPU_RUNNING_PROCESSES, len(processes), labels)
+        metrics.add(NVIDIA_GPU_PSTATE, _pstate_number(gpu.pstate), labels)
         for process in processes:
-            processes_by_gpu.setdefault(process.gpu_uuid, []).append(process)
-        for gpu in nvsmi.get_gpus():
-            labels = (
-                f"id=\"{gpu.id}\", "
-                f"uuid=\"{gpu.uuid.replace('GPU-', '')}\", "
-                f"name=\"{gpu.name}\" "
-            )
-            metrics.append(
-                "nvidia_gpu_info{" + labels +
-                f"driver=\"{gpu.driver}\", "
-                f"mem_total=\"{gpu.mem_total}\""
-                "} 1"
-            )
-            metrics.append(
-                "nvidia_gpu_utilization{" + labels + "} "
-                f"{gpu.gpu_util}"
-            )
-            metrics.append(
-                "nvidia_gpu_memory_used{" + labels + "}"
-                f" {gpu.mem_used}"
-            )
-            metrics.append(
-                "nvidia_gpu_memory_free{" + labels + "} "
-                f"{gpu.mem_free}"
-            )
-            metrics.append(
-                "nvidia_gpu_memory_total{" + labels + "} "
-                f"{gpu.mem_total}"
-            )
-            metrics.append(
-                "nvidia_gpu_memory_utilization{" + labels + "} "
-                f"{gpu.mem_util}"
-            )
-            metrics.append(
-                "nvidia_gpu_temperature{" + labels + "} "
-                f"{gpu.temperature}"
-            )
-            metrics.append(
-                "nvidia_gpu_memory_temperature{" + labels + "} "
-                f"{gpu.temperature_memory}"
-            )
-            metrics.append(
-                "nvidia_gpu_fan_speed{" + labels + "} "
-                f"{gpu.fan_speed}"
+            info = infos.get(process.pid)
+            user = info.user if info is not None else ""
+            container = info.container if info is not None else ""
+            metrics.add(
+                NVIDIA_GPU_PROCESS_INFO, 1,
+                labels + (
+                    process.pid, process.process_name, process.used_memory, user,
+                    info.cmdline if info is not None else "",
+                    container,
+                    info.cgroup if info is not None else "",
+                ),
             )
-            metrics.append(
-                "nvidia_gpu_power_draw{" + labels + "} "
-                f"{gpu.power_draw}"
-            )
-            metrics.append(
-                "nvidia_gpu_power_limit{" + labels + "}"
-                f" {gpu.power_limit}"
-            )
-            metrics.append(
-                "nvidia_gpu_running_processes{" + labels + "}"
-                f" {len(processes_by_gpu.get(gpu.uuid, []))}"
-            )
-            metrics.append(
-                "nvidia_gpu_pstate{" + labels + "}"
-                f" {gpu.pstate}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_gpu_idle{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_gpu_idle}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_applications_clocks_setting{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_applications_clocks_setting}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_sw_power_cap{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_sw_power_cap}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_hw_thermal_slowdown{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_hw_thermal_slowdown}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_hw_power_brake_slowdown{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_hw_power_brake_slowdown}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_throttle_reasons_sw_thermal_slowdown{" + labels + "}"
-                f" {gpu.clocks_throttle_reasons_sw_thermal_slowdown}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_current_graphics{" + labels + "}"
-                f" {gpu.clocks_current_graphics}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_current_sm{" + labels + "}"
-                f" {gpu.clocks_current_sm}"
-            )
-            metrics.append(
-                "nvidia_gpu_clocks_current_memory{" + labels + "}"
-                f" {gpu.clocks_current_memory}"
-            )
-            for process in processes_by_gpu.get(gpu.uuid, []):
-                metrics.append(
-                    "nvidia_gpu_process_info{" + labels +
-                    f"pid=\"{process.pid}\", "
-                    f"process_name=\"{process.process_name}\", "
-                    f"used_memory=\"{process.used_memory}\""
-                    "} 1"
-                )
+            used_memory = numeric_value(process.used_memory)
+            if math.isnan(used_memory):
+                used_memory = 0.0
+            user_memory[user] = user_memory.get(user, 0.0) + used_memory
+            user_processes[user] = user_processes.get(user, 0) + 1
+            if container:
+                container_memory[container] = container_memory.get(container, 0.0) + used_memory
+    for user, used_memory in user_memory.items():
+        metrics.add(NVIDIA_GPU_USER_MEMORY_USED, used_memory, (user,))
+    for user, count in user_processes.items():
+        metrics.add(NVIDIA_GPU_USER_PROCESSES, count, (user,))
+    for container, used_memory in container_memory.items():
+        metrics.add(NVIDIA_GPU_CONTAINER_MEMORY_USED, used_memory, (container,))
+    for gpu in gpu_sampler.latest() or ():
+        labels = (gpu.id, gpu.uuid.replace('GPU-', ''), gpu.name)
+        metrics.add(NVIDIA_GPU_WINDOW_SAMPLES, gpu.samples, labels)
+        metrics.add(NVIDIA_GPU_ENERGY_JOULES_TOTAL, gpu.energy, labels)
+        for attribute, (minimum, maximum, mean, quantiles) in NVIDIA_GPU_WINDOW_GAUGES:
+            stats = gpu.fields.get(attribute)
+            if stats is None:
+                continue
+            metrics.add(minimum, stats.minimum, labels)
+            metrics.add(maximum, stats.maximum, labels)
+            metrics.add(mean, stats.mean, labels)
+            for q, value in stats.quantiles:
+                metrics.add(quantiles, value, labels + (f"{q:g}",))
 
     return metrics
 
 
+DISK_LABELS = ("device", "mountpoint", "fstype")
+DISK_USAGE = gauge("disk_usage", "Used space in percent", DISK_LABELS)
+DISK_TOTAL = gauge("disk_total", "Total space in bytes", DISK_LABELS)
+DISK_USED = gauge("disk_used", "Used space in bytes", DISK_LABELS)
+DISK_FREE = gauge("disk_free", "Free space in bytes", DISK_LABELS)
+DISK_STAT_TIMEOUT = gauge(
+    "disk_stat_timeout", "Whether the mount timed out and is skipped for now", DISK_LABELS)
+
+mount_filter = disks.MountFilter(
+    fstype_include=config.DISK_FSTYPE_INCLUDE,
+    fstype_exclude=config.DISK_FSTYPE_EXCLUDE,
+    mountpoint_include=config.DISK_MOUNTPOINT_INCLUDE,
+    mountpoint_exclude=config.DISK_MOUNTPOINT_EXCLUDE,
+)
+disk_stats = disks.DiskStats(
+    workers=config.DISK_STAT_WORKERS,
+    timeout=config.DISK_STAT_TIMEOUT,
+    min_backoff=config.DISK_QUARANTINE_MIN,
+    max_backoff=config.DISK_QUARANTINE_MAX,
+)
+
+
+def filtered_mounts():
+    return disks.unique_mounts(mount for mount in disks.read_mounts() if mount_filter(mount))
+
+
 def get_disk_prometheus_metrics():
-    metrics = []
-
-    # Get disks/partitions connected to the system
-    partitions = [partition for partition in psutil.disk_partitions()]
-    # Filter junk
-    partitions = [partition for partition in partitions if 'snap' not in partition.mountpoint]
-    partitions = [partition for partition in partitions if 'docker' not in partition.mountpoint]
-    partitions = [partition for partition in partitions if 'loop' not in partition.mountpoint]
-    partitions = [partition for partition in partitions if 'boot' not in partition.mountpoint]
-    partitions = [partition for partition in partitions if 'var/lib' not in partition.mountpoint]
-
-    for partition in partitions:
+    metrics = MetricSet()
+
+    for mount, usage in disk_stats.stat(filtered_mounts()):
+        labels = mount.labels
+        metrics.add(DISK_STAT_TIMEOUT, usage is None, labels)
+        if usage is None:
+            continue
+        metrics.add(DISK_USAGE, usage.percent, labels)
+        metrics.add(DISK_TOTAL, usage.total, labels)
+        metrics.add(DISK_USED, usage.used, labels)
+        metrics.add(DISK_FREE, usage.free, labels)
+
+    return metrics
+
+
+DISKIO_LABELS = ("device", "name", "mountpoint")
+DISK_READ_BYTES = counter("disk_read_bytes_total", "Bytes read from the device", DISKIO_LABELS)
+DISK_WRITTEN_BYTES = counter("disk_written_bytes_total", "Bytes written to the device", DISKIO_LABELS)
+DISK_READS = counter("disk_reads_completed_total", "Reads completed", DISKIO_LABELS)
+DISK_WRITES = counter("disk_writes_completed_total", "Writes completed", DISKIO_LABELS)
+DISK_READ_TIME = counter("disk_read_time_seconds_total", "Seconds spent on reads", DISKIO_LABELS)
+DISK_WRITE_TIME = counter("disk_write_time_seconds_total", "Seconds spent on writes", DISKIO_LABELS)
+DISK_IO_TIME = counter("disk_io_time_seconds_total", "Seconds the device was busy", DISKIO_LABELS)
+DISK_IO_TIME_WEIGHTED = counter(
+    "disk_io_time_weighted_seconds_total", "Seconds requests spent queued or in flight", DISKIO_LABELS)
+DISK_IO_IN_FLIGHT = gauge("disk_io_in_flight", "Requests currently in flight", DISKIO_LABELS)
+DISK_READ_BYTES_RATE = gauge(
+    "disk_read_bytes_per_second", "Bytes read per second over the sampler window", DISKIO_LABELS)
+DISK_WRITE_BYTES_RATE = gauge(
+    "disk_write_bytes_per_second", "Bytes written per second over the sampler window", DISKIO_LABELS)
+DISK_READS_RATE = gauge("disk_reads_per_second", "Reads per second over the sampler window", DISKIO_LABELS)
+DISK_WRITES_RATE = gauge("disk_writes_per_second", "Writes per second over the sampler window", DISKIO_LABELS)
+DISK_READ_LATENCY = gauge(
+    "disk_read_latency_seconds", "Average read time over the sampler window", DISKIO_LABELS)
+DISK_WRITE_LATENCY = gauge(
+    "disk_write_latency_seconds", "Average write time over the sampler window", DISKIO_LABELS)
+DISK_IO_UTILIZATION = gauge(
+    "disk_io_utilization", "Percent of the sampler window the device was busy", DISKIO_LABELS)
+
+
+def _diskio_selected(name):
+    return (
+        (config.DISKIO_DEVICE_INCLUDE is None or config.DISKIO_DEVICE_INCLUDE.search(name))
+        and not (config.DISKIO_DEVICE_EXCLUDE is not None and config.DISKIO_DEVICE_EXCLUDE.search(name))
+    )
+
+
+def get_diskio_prometheus_metrics():
+    metrics = MetricSet()
+
+    sample = diskio_sampler.latest()
+    stats = sample.stats if sample is not None else diskio.read_diskstats()
+    rates = sample.rates if sample is not None and sample.rates is not None else {}
+    # Partitions and device-mapper devices are labelled with the mountpoint
+    # the disk collector reports them under
+    mounts = {}
+    for mount in filtered_mounts():
+        mounts.setdefault(mount.device_number, mount)
+
+    for stat in stats:
+        if not _diskio_selected(stat.name):
+            continue
+        mount = mounts.get(stat.device_number)
         labels = (
-            f"device=\"{partition.device}\", "
-            f"mountpoint=\"{partition.mountpoint}\", "
-            f"fstype=\"{partition.fstype}\""
-        )
-        usage = psutil.disk_usage(partition.mountpoint)
-        metrics.append(
-            "disk_usage{" + labels + "} "
-            f"{usage.percent}"
-        )
-        metrics.append(
-            "disk_total{" + labels + "} "
-            f"{usage.total}"
-        )
-        metrics.append(
-            "disk_used{" + labels + "} "
-            f"{usage.used}"
-        )
-        metrics.append(
-            "disk_free{" + labels + "} "
-            f"{usage.free}"
+            mount.device if mount is not None else diskio.device_path(stat.name),
+            stat.name,
+            mount.mountpoint if mount is not None else "",
         )
+        metrics.add(DISK_READ_BYTES, stat.sectors_read * diskio.SECTOR_SIZE, labels)
+        metrics.add(DISK_WRITTEN_BYTES, stat.sectors_written * diskio.SECTOR_SIZE, labels)
+        metrics.add(DISK_READS, stat.reads, labels)
+        metrics.add(DISK_WRITES, stat.writes, labels)
+        metrics.add(DISK_READ_TIME, stat.read_ms / 1000, labels)
+        metrics.add(DISK_WRITE_TIME, stat.write_ms / 1000, labels)
+        metrics.add(DISK_IO_TIME, stat.io_ms / 1000, labels)
+        metrics.add(DISK_IO_TIME_WEIGHTED, stat.weighted_io_ms / 1000, labels)
+        metrics.add(DISK_IO_IN_FLIGHT, stat.in_flight, labels)
+        rate = rates.get(stat.name)
+        if rate is not None:
+            metrics.add(DISK_READ_BYTES_RATE, rate.read_bytes, labels)
+            metrics.add(DISK_WRITE_BYTES_RATE, rate.write_bytes, labels)
+            metrics.add(DISK_READS_RATE, rate.reads, labels)
+            metrics.add(DISK_WRITES_RATE, rate.writes, labels)
+            metrics.add(DISK_READ_LATENCY, rate.read_latency, labels)
+            metrics.add(DISK_WRITE_LATENCY, rate.write_latency, labels)
+            metrics.add(DISK_IO_UTILIZATION, rate.utilization, labels)
 
     return metrics
 
 
-def get_cpu_prometheus_metrics():
-    metrics = []
+CPU_INFO = info(
+    "cpu_info", "Number of processors, cores and threads", ("processors", "cores", "threads"))
+CPU_PROCESSOR_INFO = info(
+    "cpu_processor_info", "Model and size of each physical processor",
+    ("vendor", "model", "processor", "cores", "threads"))
+CPU_THREAD_INFO = info(
+    "cpu_thread_info", "Topology of each hardware thread",
+    ("vendor", "model", "physical_id", "core_id", "processor_id", "apic_id"))
+CPU_FREQUENCY = gauge("cpu_frequency", "Current CPU frequency in Hz", ("min", "max"))
+CPU_UTILIZATION = gauge("cpu_utilization", "Busy time per thread in percent", ("thread",))
+CPU_TIMES = counter("cpu_times", "Seconds each thread spent in each mode", ("thread", "mode"))
+CPU_TEMPERATURE = gauge(
+    "cpu_temperature", "Core temperature in degrees Celsius", ("label", "high", "critical"))
+CPU_TEMPERATURE_HIGH = gauge(
+    "cpu_temperature_high", "High core temperature threshold in degrees Celsius", ("label",))
+CPU_TEMPERATURE_CRITICAL = gauge(
+    "cpu_temperature_critical", "Critical core temperature threshold in degrees Celsius", ("label",))
+FAN_SPEED = gauge("fan_speed", "Fan speed in RPM", ("category", "label"))
+PROCESS_COUNT = gauge("process_count", "Number of processes")
+
+
+def _cpu_info_fingerprint():
+    try:
+        return procfs.read_sys("devices", "system", "cpu", "online")
+    except OSError:
+        return os.cpu_count()
+
+
+def cpu_info_prometheus_metrics():
+    metrics = MetricSet()
+
+    # Only runs when CPUs went on/offline, the parsed /proc/cpuinfo is stale
+    cpu.invalidate()
 
     processors = set([i['physical id'] for i in cpu.info])
     cores = len(set([i['core id'] for i in cpu.info]))
     threads = len(set([i['processor'] for i in cpu.info]))
 
-    metrics.append(
-        "cpu_info{"
-        f"processors=\"{len(processors)}\", "
-        f"cores=\"{cores}\", "
-        f"threads=\"{threads}\" "
-        "} 1"
-    )
+    metrics.add(CPU_INFO, 1, (len(processors), cores, threads))
 
     for processor in processors:
         processor_threads_list = [i for i in cpu.info if i['physical id'] == processor]
         processor_cores = len(set([i['core id'] for i in processor_threads_list]))
         processor_threads = len(set([i['processor'] for i in processor_threads_list]))
 
-        metrics.append(
-            "cpu_processor_info{"
-            f"vendor=\"{processor_threads_list[0]['vendor_id']}\", "
-            f"model=\"{processor_threads_list[0]['model name']}\", "
-            f"processor=\"{processor}\", "
-            f"cores=\"{processor_cores}\", "
-            f"threads=\"{processor_threads}\" "
-            "} 1"
-        )
+        metrics.add(CPU_PROCESSOR_INFO, 1, (
+            processor_threads_list[0]['vendor_id'],
+            processor_threads_list[0]['model name'],
+            processor,
+            processor_cores,
+            processor_threads,
+        ))
 
     for core in cpu.info:
-        metrics.append(
-            "cpu_thread_info{"
-            f"vendor=\"{core['vendor_id']}\", "
-            f"model=\"{core['model name']}\", "
-            f"physical_id=\"{core['physical id']}\", "
-            f"core_id=\"{core['core id']}\", "
-            f"processor_id=\"{core['processor']}\", "
-            f"apic_id=\"{core['apicid']}\" "
-            "} 1"
-        )
+        metrics.add(CPU_THREAD_INFO, 1, (
+            core['vendor_id'],
+            core['model name'],
+            core['physical id'],
+            core['core id'],
+            core['processor'],
+            core['apicid'],
+        ))
+
+    return metrics
+
 
-    metrics.append(
-        "cpu_frequency{"
-        f"min=\"{psutil.cpu_freq().min*1000*1000}\", "
-        f"max=\"{psutil.cpu_freq().max*1000*1000}\""
-        "} "
-        f"{psutil.cpu_freq().current*1000*1000}"
+# The info families only change when CPUs go on/offline
+cpu_info_cache = FingerprintCache(_cpu_info_fingerprint, cpu_info_prometheus_metrics)
+
+
+def get_cpu_prometheus_metrics():
+    metrics = MetricSet()
+    metrics.extend(cpu_info_cache.get())
+
+    frequency = psutil.cpu_freq()
+    metrics.add(
+        CPU_FREQUENCY,
+        frequency.current*1000*1000,
+        (frequency.min*1000*1000, frequency.max*1000*1000),
     )
 
-    cpu_percents = psutil.cpu_percent(percpu=True)
-    cpu_times = psutil.cpu_times(percpu=True)
-    for idx, thread in enumerate(cpu_percents):
-        metrics.append(
-            "cpu_utilization{"
-            f"thread=\"{idx}\""
-            "} "
-            f"{thread}"
-        )
-    for idx, thread in enumerate(cpu_times):
-        for key, value in thread._asdict().items():
-            metrics.append(
-                "cpu_times{"
-                f"thread=\"{idx}\", "
-                f"mode=\"{key}\""
-                "} "
-                f"{value}"
-            )
+    sample = cpu_sampler.latest()
+    if sample is not None:
+        # Utilization over the sampler's last window and times from the same read
+        if sample.utilization is not None:
+            for thread, percent in zip(sample.cpus, sample.utilization):
+                metrics.add(CPU_UTILIZATION, percent, (thread,))
+        for thread, mode, seconds in sample.times():
+            metrics.add(CPU_TIMES, seconds, (thread, mode))
+    else:
+        cpu_percents = psutil.cpu_percent(percpu=True)
+        cpu_times = psutil.cpu_times(percpu=True)
+        for idx, thread in enumerate(cpu_percents):
+            metrics.add(CPU_UTILIZATION, thread, (idx,))
+        for idx, thread in enumerate(cpu_times):
+            for key, value in thread._asdict().items():
+                metrics.add(CPU_TIMES, value, (idx, key))
     temps = psutil.sensors_temperatures()
     if 'coretemp' in temps:
         for sensor in temps['coretemp']:
-            metrics.append(
-                "cpu_temperature{"
-                f"label=\"{sensor.label}\", "
-                f"high=\"{sensor.high}\", "
-                f"critical=\"{sensor.critical}\" "
-                "} "
-                f"{sensor.current}"
-            )
-            metrics.append(
-                "cpu_temperature_high{"
-                f"label=\"{sensor.label}\""
-                "} "
-                f"{sensor.high}"
-            )
-            metrics.append(
-                "cpu_temperature_critical{"
-                f"label=\"{sensor.label}\""
-                "} "
-                f"{sensor.critical}"
-            )
+            metrics.add(CPU_TEMPERATURE, sensor.current, (sensor.label, sensor.high, sensor.critical))
+            metrics.add(CPU_TEMPERATURE_HIGH, sensor.high, (sensor.label,))
+            metrics.add(CPU_TEMPERATURE_CRITICAL, sensor.critical, (sensor.label,))
     fans = psutil.sensors_fans()
     for sensor_cat in fans.items():
         for sensor in sensor_cat[1]:
-            metrics.append(
-                "fan_speed{"
-                f"category=\"{sensor_cat[0]}\", "
-                f"label=\"{sensor.label}\""
-                "} "
-                f"{sensor.current}"
-            )
-    metrics.append(
-        "process_count "
-        f"{len(psutil.pids())}"
-    )
+            metrics.add(FAN_SPEED, sensor.current, (sensor_cat[0], sensor.label))
+    metrics.add(PROCESS_COUNT, len(psutil.pids()))
 
     return metrics
 
 
+HOST_INFO = info(
+    "host_info", "Host name, operating system and architecture",
+    ("hostname", "machine", "os", "os_release", "os_name", "os_version", "os_architecture"))
+HOST_BOOT_TIME = gauge("host_boot_time", "Boot time as a Unix timestamp")
+HOST_UPTIME = gauge("host_uptime", "Seconds since boot")
+
+OS_RELEASE_FILES = (
+    # file, name key, version key
+    ('/etc/lsb-release', 'DISTRIB_ID', 'DISTRIB_RELEASE'),
+    ('/etc/os-release', 'NAME', 'VERSION_ID'),
+)
+
+
+def read_os_release():
+    """(name, version) of the distribution, 'Unknown' where not found"""
+    for path, name_key, version_key in OS_RELEASE_FILES:
+        try:
+            with open(path, 'r') as f:
+                values = dict(
+                    line.strip().split('=', 1) for line in f if '=' in line
+                )
+        except OSError:
+            continue
+        return (
+            values.get(name_key, 'Unknown').strip('"'),
+            values.get(version_key, 'Unknown').strip('"'),
+        )
+    return 'Unknown', 'Unknown'
+
+
+def _host_info_fingerprint():
+    release_mtimes = []
+    for path, _, _ in OS_RELEASE_FILES:
+        try:
+            release_mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            release_mtimes.append(None)
+    return os.uname(), release_mtimes
+
+
+def host_info_prometheus_metrics():
+    metrics = MetricSet()
+    os_name, os_version = read_os_release()
+    metrics.add(HOST_INFO, 1, (
+        os.uname()[1],
+        platform.machine(),
+        platform.system(),
+        platform.release(),
+        os_name,
+        os_version,
+        platform.architecture()[0],
+    ))
+    return metrics
+
+
+# Rebuilt when the hostname, kernel or distribution release changes
+host_info_cache = FingerprintCache(_host_info_fingerprint, host_info_prometheus_metrics)
+
+
 def get_host_prometheus_metrics():
-    metrics = []
-
-    os_version = 'Unknown'
-    os_name = 'Unknown'
-    with open('/etc/lsb-release', 'r') as f:
-        for line in f.readlines():
-            if 'DISTRIB_RELEASE' in line:
-                os_version = line.split('=')[1].strip().strip('"')
-            if 'DISTRIB_ID' in line:
-                os_name = line.split('=')[1].strip().strip('"')
-
-    metrics.append(
-        "host_info{"
-        f"hostname=\"{os.uname()[1]}\", "
-        f"machine=\"{platform.machine()}\", "
-        f"os=\"{platform.system()}\", "
-        f"os_release=\"{platform.release()}\", "
-        f"os_name=\"{os_name}\", "
-        f"os_version=\"{os_version}\", "
-        f"os_architecture=\"{platform.architecture()[0]}\" "
-        "} 1"
-    )
+    metrics = MetricSet()
+    metrics.extend(host_info_cache.get())
 
-    metrics.append(
-        "host_boot_time "
-        f"{psutil.boot_time()}"
-    )
-    metrics.append(
-        "host_uptime "
-        f"{datetime.now().timestamp() - psutil.boot_time()}"
-    )
+    boot_time = psutil.boot_time()
+    metrics.add(HOST_BOOT_TIME, boot_time)
+    metrics.add(HOST_UPTIME, datetime.now().timestamp() - boot_time)
 
     return metrics
 
 
+MEMORY_GAUGES = [
+    (attribute, gauge(f"memory_{attribute}", documentation))
+    for attribute, documentation in (
+        ("ram_total", "Total RAM in bytes"),
+        ("ram_used", "Used RAM in bytes, total minus available"),
+        ("ram_free", "Unused RAM in bytes"),
+        ("ram_available", "RAM available to new processes without swapping in bytes"),
+        ("ram_used_percent", "Used RAM in percent"),
+        ("swap_total", "Total swap in bytes"),
+        ("swap_used", "Used swap in bytes"),
+        ("swap_free", "Free swap in bytes"),
+        ("swap_used_percent", "Used swap in percent"),
+        ("buffers", "Block device buffers in bytes"),
+        ("cached", "Page cache in bytes"),
+        ("dirty", "Memory waiting to be written back to disk in bytes"),
+        ("writeback", "Memory being written back to disk in bytes"),
+        ("slab", "Kernel slab allocations in bytes"),
+        ("slab_reclaimable", "Reclaimable kernel slab allocations in bytes"),
+        ("committed_as", "Memory committed to processes in bytes"),
+        ("commit_limit", "Memory that can be committed under strict overcommit in bytes"),
+        ("hugepages_total", "Number of huge pages in the pool"),
+        ("hugepages_free", "Number of unallocated huge pages"),
+        ("hugepages_reserved", "Number of huge pages reserved but not yet allocated"),
+        ("hugepages_surplus", "Number of surplus huge pages above the pool size"),
+        ("hugepage_size", "Default huge page size in bytes"),
+    )
+]
+
+
+def _psutil_memory():
+    """MemorySnapshot-like view for systems without /proc/meminfo"""
+    ram = psutil.virtual_memory()
+    swap = psutil.swap_memory()
+    return procfs.MemorySnapshot({
+        "MemTotal": ram.total,
+        "MemFree": ram.free,
+        "MemAvailable": ram.available,
+        "Buffers": getattr(ram, "buffers", 0),
+        "Cached": getattr(ram, "cached", 0),
+        "SwapTotal": swap.total,
+        "SwapFree": swap.free,
+    })
+
+
 def get_memory_prometheus_metrics():
-    metrics = []
+    metrics = MetricSet()
 
-    metrics.append(
-        "memory_ram_total"
-        f" {psutil.virtual_memory().total}"
-    )
-    metrics.append(
-        "memory_ram_used"
-        f" {psutil.virtual_memory().used}"
-    )
-    metrics.append(
-        "memory_ram_free"
-        f" {psutil.virtual_memory().free}"
-    )
-    metrics.append(
-        "memory_ram_available"
-        f" {psutil.virtual_memory().available}"
-    )
-    metrics.append(
-        "memory_ram_used_percent"
-        f" {psutil.virtual_memory().percent}"
-    )
-    metrics.append(
-        "memory_swap_total"
-        f" {psutil.swap_memory().total}"
-    )
-    metrics.append(
-        "memory_swap_used"
-        f" {psutil.swap_memory().used}"
-    )
-    metrics.append(
-        "memory_swap_free"
-        f" {psutil.swap_memory().free}"
-    )
-    metrics.append(
-        "memory_swap_used_percent"
-        f" {psutil.swap_memory().percent}"
-    )
+    try:
+        memory = procfs.read_memory()
+    except FileNotFoundError:
+        memory = _psutil_memory()
+
+    for attribute, family in MEMORY_GAUGES:
+        metrics.add(family, getattr(memory, attribute))
 
     return metrics
 
 
 def get_screen_prometheus_metrics():
-    metrics = []
-
-    screens = list_screens()
-    metrics.append(
-        "screen_count "
-        f"{len(screens)}"
+    return screen_prometheus_metrics(screens.list_sessions())
+
+
+NETWORK_LABELS = ("interface",)
+NETWORK_RECEIVE_BYTES = counter("network_receive_bytes_total", "Bytes received", NETWORK_LABELS)
+NETWORK_RECEIVE_PACKETS = counter("network_receive_packets_total", "Packets received", NETWORK_LABELS)
+NETWORK_RECEIVE_ERRORS = counter("network_receive_errors_total", "Receive errors", NETWORK_LABELS)
+NETWORK_RECEIVE_DROPS = counter("network_receive_drops_total", "Received packets dropped", NETWORK_LABELS)
+NETWORK_TRANSMIT_BYTES = counter("network_transmit_bytes_total", "Bytes transmitted", NETWORK_LABELS)
+NETWORK_TRANSMIT_PACKETS = counter("network_transmit_packets_total", "Packets transmitted", NETWORK_LABELS)
+NETWORK_TRANSMIT_ERRORS = counter("network_transmit_errors_total", "Transmit errors", NETWORK_LABELS)
+NETWORK_TRANSMIT_DROPS = counter("network_transmit_drops_total", "Transmitted packets dropped", NETWORK_LABELS)
+NETWORK_INFO = info("network_info", "Operational state of the interface", NETWORK_LABELS + ("operstate",))
+NETWORK_UP = gauge("network_up", "Whether the interface is operationally up", NETWORK_LABELS)
+NETWORK_SPEED = gauge("network_speed_bytes", "Link speed in bytes per second", NETWORK_LABELS)
+NETWORK_RECEIVE_RATE = gauge(
+    "network_receive_bytes_per_second", "Bytes received per second over the sampler window", NETWORK_LABELS)
+NETWORK_TRANSMIT_RATE = gauge(
+    "network_transmit_bytes_per_second", "Bytes transmitted per second over the sampler window", NETWORK_LABELS)
+NETWORK_RECEIVE_UTILIZATION = gauge(
+    "network_receive_utilization", "Receive rate in percent of the link speed", NETWORK_LABELS)
+NETWORK_TRANSMIT_UTILIZATION = gauge(
+    "network_transmit_utilization", "Transmit rate in percent of the link speed", NETWORK_LABELS)
+
+
+def _network_selected(name):
+    return (
+        (config.NETWORK_INTERFACE_INCLUDE is None or config.NETWORK_INTERFACE_INCLUDE.search(name))
+        and not (config.NETWORK_INTERFACE_EXCLUDE is not None and config.NETWORK_INTERFACE_EXCLUDE.search(name))
     )
-    for screen in screens:
-        command = (f"ps u -p $(ps -el | grep $(ps -el | grep {screen.id} | "
-                   "grep bash | awk '{print $4}') | grep -v bash | awk '{print $4}')")
-        output = os.popen(command).read()
-        if output:
-            output = output.split('\n')[-2]
-            output = " ".join(output.split()[10:])
-
-        metrics.append(
-            "screen_info{"
-            f"pid=\"{screen.id}\", "
-            f"open_time=\"{datetime.strptime(screen._date, '%m/%d/%Y %I:%M:%S %p').timestamp()}\", "
-            f"status=\"{screen.status}\", "
-            f"name=\"{screen.name}\", "
-            f"command=\"{output}\" "
-            "} 1"
-        )
+
+
+def get_network_prometheus_metrics():
+    metrics = MetricSet()
+
+    sample = net_sampler.latest()
+    stats = sample.stats if sample is not None else netdev.read_net_dev()
+    rates = sample.rates if sample is not None and sample.rates is not None else {}
+
+    for stat in stats:
+        if not _network_selected(stat.name):
+            continue
+        labels = (stat.name,)
+        metrics.add(NETWORK_RECEIVE_BYTES, stat.rx_bytes, labels)
+        metrics.add(NETWORK_RECEIVE_PACKETS, stat.rx_packets, labels)
+        metrics.add(NETWORK_RECEIVE_ERRORS, stat.rx_errors, labels)
+        metrics.add(NETWORK_RECEIVE_DROPS, stat.rx_drops, labels)
+        metrics.add(NETWORK_TRANSMIT_BYTES, stat.tx_bytes, labels)
+        metrics.add(NETWORK_TRANSMIT_PACKETS, stat.tx_packets, labels)
+        metrics.add(NETWORK_TRANSMIT_ERRORS, stat.tx_errors, labels)
+        metrics.add(NETWORK_TRANSMIT_DROPS, stat.tx_drops, labels)
+        state = netdev.operstate(stat.name)
+        metrics.add(NETWORK_INFO, 1, labels + (state,))
+        metrics.add(NETWORK_UP, state == "up", labels)
+        speed = netdev.link_speed(stat.name)
+        if speed is not None:
+            metrics.add(NETWORK_SPEED, speed / 8, labels)
+        rate = rates.get(stat.name)
+        if rate is not None:
+            metrics.add(NETWORK_RECEIVE_RATE, rate.rx_bytes, labels)
+            metrics.add(NETWORK_TRANSMIT_RATE, rate.tx_bytes, labels)
+            if speed is not None:
+                metrics.add(NETWORK_RECEIVE_UTILIZATION, netdev.utilization(rate.rx_bytes, speed), labels)
+                metrics.add(NETWORK_TRANSMIT_UTILIZATION, netdev.utilization(rate.tx_bytes, speed), labels)
 
     return metrics
 
 
+PROCESS_LABELS = ("pid", "name", "user")
+# host_ prefixed: process_cpu_seconds_total and process_resident_memory_bytes
+# are what client libraries report about the scraped process itself
+PROCESS_TRACKED = gauge("host_process_tracked", "Processes seen by the last walk over /proc")
+PROCESS_INFO = info(
+    "host_process_info", "Command line of a top consumer process", PROCESS_LABELS + ("cmdline",))
+PROCESS_CPU_UTILIZATION = gauge(
+    "host_process_cpu_utilization", "CPU use of the process since the last walk in percent of one thread",
+    PROCESS_LABELS)
+PROCESS_CPU_SECONDS = counter(
+    "host_process_cpu_seconds_total", "User and system CPU time of the process", PROCESS_LABELS)
+PROCESS_RESIDENT_MEMORY = gauge(
+    "host_process_resident_memory_bytes", "Resident memory of the process", PROCESS_LABELS)
+PROCESS_IO_READ = counter(
+    "host_process_io_read_bytes_total", "Bytes the process read from storage", PROCESS_LABELS)
+PROCESS_IO_WRITTEN = counter(
+    "host_process_io_written_bytes_total", "Bytes the process wrote to storage", PROCESS_LABELS)
+PROCESS_IO_RATE = gauge(
+    "host_process_io_bytes_per_second", "Bytes read and written per second since the last walk", PROCESS_LABELS)
+
+
+def get_processes_prometheus_metrics():
+    metrics = MetricSet()
+
+    # Only the top consumers by CPU, memory and I/O are exported, so the
+    # number of series stays bounded however many processes there are
+    tracked, usages = process_tracker.scan()
+    metrics.add(PROCESS_TRACKED, tracked)
+    for usage in usages:
+        labels = (usage.stat.pid, usage.info.comm, usage.info.user)
+        metrics.add(PROCESS_INFO, 1, labels + (usage.info.cmdline,))
+        if usage.cpu is not None:
+            metrics.add(PROCESS_CPU_UTILIZATION, usage.cpu, labels)
+        metrics.add(PROCESS_CPU_SECONDS, usage.cpu_seconds, labels)
+        metrics.add(PROCESS_RESIDENT_MEMORY, usage.rss_bytes, labels)
+        if usage.io is not None:
+            metrics.add(PROCESS_IO_READ, usage.io[0], labels)
+            metrics.add(PROCESS_IO_WRITTEN, usage.io[1], labels)
+        if usage.io_rate is not None:
+            metrics.add(PROCESS_IO_RATE, usage.io_rate, labels)
+
+    return metrics
+
+
+CONTAINER_LABELS = ("id", "name", "image")
+DOCKER_UP = gauge("docker_up", "Whether the Docker daemon answered")
+DOCKER_CONTAINERS = gauge("docker_containers", "Number of running containers")
+CONTAINER_INFO = info("container_info", "Container and its state", CONTAINER_LABELS + ("state",))
+CONTAINER_CPU_SECONDS = counter(
+    "container_cpu_seconds_total", "CPU time consumed by the container", CONTAINER_LABELS)
+CONTAINER_MEMORY_USAGE = gauge(
+    "container_memory_usage_bytes", "Memory used by the container including page cache", CONTAINER_LABELS)
+CONTAINER_MEMORY_LIMIT = gauge(
+    "container_memory_limit_bytes", "Memory limit of the container, the host's memory if unlimited",
+    CONTAINER_LABELS)
+CONTAINER_PIDS = gauge("container_pids", "Processes and threads in the container", CONTAINER_LABELS)
+CONTAINER_BLOCK_READ = counter(
+    "container_block_read_bytes_total", "Bytes read from block devices", CONTAINER_LABELS)
+CONTAINER_BLOCK_WRITTEN = counter(
+    "container_block_written_bytes_total", "Bytes written to block devices", CONTAINER_LABELS)
+CONTAINER_NETWORK_RECEIVE = counter(
+    "container_network_receive_bytes_total", "Bytes received on all interfaces of the container",
+    CONTAINER_LABELS)
+CONTAINER_NETWORK_TRANSMIT = counter(
+    "container_network_transmit_bytes_total", "Bytes transmitted on all interfaces of the container",
+    CONTAINER_LABELS)
+
+CONTAINER_USAGE = (
+    ("cpu_seconds", CONTAINER_CPU_SECONDS),
+    ("memory_usage", CONTAINER_MEMORY_USAGE),
+    ("memory_limit", CONTAINER_MEMORY_LIMIT),
+    ("pids", CONTAINER_PIDS),
+    ("block_read", CONTAINER_BLOCK_READ),
+    ("block_written", CONTAINER_BLOCK_WRITTEN),
+    ("rx_bytes", CONTAINER_NETWORK_RECEIVE),
+    ("tx_bytes", CONTAINER_NETWORK_TRANSMIT),
+)
+
+
+async def get_docker_prometheus_metrics_async():
+    metrics = MetricSet()
+    if not docker_client.available():
+        return metrics
+
+    try:
+        usages = await containers.collect(docker_client)
+    except (OSError, containers.DockerError, ValueError) as e:
+        logger.warning("Docker daemon at %s unavailable: %s", docker_client.path, e)
+        metrics.add(DOCKER_UP, False)
+        return metrics
+    metrics.add(DOCKER_UP, True)
+    metrics.add(DOCKER_CONTAINERS, len(usages))
+    for container, usage in usages:
+        labels = container.labels
+        metrics.add(CONTAINER_INFO, 1, labels + (container.state,))
+        if usage is None:
+            continue
+        for attribute, family in CONTAINER_USAGE:
+            value = getattr(usage, attribute)
+            if value is not None:
+                metrics.add(family, value, labels)
+
+    return metrics
+
+
+SCREEN_COUNT = gauge("screen_count", "Number of screen sessions")
+SCREEN_INFO = info(
+    "screen_info", "Screen session and the command running in it",
+    ("pid", "open_time", "status", "name", "command"))
+
+
+def screen_prometheus_metrics(sessions):
+    metrics = MetricSet()
+
+    metrics.add(SCREEN_COUNT, len(sessions))
+    for session in sessions:
+        metrics.add(SCREEN_INFO, 1, (
+            session.id,
+            session.open_time(),
+            session.status,
+            session.name,
+            session.command,
+        ))
+
+    return metrics
+
+
+COLLECTORS = {
+    "gpu": get_gpu_prometheus_metrics_async,
+    "disk": get_disk_prometheus_metrics,
+    "diskio": get_diskio_prometheus_metrics,
+    "cpu": get_cpu_prometheus_metrics,
+    "host": get_host_prometheus_metrics,
+    "docker": get_docker_prometheus_metrics_async,
+    "memory": get_memory_prometheus_metrics,
+    "network": get_network_prometheus_metrics,
+    "processes": get_processes_prometheus_metrics,
+    "screen": get_screen_prometheus_metrics,
+}
+
+instrumentation = Instrumentation()
+scheduler = Scheduler(
+    COLLECTORS,
+    config.COLLECTOR_INTERVALS,
+    config.COLLECTOR_TIMEOUTS,
+    workers=config.COLLECTOR_WORKERS,
+    instrumentation=instrumentation,
+)
+remote_writer = None
+if config.REMOTE_WRITE_URL:
+    remote_writer = remote_write.RemoteWriter(
+        config.REMOTE_WRITE_URL,
+        scheduler,
+        remote_write.WAL(config.REMOTE_WRITE_WAL_DIR, config.REMOTE_WRITE_WAL_MAX_BYTES),
+        interval=config.REMOTE_WRITE_INTERVAL,
+        batch=config.REMOTE_WRITE_BATCH,
+        timeout=config.REMOTE_WRITE_TIMEOUT,
+        external_labels=(("job", config.REMOTE_WRITE_JOB), ("instance", config.REMOTE_WRITE_INSTANCE)),
+    )
+federator = None
+if config.FEDERATION_TARGETS:
+    federator = federation.Federator(
+        [federation.Target(target) for target in config.FEDERATION_TARGETS],
+        concurrency=config.FEDERATION_CONCURRENCY,
+        timeout=config.FEDERATION_TIMEOUT,
+    )
+
+FEDERATION_TARGET_UP = gauge(
+    "federation_target_up", "Whether the last scrape of a federated exporter succeeded", ("instance",))
+FEDERATION_TARGET_DURATION = gauge(
+    "federation_target_duration_seconds", "Duration of the last scrape of a federated exporter", ("instance",))
+FEDERATION_TARGET_SAMPLES = gauge(
+    "federation_target_samples", "Samples relabelled from the last scrape of a federated exporter", ("instance",))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if config.TRACEMALLOC_FRAMES > 0:
+        tracemalloc.start(config.TRACEMALLOC_FRAMES)
+    instrumentation.start()
+    if gpu_backend.available():
+        gpu_backend.start()
+    gpu_sampler.start()
+    cpu_sampler.start()
+    diskio_sampler.start()
+    net_sampler.start()
+    await scheduler.start()
+    if remote_writer is not None:
+        await remote_writer.start()
+    yield
+    if remote_writer is not None:
+        await remote_writer.stop()
+    await scheduler.stop()
+    net_sampler.stop()
+    diskio_sampler.stop()
+    cpu_sampler.stop()
+    gpu_sampler.stop()
+    gpu_backend.stop()
+    disk_stats.stop()
+    await docker_client.close()
+    if federator is not None:
+        federator.close()
+    instrumentation.stop()
+
+
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
+    lifespan=lifespan,
 )
 
 
-@app.get("/metrics")
-def metrics():
-    m1 = get_gpu_prometheus_metrics()
-    m2 = get_disk_prometheus_metrics()
-    m3 = get_cpu_prometheus_metrics()
-    m4 = get_host_prometheus_metrics()
-    m5 = get_memory_prometheus_metrics()
-    m6 = get_screen_prometheus_metrics()
+async def _stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _metrics(request, names):
+    # Background collectors are served from the last snapshot, only
+    # collectors configured with interval 0 run during the scrape, in
+    # parallel and dropped if they miss their timeout
+    if names is not None:
+        unknown = sorted(set(names) - set(scheduler.names()))
+        if unknown:
+            return Response(
+                f"Unknown collectors {', '.join(unknown)}, known are {', '.join(scheduler.names())}\n",
+                status_code=400, media_type="text/plain",
+            )
+    started = time.perf_counter()
+    scrape = await scheduler.scrape(names)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    format = exposition.negotiate(request.headers.get("accept"))
+    gzip = exposition.accepts_gzip(request.headers.get("accept-encoding"))
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    chunks = exposition.chunks(scrape, format, gzip=gzip, level=config.GZIP_LEVEL)
+    instrumentation.observe_scrape(
+        format.name, "gzip" if gzip else "identity",
+        time.perf_counter() - started, sum(len(chunk) for chunk in chunks),
+    )
+    return StreamingResponse(_stream(chunks), media_type=format.content_type, headers=headers)
 
-    response = '\n'.join(sorted(m1 + m2 + m3 + m4 + m5 + m6))
-    # return response as plain text encoding
-    return PlainTextResponse(response)
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    # ?collect[]=gpu&collect[]=memory limits the scrape to those collectors
+    return await _metrics(request, request.query_params.getlist("collect[]") or None)
+
+
+@app.get("/metrics/{collector}")
+async def collector_metrics(request: Request, collector: str):
+    return await _metrics(request, [collector])
+
+
+async def _federate():
+    results = {}
+    async for chunk in federator.stream(results):
+        yield chunk
+    metrics = MetricSet()
+    for target in federator.targets:
+        result = results[target.instance]
+        metrics.add(FEDERATION_TARGET_UP, result.up, (target.instance,))
+        metrics.add(FEDERATION_TARGET_DURATION, round(result.duration, 6), (target.instance,))
+        metrics.add(FEDERATION_TARGET_SAMPLES, result.samples, (target.instance,))
+    yield exposition.TEXT.encode(metrics)
+
+
+@app.get("/federate")
+async def federate(request: Request):
+    # Peers are relabelled as they are read and passed on grouped by metric
+    # family, in the text format whatever they could produce
+    if federator is None:
+        return Response("No federation targets configured\n", status_code=404, media_type="text/plain")
+    headers = {"Vary": "Accept-Encoding"}
+    chunks = _federate()
+    if exposition.accepts_gzip(request.headers.get("accept-encoding")):
+        headers["Content-Encoding"] = "gzip"
+        chunks = exposition.gzip_stream(chunks, level=config.GZIP_LEVEL)
+    return StreamingResponse(chunks, media_type=exposition.TEXT_CONTENT_TYPE, headers=headers)
+
+
+# One profile or allocation trace at a time
+_debug_lock = asyncio.Lock()
+# Upper bounds of the /debug/tracemalloc parameters
+DEBUG_MAX_FRAMES = 100
+DEBUG_MAX_TOP = 1000
+
+
+def _bad_request(message):
+    return Response(message + "\n", status_code=400, media_type="text/plain")
+
+
+def _debug_refusal(seconds):
+    """Response refusing a /debug request, None if it may run"""
+    if not config.DEBUG_ENDPOINTS:
+        return Response("Not Found\n", status_code=404, media_type="text/plain")
+    if not 0 < seconds <= config.DEBUG_MAX_SECONDS:
+        return _bad_request(f"seconds must be within (0, {config.DEBUG_MAX_SECONDS:g}]")
+    if _debug_lock.locked():
+        return Response("Another profile is running\n", status_code=409, media_type="text/plain")
+    return None
+
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 10, mode: str = "sample"):
+    # sample: stacks of every thread in the collapsed format, cprofile:
+    # deterministic profile of the event loop thread only
+    refusal = _debug_refusal(seconds)
+    if refusal is not None:
+        return refusal
+    if mode not in ("sample", "cprofile"):
+        return _bad_request("mode must be sample or cprofile")
+    headers = {}
+    async with _debug_lock:
+        if mode == "cprofile":
+            report = await profiling.profile_loop(seconds)
+        else:
+            samples, stacks = await asyncio.to_thread(profiling.sample_stacks, seconds)
+            report = profiling.collapsed(stacks)
+            headers["X-Profile-Samples"] = str(samples)
+    return Response(report, media_type="text/plain", headers=headers)
+
+
+@app.get("/debug/tracemalloc")
+async def debug_tracemalloc(seconds: float = 10, top: int = 25, frames: int = 1):
+    refusal = _debug_refusal(seconds)
+    if refusal is not None:
+        return refusal
+    if not 1 <= top <= DEBUG_MAX_TOP:
+        return _bad_request(f"top must be within [1, {DEBUG_MAX_TOP}]")
+    if not 1 <= frames <= DEBUG_MAX_FRAMES:
+        return _bad_request(f"frames must be within [1, {DEBUG_MAX_FRAMES}]")
+    async with _debug_lock:
+        report = await asyncio.to_thread(profiling.top_allocations, seconds, top, frames)
+    return Response(report, media_type="text/plain")
 
 
 if __name__ == "__main__":
-    run(app, host="0.0.0.0", port=8754)
+    run(app, host=config.HOST, port=config.PORT)
@@ -0,0 +1,263 @@
+# Typed metric families and the per-collection sample sets collectors fill.
+# Label sets are escaped and rendered once per family, samples are written
+# straight into one output buffer.
+import bisect
+import io
+import itertools
+import math
+
+# Rendered label prefixes kept per family before the cache is reset, bounds
+# memory for families whose label values churn (pids, containers)
+PREFIX_CACHE_SIZE = 10000
+
+# Upper bounds of histogram buckets in seconds, as the Prometheus clients default to
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def format_value(value):
+    if value is True:
+        return "1"
+    if value is False:
+        return "0"
+    if isinstance(value, int):
+        return str(value)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        # nvidia-smi and friends report "[N/A]" and similar for unsupported fields
+        return "NaN"
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def numeric_value(value):
+    """Sample value as a float, NaN where format_value writes NaN"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class MetricFamily(object):
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.header = (
+            f"# HELP {name} {escape_help(documentation)}\n"
+            f"# TYPE {name} {self.text_type()}\n"
+        )
+        self._prefixes = {}
+
+    def text_type(self):
+        """Type as written in the Prometheus text format"""
+        return self.type
+
+    def labels(self, labelvalues):
+        """Rendered `label="value",...` for a tuple of label values"""
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {len(labelvalues)} values"
+            )
+        return ",".join(
+            f"{name}=\"{escape_label_value(value)}\""
+            for name, value in zip(self.labelnames, labelvalues)
+        )
+
+    def prefix(self, labelvalues):
+        """Rendered `name{label="value",...} ` for a tuple of label values"""
+        try:
+            return self._prefixes[labelvalues]
+        except KeyError:
+            pass
+        labels = self.labels(labelvalues)
+        prefix = f"{self.name}{{{labels}}} " if labels else f"{self.name} "
+        if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+            self._prefixes = {}
+        self._prefixes[labelvalues] = prefix
+        return prefix
+
+    def write_samples(self, out, samples, end):
+        prefix = self.prefix
+        for labels, value in samples:
+            out.write(prefix(labels))
+            out.write(format_value(value))
+            out.write(end)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name!r})"
+
+
+class Gauge(MetricFamily):
+    type = "gauge"
+
+
+class Counter(MetricFamily):
+    type = "counter"
+
+
+class Info(MetricFamily):
+    """Constant 1 samples carrying information in their labels"""
+    type = "info"
+
+    def text_type(self):
+        # The Prometheus text format has no info type
+        return "gauge"
+
+    def write_samples(self, out, samples, end):
+        prefix = self.prefix
+        for labels, _ in samples:
+            out.write(prefix(labels))
+            out.write("1")
+            out.write(end)
+
+
+class HistogramValue(object):
+    """Observations of one histogram series: counts per bucket, their sum and number"""
+
+    def __init__(self, buckets):
+        # Upper bounds ending with +Inf
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, amount):
+        self.counts[bisect.bisect_left(self.buckets, amount)] += 1
+        self.sum += amount
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations up to it) for every bucket"""
+        return list(zip(self.buckets, itertools.accumulate(self.counts)))
+
+    def copy(self):
+        value = HistogramValue(self.buckets)
+        value.counts = list(self.counts)
+        value.sum = self.sum
+        value.count = self.count
+        return value
+
+
+class Histogram(MetricFamily):
+    """Samples are HistogramValues, written as _bucket, _sum and _count series"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        buckets = tuple(sorted(float(bound) for bound in buckets))
+        if not buckets or buckets[-1] != math.inf:
+            buckets += (math.inf,)
+        self.buckets = buckets
+
+    def value(self):
+        return HistogramValue(self.buckets)
+
+    def series(self, labelvalues):
+        """Rendered prefixes of the _bucket samples, one per bucket, and of _sum and _count"""
+        try:
+            return self._prefixes[labelvalues]
+        except KeyError:
+            pass
+        labels = self.labels(labelvalues)
+        separator = "," if labels else ""
+        suffix = f"{{{labels}}}" if labels else ""
+        series = (
+            [f"{self.name}_bucket{{{labels}{separator}le=\"{format_value(bound)}\"}} " for bound in self.buckets],
+            f"{self.name}_sum{suffix} ",
+            f"{self.name}_count{suffix} ",
+        )
+        if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+            self._prefixes = {}
+        self._prefixes[labelvalues] = series
+        return series
+
+    def write_samples(self, out, samples, end):
+        for labels, value in samples:
+            buckets, sum_prefix, count_prefix = self.series(labels)
+            for prefix, (_, count) in zip(buckets, value.cumulative()):
+                out.write(prefix)
+                out.write(str(count))
+                out.write(end)
+            out.write(sum_prefix)
+            out.write(format_value(value.sum))
+            out.write(end)
+            out.write(count_prefix)
+            out.write(str(value.count))
+            out.write(end)
+
+
+class Registry(object):
+    def __init__(self):
+        self.families = {}
+
+    def register(self, family):
+        if family.name in self.families:
+            raise ValueError(f"metric family {family.name} registered twice")
+        self.families[family.name] = family
+        return family
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def info(self, name, documentation, labelnames=()):
+        return self.register(Info(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+
+REGISTRY = Registry()
+gauge = REGISTRY.gauge
+counter = REGISTRY.counter
+info = REGISTRY.info
+histogram = REGISTRY.histogram
+
+
+class MetricSet(object):
+    """Samples of one collection, grouped by family in the order first added"""
+
+    def __init__(self):
+        # family -> [(label values, value)]
+        self.families = {}
+
+    def add(self, family, value, labels=()):
+        samples = self.families.get(family)
+        if samples is None:
+            samples = self.families[family] = []
+        samples.append((labels, value))
+
+    def extend(self, other):
+        for family, samples in other.families.items():
+            self.families.setdefault(family, []).extend(samples)
+
+    def __len__(self):
+        return sum(len(samples) for samples in self.families.values())
+
+    def write(self, out, timestamp=None):
+        """Write the text exposition to out, with timestamp (seconds) on every sample"""
+        end = f" {int(timestamp * 1000)}\n" if timestamp is not None else "\n"
+        for family, samples in self.families.items():
+            out.write(family.header)
+            family.write_samples(out, samples, end)
+
+    def render(self, timestamp=None):
+        out = io.StringIO()
+        self.write(out, timestamp)
+        return out.getvalue()
@@ -0,0 +1,84 @@
+# Network interfaces from /proc/net/dev and /sys/class/net, one read of the
+# counters per collection. Rates are computed by an optional sampler over a
+# fixed window.
+import os
+import time
+
+import procfs
+from sampler import Sampler
+
+
+def read_net_dev():
+    return procfs.parse_net_dev(procfs.read("net", "dev"))
+
+
+def link_speed(name):
+    """Link speed in bits per second, None for virtual interfaces and links that are down"""
+    try:
+        speed = int(procfs.read_sys("class", "net", name, "speed"))
+    except (OSError, ValueError):
+        return None
+    return speed * 1000 * 1000 if speed > 0 else None
+
+
+def operstate(name):
+    try:
+        return procfs.read_sys("class", "net", name, "operstate").strip()
+    except OSError:
+        return "unknown"
+
+
+class NetRates(object):
+    def __init__(self, previous, current, seconds):
+        self.rx_bytes = (current.rx_bytes - previous.rx_bytes) / seconds
+        self.tx_bytes = (current.tx_bytes - previous.tx_bytes) / seconds
+        self.rx_packets = (current.rx_packets - previous.rx_packets) / seconds
+        self.tx_packets = (current.tx_packets - previous.tx_packets) / seconds
+
+
+def rates(previous, current, seconds):
+    """name -> NetRates between two reads, interfaces that appeared or were reset are left out"""
+    before = {stat.name: stat for stat in previous}
+    result = {}
+    for stat in current:
+        old = before.get(stat.name)
+        if old is None or stat.rx_bytes < old.rx_bytes or stat.tx_bytes < old.tx_bytes:
+            continue
+        result[stat.name] = NetRates(old, stat, seconds)
+    return result
+
+
+def utilization(bytes_per_second, speed):
+    """Percent of a link's speed in bits per second"""
+    return round(min(100.0, bytes_per_second * 8 / speed * 100), 1)
+
+
+class NetSample(object):
+    def __init__(self, timestamp, monotonic, stats, rates):
+        self.timestamp = timestamp
+        self.monotonic = monotonic
+        self.stats = stats
+        # name -> NetRates over the last window, None until two reads
+        self.rates = rates
+
+
+class NetSampler(Sampler):
+    """Reads /proc/net/dev every interval seconds, disabled with interval 0"""
+    name = "net-sampler"
+
+    def __init__(self, interval=0):
+        super().__init__(interval)
+        self._latest = None
+
+    def available(self):
+        return self.interval > 0 and os.path.exists(procfs.path("net", "dev"))
+
+    def sample(self):
+        stats = read_net_dev()
+        now = time.monotonic()
+        previous = self._latest
+        window = rates(previous.stats, stats, now - previous.monotonic) if previous is not None else None
+        self._latest = NetSample(time.time(), now, stats, window)
+
+    def latest(self) -> NetSample:
+        return self._latest
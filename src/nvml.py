@@ -0,0 +1,386 @@
+# GPU backend reading from the NVIDIA driver through libnvidia-ml (NVML)
+# with ctypes, so collections spawn no nvidia-smi processes at all.
+import asyncio
+import ctypes
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import nvsmi
+
+logger = logging.getLogger(__name__)
+
+NVML_LIBRARY = "libnvidia-ml.so.1"
+
+NVML_SUCCESS = 0
+NVML_ERROR_NOT_SUPPORTED = 3
+NVML_ERROR_INSUFFICIENT_SIZE = 7
+NVML_ERROR_FUNCTION_NOT_FOUND = 13
+
+NVML_TEMPERATURE_GPU = 0
+NVML_CLOCK_GRAPHICS = 0
+NVML_CLOCK_SM = 1
+NVML_CLOCK_MEM = 2
+NVML_FI_DEV_MEMORY_TEMP = 82
+NVML_VALUE_NOT_AVAILABLE = 2 ** 64 - 1
+
+NVML_CLOCKS_THROTTLE_REASON_GPU_IDLE = 0x01
+NVML_CLOCKS_THROTTLE_REASON_APPLICATIONS_CLOCKS_SETTING = 0x02
+NVML_CLOCKS_THROTTLE_REASON_SW_POWER_CAP = 0x04
+NVML_CLOCKS_THROTTLE_REASON_SW_THERMAL_SLOWDOWN = 0x20
+NVML_CLOCKS_THROTTLE_REASON_HW_THERMAL_SLOWDOWN = 0x40
+NVML_CLOCKS_THROTTLE_REASON_HW_POWER_BRAKE_SLOWDOWN = 0x80
+
+STRING_BUFFER_SIZE = 96
+
+
+class NVMLError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"NVML error {code}: {message}")
+        self.code = code
+
+
+class nvmlUtilization_t(ctypes.Structure):
+    _fields_ = [("gpu", ctypes.c_uint), ("memory", ctypes.c_uint)]
+
+
+class nvmlMemory_t(ctypes.Structure):
+    _fields_ = [("total", ctypes.c_ulonglong), ("free", ctypes.c_ulonglong), ("used", ctypes.c_ulonglong)]
+
+
+class nvmlProcessInfo_t(ctypes.Structure):
+    # Layout of the _v2/_v3 process queries
+    _fields_ = [
+        ("pid", ctypes.c_uint),
+        ("usedGpuMemory", ctypes.c_ulonglong),
+        ("gpuInstanceId", ctypes.c_uint),
+        ("computeInstanceId", ctypes.c_uint),
+    ]
+
+
+class nvmlProcessInfo_v1_t(ctypes.Structure):
+    _fields_ = [("pid", ctypes.c_uint), ("usedGpuMemory", ctypes.c_ulonglong)]
+
+
+class nvmlValue_t(ctypes.Union):
+    _fields_ = [
+        ("dVal", ctypes.c_double),
+        ("uiVal", ctypes.c_uint),
+        ("ulVal", ctypes.c_ulong),
+        ("ullVal", ctypes.c_ulonglong),
+        ("sllVal", ctypes.c_longlong),
+    ]
+
+
+class nvmlFieldValue_t(ctypes.Structure):
+    _fields_ = [
+        ("fieldId", ctypes.c_uint),
+        ("scopeId", ctypes.c_uint),
+        ("timestamp", ctypes.c_longlong),
+        ("latencyUsec", ctypes.c_longlong),
+        ("valueType", ctypes.c_uint),
+        ("nvmlReturn", ctypes.c_uint),
+        ("value", nvmlValue_t),
+    ]
+
+
+class NVML(object):
+    """Thin wrapper raising NVMLError for every non-zero NVML return code
+
+    `library` is anything exposing the NVML C functions as attributes: the
+    loaded libnvidia-ml, a stub shared library with the same symbols, or a
+    Python object that fills the ctypes.byref() arguments it is given.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        error_string = getattr(library, "nvmlErrorString", None)
+        if error_string is not None and hasattr(error_string, "restype"):
+            error_string.restype = ctypes.c_char_p
+
+    @classmethod
+    def load(cls, path=None):
+        return cls(ctypes.CDLL(path or os.environ.get("EXPORTER_NVML_LIBRARY") or NVML_LIBRARY))
+
+    def call(self, name, *args):
+        try:
+            function = getattr(self.library, name)
+        except AttributeError:
+            raise NVMLError(NVML_ERROR_FUNCTION_NOT_FOUND, f"{name} not found")
+        code = function(*args)
+        if code != NVML_SUCCESS:
+            raise NVMLError(code, self.error_string(code))
+
+    def error_string(self, code):
+        try:
+            message = self.library.nvmlErrorString(code)
+        except AttributeError:
+            return "unknown error"
+        return message.decode() if isinstance(message, bytes) else str(message)
+
+    def string(self, name, *args):
+        buffer = ctypes.create_string_buffer(STRING_BUFFER_SIZE)
+        self.call(name, *args, buffer, ctypes.c_uint(STRING_BUFFER_SIZE))
+        return buffer.value.decode()
+
+    def uint(self, name, *args):
+        value = ctypes.c_uint()
+        self.call(name, *args, ctypes.byref(value))
+        return value.value
+
+    def optional(self, function, *args, default=float("nan")):
+        """Result of function, or default if the device does not support it"""
+        try:
+            return function(*args)
+        except NVMLError as e:
+            if e.code in (NVML_ERROR_NOT_SUPPORTED, NVML_ERROR_FUNCTION_NOT_FOUND):
+                return default
+            raise
+
+
+class Device(object):
+    """Cached NVML handle and the fields of a GPU that never change"""
+
+    def __init__(self, nvml, index):
+        self.index = index
+        self.handle = ctypes.c_void_p()
+        nvml.call("nvmlDeviceGetHandleByIndex_v2", ctypes.c_uint(index), ctypes.byref(self.handle))
+        self.uuid = nvml.string("nvmlDeviceGetUUID", self.handle)
+        self.name = nvml.string("nvmlDeviceGetName", self.handle)
+        self.serial = nvml.optional(nvml.string, "nvmlDeviceGetSerial", self.handle, default="[N/A]")
+        self.vbios_version = nvml.optional(nvml.string, "nvmlDeviceGetVbiosVersion", self.handle, default="[N/A]")
+
+
+def _process_name(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            argv0 = f.read().split(b"\0", 1)[0]
+        if argv0:
+            return argv0.decode(errors="replace")
+        with open(f"/proc/{pid}/comm", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return "[Not Found]"
+
+
+class NVMLBackend(object):
+    """Reads the fields of nvsmi.GPU straight from the driver
+
+    Device handles and static fields are cached across collections and only
+    re-enumerated when the device count changes or NVML reports an error.
+    If NVML cannot be loaded or fails, collections use `fallback` instead.
+    """
+    name = "nvml"
+
+    def __init__(self, fallback=None, nvml=None):
+        self.fallback = fallback
+        self.nvml = nvml
+        self._initialized = None
+        self._devices = None
+        self._driver = None
+        # Future of the snapshot running on its own thread, see snapshot_async
+        self._pending = None
+
+    def _init(self):
+        if self._initialized is None:
+            try:
+                if self.nvml is None:
+                    self.nvml = NVML.load()
+                self.nvml.call("nvmlInit_v2")
+                self._initialized = True
+            except (OSError, NVMLError) as e:
+                logger.info("NVML unavailable (%s), using %s", e,
+                            self.fallback.name if self.fallback else "no GPU backend")
+                self._initialized = False
+        return self._initialized
+
+    def available(self):
+        if self._init():
+            return True
+        return self.fallback is not None and self.fallback.available()
+
+    def start(self):
+        if not self._init() and self.fallback is not None:
+            self.fallback.start()
+
+    def stop(self):
+        if self._initialized:
+            try:
+                self.nvml.call("nvmlShutdown")
+            except NVMLError:
+                pass
+            self._initialized = None
+            self._devices = None
+        if self.fallback is not None:
+            self.fallback.stop()
+
+    def _enumerate(self):
+        count = self.nvml.uint("nvmlDeviceGetCount_v2")
+        if self._devices is None or len(self._devices) != count:
+            self._devices = [Device(self.nvml, index) for index in range(count)]
+            self._driver = self.nvml.string("nvmlSystemGetDriverVersion")
+        return self._devices
+
+    def _snapshot(self):
+        """NVML snapshot, or None if the fallback has to be used instead"""
+        if not self._init():
+            return None
+        try:
+            gpus = []
+            processes = []
+            for device in self._enumerate():
+                gpus.append(self._gpu(device))
+                processes.extend(self._processes(device))
+        except NVMLError:
+            logger.exception("NVML query failed, using %s for this collection",
+                             self.fallback.name if self.fallback else "nothing")
+            self._devices = None
+            if self.fallback is None:
+                raise
+            return None
+        return nvsmi.GPUSnapshot(gpus, processes, subprocesses=0)
+
+    def _snapshot_into(self, future):
+        try:
+            future.set_result(self._snapshot())
+        except BaseException as e:
+            future.set_exception(e)
+
+    def snapshot(self) -> nvsmi.GPUSnapshot:
+        snapshot = self._snapshot()
+        return snapshot if snapshot is not None else self.fallback.snapshot()
+
+    async def snapshot_async(self) -> nvsmi.GPUSnapshot:
+        # NVML calls usually return quickly, but hang for as long as the
+        # driver does when a GPU fell off the bus. They run on a daemon
+        # thread so a hang ties up neither the event loop nor shutdown, and
+        # later collections wait for the same snapshot instead of piling up
+        # more stuck threads.
+        if self._pending is None or self._pending.done():
+            self._pending = Future()
+            threading.Thread(target=self._snapshot_into, args=(self._pending,), name="nvml", daemon=True).start()
+        snapshot = await asyncio.shield(asyncio.wrap_future(self._pending))
+        return snapshot if snapshot is not None else await self.fallback.snapshot_async()
+
+    def readings(self):
+        """Sampler fields of every GPU, a handful of driver calls per device"""
+        if not self._init():
+            return self.fallback.readings() if self.fallback is not None else None
+        nvml = self.nvml
+        readings = []
+        try:
+            for device in self._enumerate():
+                handle = device.handle
+                utilization = nvmlUtilization_t()
+                nvml.call("nvmlDeviceGetUtilizationRates", handle, ctypes.byref(utilization))
+                readings.append(nvsmi.GPUReading(str(device.index), device.uuid, device.name, time.monotonic(), (
+                    float(utilization.gpu),
+                    nvml.optional(nvml.uint, "nvmlDeviceGetPowerUsage", handle) / 1000,
+                    float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_SM))),
+                    float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_MEM))),
+                    float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_GRAPHICS))),
+                    float(nvml.uint("nvmlDeviceGetTemperature", handle, ctypes.c_uint(NVML_TEMPERATURE_GPU))),
+                )))
+        except NVMLError:
+            # Re-enumerate on the next call, the sampler logs the failure
+            self._devices = None
+            raise
+        return readings
+
+    def _throttle_reasons(self, handle):
+        reasons = ctypes.c_ulonglong()
+        self.nvml.call("nvmlDeviceGetCurrentClocksThrottleReasons", handle, ctypes.byref(reasons))
+        return reasons.value
+
+    def _memory_temperature(self, handle):
+        field = nvmlFieldValue_t(fieldId=NVML_FI_DEV_MEMORY_TEMP)
+        self.nvml.call("nvmlDeviceGetFieldValues", handle, ctypes.c_int(1), ctypes.byref(field))
+        if field.nvmlReturn != NVML_SUCCESS:
+            return float("nan")
+        return float(field.value.uiVal)
+
+    def _gpu(self, device):
+        nvml = self.nvml
+        handle = device.handle
+        utilization = nvmlUtilization_t()
+        nvml.call("nvmlDeviceGetUtilizationRates", handle, ctypes.byref(utilization))
+        memory = nvmlMemory_t()
+        nvml.call("nvmlDeviceGetMemoryInfo", handle, ctypes.byref(memory))
+        reasons = nvml.optional(self._throttle_reasons, handle, default=0)
+        pstate = nvml.optional(nvml.uint, "nvmlDeviceGetPerformanceState", handle, default=32)
+        enabled = {0: "Disabled", 1: "Enabled"}
+        mib = 1024 * 1024
+        return nvsmi.GPU(
+            id=str(device.index),
+            uuid=device.uuid,
+            gpu_util=float(utilization.gpu),
+            mem_total=memory.total / mib,
+            mem_used=memory.used / mib,
+            mem_free=memory.free / mib,
+            driver=self._driver,
+            gpu_name=device.name,
+            serial=device.serial,
+            display_mode=enabled.get(nvml.optional(nvml.uint, "nvmlDeviceGetDisplayMode", handle), "[N/A]"),
+            display_active=enabled.get(nvml.optional(nvml.uint, "nvmlDeviceGetDisplayActive", handle), "[N/A]"),
+            temperature=float(nvml.uint("nvmlDeviceGetTemperature", handle, ctypes.c_uint(NVML_TEMPERATURE_GPU))),
+            vbios_version=device.vbios_version,
+            fan_speed=float(nvml.optional(nvml.uint, "nvmlDeviceGetFanSpeed", handle)),
+            pstate=f"P{pstate}" if pstate < 32 else "Unknown",
+            clocks_throttle_reasons_gpu_idle=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_GPU_IDLE),
+            clocks_throttle_reasons_applications_clocks_setting=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_APPLICATIONS_CLOCKS_SETTING),
+            clocks_throttle_reasons_sw_power_cap=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_SW_POWER_CAP),
+            clocks_throttle_reasons_hw_thermal_slowdown=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_HW_THERMAL_SLOWDOWN),
+            clocks_throttle_reasons_hw_power_brake_slowdown=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_HW_POWER_BRAKE_SLOWDOWN),
+            clocks_throttle_reasons_sw_thermal_slowdown=bool(
+                reasons & NVML_CLOCKS_THROTTLE_REASON_SW_THERMAL_SLOWDOWN),
+            temperature_memory=nvml.optional(self._memory_temperature, handle),
+            power_draw=nvml.optional(nvml.uint, "nvmlDeviceGetPowerUsage", handle) / 1000,
+            power_limit=nvml.optional(nvml.uint, "nvmlDeviceGetPowerManagementLimit", handle) / 1000,
+            enforced_power_limit=nvml.optional(nvml.uint, "nvmlDeviceGetEnforcedPowerLimit", handle) / 1000,
+            clocks_current_graphics=float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_GRAPHICS))),
+            clocks_current_sm=float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_SM))),
+            clocks_current_memory=float(nvml.uint("nvmlDeviceGetClockInfo", handle, ctypes.c_uint(NVML_CLOCK_MEM))),
+        )
+
+    def _running_processes(self, handle):
+        for function, info_type in (
+                ("nvmlDeviceGetComputeRunningProcesses_v3", nvmlProcessInfo_t),
+                ("nvmlDeviceGetComputeRunningProcesses_v2", nvmlProcessInfo_t),
+                ("nvmlDeviceGetComputeRunningProcesses", nvmlProcessInfo_v1_t),
+        ):
+            if not hasattr(self.nvml.library, function):
+                continue
+            count = ctypes.c_uint(0)
+            try:
+                self.nvml.call(function, handle, ctypes.byref(count), None)
+                return []
+            except NVMLError as e:
+                if e.code != NVML_ERROR_INSUFFICIENT_SIZE:
+                    raise
+            # Leave headroom for processes started between the two calls
+            count = ctypes.c_uint(count.value + 8)
+            infos = (info_type * count.value)()
+            self.nvml.call(function, handle, ctypes.byref(count), infos)
+            return infos[:count.value]
+        return []
+
+    def _processes(self, device):
+        processes = []
+        for info in self._running_processes(device.handle):
+            used_memory = info.usedGpuMemory
+            processes.append(nvsmi.GPUProcess(
+                pid=info.pid,
+                process_name=_process_name(info.pid),
+                gpu_id=str(device.index),
+                gpu_uuid=device.uuid,
+                gpu_name=device.name,
+                used_memory=float("nan") if used_memory == NVML_VALUE_NOT_AVAILABLE else used_memory / 1024 / 1024,
+            ))
+        return processes
@@ -1,14 +1,20 @@
 # Modified version of
 # https://github.com/pmav99/nvsmi/blob/master/nvsmi.py (MIT licenced)
 # To gather more metrics
+import asyncio
 import json
+import logging
 import os
 import shlex
 import shutil
 import subprocess
+import threading
+import time
 
 __version__ = "0.4.2"
 
+logger = logging.getLogger(__name__)
+
 
 NVIDIA_SMI_GET_GPUS = ("nvidia-smi "
                        "--query-gpu="
@@ -133,6 +139,85 @@ class GPUProcess(object):
         return json.dumps(self.__dict__)
 
 
+class GPUSnapshot(object):
+    def __init__(self, gpus, processes, subprocesses):
+        self.gpus = gpus
+        self.processes = processes
+        # Number of nvidia-smi processes spawned to build this snapshot
+        self.subprocesses = subprocesses
+
+    def processes_by_gpu(self):
+        processes_by_gpu = {}
+        for process in self.processes:
+            processes_by_gpu.setdefault(process.gpu_uuid, []).append(process)
+        return processes_by_gpu
+
+
+# GPU fields the high-frequency sampler keeps, in the order of GPUReading.values
+READING_FIELDS = (
+    "gpu_util", "power_draw", "clocks_current_sm", "clocks_current_memory",
+    "clocks_current_graphics", "temperature",
+)
+
+
+class GPUReading(object):
+    """READING_FIELDS of one GPU at a monotonic timestamp"""
+
+    def __init__(self, id, uuid, gpu_name, timestamp, values):
+        self.id = id
+        self.uuid = uuid
+        self.name = gpu_name
+        self.timestamp = timestamp
+        self.values = values
+
+    @classmethod
+    def from_gpu(cls, gpu, timestamp):
+        return cls(gpu.id, gpu.uuid, gpu.name, timestamp,
+                   tuple(getattr(gpu, field) for field in READING_FIELDS))
+
+
+_spawned_lock = threading.Lock()
+_spawned_total = 0
+
+
+def subprocesses_spawned():
+    """Total number of nvidia-smi processes spawned since startup"""
+    return _spawned_total
+
+
+def _count_spawn():
+    global _spawned_total
+    with _spawned_lock:
+        _spawned_total += 1
+
+
+def _nvidia_smi(command, timeout=None):
+    _count_spawn()
+    # The child is killed and reaped when it runs out of time
+    output = subprocess.check_output(shlex.split(command), timeout=timeout)
+    return [line for line in output.decode("utf-8").split(os.linesep) if line.strip()]
+
+
+async def _nvidia_smi_async(command):
+    _count_spawn()
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    try:
+        output, _ = await process.communicate()
+    except asyncio.CancelledError:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            # It exited on its own in the meantime
+            pass
+        await process.wait()
+        raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
+    return [line for line in output.decode("utf-8").split(os.linesep) if line.strip()]
+
+
 def to_float_or_inf(value):
     try:
         number = float(value)
@@ -178,10 +263,7 @@ def _get_gpu(line):
 
 
 def get_gpus() -> list[GPU]:
-    output = subprocess.check_output(shlex.split(NVIDIA_SMI_GET_GPUS))
-    lines = output.decode("utf-8").split(os.linesep)
-    gpus = (_get_gpu(line) for line in lines if line.strip())
-    return gpus
+    return [_get_gpu(line) for line in _nvidia_smi(NVIDIA_SMI_GET_GPUS)]
 
 
 def _get_gpu_proc(line, gpu_uuid_to_id_map):
@@ -196,16 +278,207 @@ def _get_gpu_proc(line, gpu_uuid_to_id_map):
     return proc
 
 
-def get_gpu_processes():
-    gpu_uuid_to_id_map = {gpu.uuid: gpu.id for gpu in get_gpus()}
-    output = subprocess.check_output(shlex.split(NVIDIA_SMI_GET_PROCS))
-    lines = output.decode("utf-8").split(os.linesep)
+# Devices and compute apps take two nvidia-smi calls: it runs a single
+# --query-* per invocation, and the one query covering both, -q -x, reads
+# every field of every GPU, takes several times as long and names its XML
+# elements differently between driver versions. The nvml backend spawns
+# nothing, and nvidia-smi-stream no process per collection.
+def get_gpu_snapshot() -> GPUSnapshot:
+    """Devices and compute apps from a single nvidia-smi call each"""
+    gpus = get_gpus()
+    gpu_uuid_to_id_map = {gpu.uuid: gpu.id for gpu in gpus}
     processes = [
-        _get_gpu_proc(line, gpu_uuid_to_id_map) for line in lines if line.strip()
+        _get_gpu_proc(line, gpu_uuid_to_id_map) for line in _nvidia_smi(NVIDIA_SMI_GET_PROCS)
     ]
-    return processes
+    return GPUSnapshot(gpus, processes, subprocesses=2)
+
+
+async def get_gpu_snapshot_async() -> GPUSnapshot:
+    """get_gpu_snapshot() with both nvidia-smi queries running concurrently"""
+    gpu_lines, proc_lines = await asyncio.gather(
+        _nvidia_smi_async(NVIDIA_SMI_GET_GPUS), _nvidia_smi_async(NVIDIA_SMI_GET_PROCS)
+    )
+    gpus = [_get_gpu(line) for line in gpu_lines]
+    gpu_uuid_to_id_map = {gpu.uuid: gpu.id for gpu in gpus}
+    processes = [_get_gpu_proc(line, gpu_uuid_to_id_map) for line in proc_lines]
+    return GPUSnapshot(gpus, processes, subprocesses=2)
 
 
 def is_nvidia_smi_on_path():
     return shutil.which("nvidia-smi")
 
+
+class NvidiaSmiBackend(object):
+    """Runs nvidia-smi once per query on every collection"""
+    name = "nvidia-smi"
+
+    def available(self):
+        return is_nvidia_smi_on_path()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def snapshot(self) -> GPUSnapshot:
+        return get_gpu_snapshot()
+
+    async def snapshot_async(self) -> GPUSnapshot:
+        return await get_gpu_snapshot_async()
+
+    def readings(self):
+        # A process per reading is too much at sampler rates
+        return None
+
+
+class NvidiaSmiStreamBackend(object):
+    """Keeps one nvidia-smi looping with -lms and parses its output as it arrives
+
+    Collections read the latest record per GPU and never fork. A child that
+    exits or stops printing for stall_timeout seconds is killed and restarted
+    with exponential backoff. Compute apps cannot be streamed (a loop has no
+    delimiter), so they are polled off the scrape path every process_interval.
+    """
+    name = "nvidia-smi-stream"
+
+    def __init__(self, interval_ms=1000, process_interval=5.0, stall_timeout=None,
+                 min_backoff=1.0, max_backoff=60.0):
+        self.interval_ms = interval_ms
+        self.process_interval = process_interval
+        self.stall_timeout = stall_timeout or max(5.0, 5 * interval_ms / 1000)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.restarts = 0
+        self._gpus = {}
+        self._processes = []
+        self._child = None
+        self._last_line = 0.0
+        self._lines_since_spawn = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def available(self):
+        return is_nvidia_smi_on_path()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._supervise, name="nvidia-smi-stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._kill()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def snapshot(self) -> GPUSnapshot:
+        # Drop GPUs that have not reported for a while, e.g. after a reset
+        horizon = time.monotonic() - self.stall_timeout
+        # list() first, the reader thread may add a GPU meanwhile
+        gpus = [gpu for seen, gpu in list(self._gpus.values()) if seen >= horizon]
+        gpus.sort(key=lambda gpu: int(gpu.id))
+        return GPUSnapshot(gpus, self._processes, subprocesses=0)
+
+    async def snapshot_async(self) -> GPUSnapshot:
+        # Only reads what the reader thread already parsed
+        return self.snapshot()
+
+    def readings(self):
+        """Latest record per GPU, timestamped when its line arrived"""
+        horizon = time.monotonic() - self.stall_timeout
+        return [
+            GPUReading.from_gpu(gpu, seen)
+            for seen, gpu in list(self._gpus.values()) if seen >= horizon
+        ]
+
+    def _spawn(self):
+        command = shlex.split(NVIDIA_SMI_GET_GPUS) + ["-lms", str(self.interval_ms)]
+        _count_spawn()
+        self._child = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+        )
+        self._last_line = time.monotonic()
+        self._lines_since_spawn = 0
+        threading.Thread(
+            target=self._read, args=(self._child,), name="nvidia-smi-reader", daemon=True
+        ).start()
+
+    def _kill(self):
+        child = self._child
+        if child is not None and child.poll() is None:
+            child.kill()
+            child.wait()
+
+    def _read(self, child):
+        for line in child.stdout:
+            if not line.strip():
+                continue
+            try:
+                gpu = _get_gpu(line.rstrip("\n"))
+            except (IndexError, ValueError, ZeroDivisionError):
+                logger.debug("unparsable nvidia-smi line: %r", line)
+                continue
+            self._last_line = time.monotonic()
+            self._lines_since_spawn += 1
+            self._gpus[gpu.uuid] = (self._last_line, gpu)
+        child.stdout.close()
+
+    def _refresh_processes(self):
+        # Runs on the supervisor thread, a hanging query must not keep it
+        # from noticing a stalled or dead stream
+        try:
+            gpu_uuid_to_id_map = {gpu.uuid: gpu.id for _, gpu in list(self._gpus.values())}
+            self._processes = [
+                _get_gpu_proc(line, gpu_uuid_to_id_map)
+                for line in _nvidia_smi(NVIDIA_SMI_GET_PROCS, timeout=self.stall_timeout)
+            ]
+        except subprocess.TimeoutExpired:
+            logger.warning("nvidia-smi compute-apps query took over %gs, killed it", self.stall_timeout)
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception("nvidia-smi compute-apps query failed")
+
+    def _supervise(self):
+        backoff = self.min_backoff
+        next_processes = 0.0
+        while not self._stop.is_set():
+            try:
+                self._spawn()
+            except OSError:
+                logger.exception("could not start nvidia-smi")
+                reason = "failed to start"
+            else:
+                reason = None
+            tick = min(1.0, self.interval_ms / 1000)
+            while reason is None and not self._stop.wait(tick):
+                if self._child.poll() is not None:
+                    reason = f"exited with {self._child.returncode}"
+                elif time.monotonic() - self._last_line > self.stall_timeout:
+                    reason = f"stalled for {self.stall_timeout:g}s"
+                else:
+                    if self._lines_since_spawn:
+                        backoff = self.min_backoff
+                    if time.monotonic() >= next_processes:
+                        next_processes = time.monotonic() + self.process_interval
+                        self._refresh_processes()
+            self._kill()
+            if self._stop.is_set():
+                break
+            self.restarts += 1
+            logger.warning("nvidia-smi stream %s, restarting in %.0fs", reason, backoff)
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+BACKENDS = {
+    NvidiaSmiBackend.name: NvidiaSmiBackend,
+    NvidiaSmiStreamBackend.name: NvidiaSmiStreamBackend,
+}
+
+
+def create_backend(name, **kwargs):
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown GPU backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return backend(**kwargs)
@@ -0,0 +1,168 @@
+# Per-process usage from incremental walks over /proc. Only stat (and io)
+# is read for every process on each walk, everything that stays the same
+# over the life of a process is read once per (pid, starttime). Only the
+# top consumers are exported, so series stay bounded with any pid count.
+import heapq
+import pwd
+import re
+import threading
+
+import procfs
+
+# 64 hex digit container ids as docker, containerd, CRI-O and podman put
+# them into cgroup paths: /docker/<id>, docker-<id>.scope, crio-<id>.scope...
+CONTAINER_ID = re.compile(r"(?:^|[/-])([0-9a-f]{64})(?:\.scope)?(?:/|$)")
+
+
+_user_names = {}
+
+
+def user_name(uid):
+    name = _user_names.get(uid)
+    if name is None:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            # Users of containers mostly have no entry on the host
+            name = str(uid)
+        _user_names[uid] = name
+    return name
+
+
+def container_id(cgroup):
+    """Short id of the container a cgroup path belongs to, "" outside containers"""
+    match = CONTAINER_ID.search(cgroup)
+    return match.group(1)[:12] if match else ""
+
+
+class ProcessInfo(object):
+    """Attributes of a process that do not change while it runs"""
+
+    def __init__(self, pid, starttime, comm, cmdline, uid, cgroup):
+        self.pid = pid
+        self.starttime = starttime
+        self.comm = comm
+        self.cmdline = cmdline
+        self.uid = uid
+        self.user = user_name(uid) if uid is not None else ""
+        self.cgroup = cgroup
+        self.container = container_id(cgroup)
+
+
+class ProcessInfoCache(object):
+    """ProcessInfo by (pid, starttime), so a reused pid is never mistaken for the old process"""
+
+    def __init__(self, cmdline_length=200):
+        self.cmdline_length = cmdline_length
+        self._infos = {}
+        self._lock = threading.Lock()
+
+    def _build(self, stat):
+        cmdline = procfs.read_cmdline(stat.pid)[:self.cmdline_length]
+        return ProcessInfo(
+            stat.pid, stat.starttime, stat.comm, cmdline,
+            procfs.read_uid(stat.pid), procfs.read_pid_cgroup(stat.pid),
+        )
+
+    def get(self, stat):
+        key = (stat.pid, stat.starttime)
+        info = self._infos.get(key)
+        if info is None:
+            info = self._build(stat)
+            with self._lock:
+                self._infos[key] = info
+        return info
+
+    def lookup(self, pid):
+        """ProcessInfo of a pid from outside a walk, None if the process is gone"""
+        stat = procfs.read_pid_stat(pid)
+        return self.get(stat) if stat is not None else None
+
+    def retain(self, keys):
+        """Forget processes whose (pid, starttime) is not in keys"""
+        with self._lock:
+            self._infos = {key: info for key, info in self._infos.items() if key in keys}
+
+
+class ProcessUsage(object):
+    def __init__(self, info, stat, cpu, io, io_rate):
+        self.info = info
+        self.stat = stat
+        # Percent of one CPU over the last walk window, None without a baseline
+        self.cpu = cpu
+        # (read_bytes, write_bytes), None if not readable
+        self.io = io
+        # Bytes read and written per second over the window
+        self.io_rate = io_rate
+
+    @property
+    def cpu_seconds(self):
+        return (self.stat.utime + self.stat.stime) / procfs.CLOCK_TICKS
+
+    @property
+    def rss_bytes(self):
+        return self.stat.rss * procfs.PAGE_SIZE
+
+
+class ProcessTracker(object):
+    """Walks /proc and keeps the top consumers by CPU, resident memory and I/O"""
+
+    def __init__(self, infos, top_n=10, io=True):
+        self.infos = infos
+        self.top_n = top_n
+        self.io = io
+        # (pid, starttime) -> (cpu jiffies, io bytes or None) of the last walk
+        self._previous = {}
+        self._previous_uptime = None
+        self._lock = threading.Lock()
+
+    def _usage(self, previous, stat, uptime):
+        jiffies = stat.utime + stat.stime
+        io = procfs.read_pid_io(stat.pid) if self.io else None
+        io_total = sum(io) if io is not None else None
+        before = previous.get((stat.pid, stat.starttime))
+        window = None
+        if before is not None:
+            window = uptime - self._previous_uptime
+        elif self._previous_uptime is not None:
+            started = stat.starttime / procfs.CLOCK_TICKS
+            if started >= self._previous_uptime:
+                # Started since the last walk, everything it used is new
+                before = (0, 0)
+                window = uptime - started
+        cpu = io_rate = None
+        if window:
+            cpu = round((jiffies - before[0]) / procfs.CLOCK_TICKS / window * 100, 1)
+            if io_total is not None and before[1] is not None:
+                io_rate = (io_total - before[1]) / window
+        return (jiffies, io_total), ProcessUsage(None, stat, cpu, io, io_rate)
+
+    def scan(self):
+        """(number of processes, [ProcessUsage] of the top consumers)"""
+        with self._lock:
+            uptime = procfs.uptime()
+            previous = self._previous
+            current = {}
+            usages = {}
+            for stat in procfs.process_table():
+                key = (stat.pid, stat.starttime)
+                current[key], usages[key] = self._usage(previous, stat, uptime)
+            self._previous = current
+            self._previous_uptime = uptime
+            self.infos.retain(usages.keys())
+
+            selected = {}
+            rankings = [
+                lambda item: item[1].cpu or 0,
+                lambda item: item[1].stat.rss,
+            ]
+            if self.io:
+                rankings.append(lambda item: item[1].io_rate or 0)
+            for ranking in rankings:
+                for key, usage in heapq.nlargest(self.top_n, usages.items(), key=ranking):
+                    # Idle processes are not worth a series
+                    if ranking((key, usage)) > 0:
+                        selected[key] = usage
+            for usage in selected.values():
+                usage.info = self.infos.get(usage.stat)
+            return len(usages), sorted(selected.values(), key=lambda usage: usage.stat.pid)
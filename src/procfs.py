@@ -0,0 +1,298 @@
+# Parsers for the Linux /proc files collectors read directly, one read per
+# file per collection instead of a library call per value.
+import os
+from array import array
+
+import config
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def path(*parts):
+    return os.path.join(config.PROC_ROOT, *parts)
+
+
+def read(*parts):
+    with open(path(*parts), "r") as f:
+        return f.read()
+
+
+def sys_path(*parts):
+    return os.path.join(config.SYS_ROOT, *parts)
+
+
+def read_sys(*parts):
+    with open(sys_path(*parts), "r") as f:
+        return f.read()
+
+
+class MemorySnapshot(object):
+    """Values of /proc/meminfo in bytes, all taken from the same read
+
+    ram_used and the percentages follow psutil's definitions so the series
+    keep their meaning.
+    """
+
+    def __init__(self, meminfo):
+        self.meminfo = meminfo
+        get = meminfo.get
+        self.ram_total = get("MemTotal", 0)
+        self.ram_free = get("MemFree", 0)
+        self.buffers = get("Buffers", 0)
+        self.cached = get("Cached", 0)
+        self.slab = get("Slab", 0)
+        self.slab_reclaimable = get("SReclaimable", 0)
+        self.ram_available = get("MemAvailable", self.ram_free + self.buffers + self.cached)
+        self.ram_used = self.ram_total - self.ram_available
+        self.ram_used_percent = _percent(self.ram_total - self.ram_available, self.ram_total)
+        self.swap_total = get("SwapTotal", 0)
+        self.swap_free = get("SwapFree", 0)
+        self.swap_used = self.swap_total - self.swap_free
+        self.swap_used_percent = _percent(self.swap_used, self.swap_total)
+        self.dirty = get("Dirty", 0)
+        self.writeback = get("Writeback", 0)
+        self.committed_as = get("Committed_AS", 0)
+        self.commit_limit = get("CommitLimit", 0)
+        self.hugepages_total = get("HugePages_Total", 0)
+        self.hugepages_free = get("HugePages_Free", 0)
+        self.hugepages_reserved = get("HugePages_Rsvd", 0)
+        self.hugepages_surplus = get("HugePages_Surp", 0)
+        self.hugepage_size = get("Hugepagesize", 0)
+
+
+def _percent(part, total):
+    return round(part / total * 100, 1) if total else 0.0
+
+
+def parse_meminfo(text):
+    """/proc/meminfo as {field: value}, kB values converted to bytes"""
+    meminfo = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        fields = value.split()
+        if not fields:
+            continue
+        number = int(fields[0])
+        if len(fields) > 1 and fields[1] == "kB":
+            number *= 1024
+        meminfo[name] = number
+    return meminfo
+
+
+def read_memory() -> MemorySnapshot:
+    return MemorySnapshot(parse_meminfo(read("meminfo")))
+
+
+# Columns of the cpuN lines in /proc/stat, named like psutil.cpu_times()
+CPU_TIMES_FIELDS = (
+    "user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal", "guest", "guest_nice",
+)
+
+
+def parse_stat_cpus(text):
+    """(cpu numbers, flat array of jiffies) from the per-thread lines of /proc/stat
+
+    The array holds len(CPU_TIMES_FIELDS) values per thread, missing columns
+    on old kernels are left at zero.
+    """
+    width = len(CPU_TIMES_FIELDS)
+    cpus = []
+    jiffies = array("Q")
+    for line in text.splitlines():
+        if not line.startswith("cpu"):
+            # cpu lines come first, nothing else follows them
+            if cpus:
+                break
+            continue
+        label, _, values = line.partition(" ")
+        if label == "cpu":
+            continue
+        cpus.append(int(label[3:]))
+        fields = values.split()[:width]
+        jiffies.extend(int(value) for value in fields)
+        jiffies.extend(0 for _ in range(width - len(fields)))
+    return cpus, jiffies
+
+
+def parse_boot_time(text):
+    """Boot time as a Unix timestamp from the btime line of /proc/stat"""
+    for line in text.splitlines():
+        if line.startswith("btime "):
+            return int(line.split()[1])
+    raise ValueError("no btime in /proc/stat")
+
+
+def boot_time():
+    return parse_boot_time(read("stat"))
+
+
+class ProcessStat(object):
+    """Fields of /proc/<pid>/stat a collector needs"""
+    __slots__ = ("pid", "comm", "state", "ppid", "utime", "stime", "starttime", "rss")
+
+    def __init__(self, pid, comm, state, ppid, utime, stime, starttime, rss):
+        self.pid = pid
+        self.comm = comm
+        self.state = state
+        self.ppid = ppid
+        # Jiffies
+        self.utime = utime
+        self.stime = stime
+        self.starttime = starttime
+        # Pages
+        self.rss = rss
+
+
+def parse_pid_stat(pid, text):
+    # comm is in parentheses and may itself contain spaces and parentheses
+    head, _, tail = text.rpartition(")")
+    fields = tail.split()
+    return ProcessStat(
+        pid, head.partition("(")[2], fields[0], int(fields[1]),
+        int(fields[11]), int(fields[12]), int(fields[19]), int(fields[21]),
+    )
+
+
+def pids():
+    return [int(entry) for entry in os.listdir(config.PROC_ROOT) if entry.isdigit()]
+
+
+def read_pid_stat(pid):
+    """ProcessStat of pid, None if the process is gone"""
+    try:
+        return parse_pid_stat(pid, read(str(pid), "stat"))
+    except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+        return None
+
+
+def read_cmdline(pid):
+    """Command line of pid joined with spaces, "" for kernel threads and gone processes"""
+    try:
+        with open(path(str(pid), "cmdline"), "rb") as f:
+            cmdline = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return ""
+    return cmdline.rstrip(b"\0").replace(b"\0", b" ").decode("utf-8", errors="replace")
+
+
+def process_table():
+    """ProcessStat of every process, from one walk over /proc"""
+    table = []
+    for pid in pids():
+        stat = read_pid_stat(pid)
+        if stat is not None:
+            table.append(stat)
+    return table
+
+
+class DiskStat(object):
+    """Counters of one block device from /proc/diskstats"""
+    __slots__ = (
+        "device_number", "name", "reads", "sectors_read", "read_ms",
+        "writes", "sectors_written", "write_ms", "in_flight", "io_ms", "weighted_io_ms",
+    )
+
+    def __init__(self, device_number, name, fields):
+        # major:minor, as in /proc/self/mountinfo
+        self.device_number = device_number
+        self.name = name
+        self.reads = fields[0]
+        self.sectors_read = fields[2]
+        self.read_ms = fields[3]
+        self.writes = fields[4]
+        self.sectors_written = fields[6]
+        self.write_ms = fields[7]
+        self.in_flight = fields[8]
+        self.io_ms = fields[9]
+        # Time in queue, io_ms weighted by the number of requests in flight
+        self.weighted_io_ms = fields[10]
+
+
+def parse_diskstats(text):
+    # "   8       1 sda1 4 0 8 0 ..." with 11, 15 or 17 counters depending on the kernel
+    stats = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 14:
+            continue
+        stats.append(DiskStat(f"{fields[0]}:{fields[1]}", fields[2], [int(value) for value in fields[3:14]]))
+    return stats
+
+
+class NetDevStat(object):
+    """Counters of one network interface from /proc/net/dev"""
+    __slots__ = (
+        "name", "rx_bytes", "rx_packets", "rx_errors", "rx_drops",
+        "tx_bytes", "tx_packets", "tx_errors", "tx_drops",
+    )
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.rx_bytes, self.rx_packets, self.rx_errors, self.rx_drops = fields[0:4]
+        self.tx_bytes, self.tx_packets, self.tx_errors, self.tx_drops = fields[8:12]
+
+
+def parse_net_dev(text):
+    # Two header lines, then "  eth0: 7582214 413 0 0 0 0 0 0 42801 415 0 0 0 0 0 0"
+    stats = []
+    for line in text.splitlines()[2:]:
+        name, _, values = line.partition(":")
+        fields = values.split()
+        if len(fields) < 16:
+            continue
+        stats.append(NetDevStat(name.strip(), [int(value) for value in fields[:16]]))
+    return stats
+
+
+def uptime():
+    """Seconds since boot, the clock starttime in /proc/<pid>/stat counts on"""
+    return float(read("uptime").split()[0])
+
+
+def read_uid(pid):
+    """Real uid of pid, None if the process is gone"""
+    try:
+        status = read(str(pid), "status")
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    for line in status.splitlines():
+        if line.startswith("Uid:"):
+            return int(line.split()[1])
+    return None
+
+
+def read_pid_io(pid):
+    """(read_bytes, write_bytes) of pid, None if the process is gone or not ours to read"""
+    try:
+        text = read(str(pid), "io")
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    values = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        values[name] = value
+    try:
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_pid_cgroup(text):
+    """cgroup path from /proc/<pid>/cgroup, the unified hierarchy or else the memory controller's"""
+    paths = {}
+    for line in text.splitlines():
+        hierarchy, _, rest = line.partition(":")
+        controllers, _, cgroup = rest.partition(":")
+        if hierarchy == "0" and not controllers:
+            return cgroup
+        for controller in controllers.split(","):
+            paths[controller] = cgroup
+    return paths.get("memory", next(iter(paths.values()), ""))
+
+
+def read_pid_cgroup(pid):
+    try:
+        return parse_pid_cgroup(read(str(pid), "cgroup"))
+    except (FileNotFoundError, ProcessLookupError):
+        return ""
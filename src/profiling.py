@@ -0,0 +1,93 @@
+# On-demand diagnostics for the /debug endpoints: a sampling profile of
+# every thread, a cProfile of the event loop thread and the top allocation
+# sites. Nothing here costs anything until it is asked for.
+import asyncio
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds, interval=0.005):
+    """(number of samples, Counter of `thread;outer;...;inner` stacks) of all other threads"""
+    own = threading.get_ident()
+    stacks = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def collapsed(stacks):
+    """Stacks in the collapsed format flamegraph.pl and speedscope read"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+async def profile_loop(seconds, sort="cumulative", limit=100):
+    """pstats report of everything the event loop thread runs for seconds"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def top_allocations(seconds, limit=25, frames=1):
+    """Report of the allocation sites holding the most memory
+
+    Uses the running trace if tracemalloc was started already, otherwise
+    traces for seconds, keeping frames frames per allocation, and reports
+    what was allocated since and is still alive.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(frames)
+    try:
+        if not tracing:
+            time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        frames = tracemalloc.get_traceback_limit()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    key = "traceback" if frames > 1 else "lineno"
+    statistics = snapshot.statistics(key)
+    lines = [
+        f"# traced {current} bytes, peak {peak} bytes, "
+        + ("since startup" if tracing else f"allocated over {seconds:g}s") + "\n"
+    ]
+    for statistic in statistics[:limit]:
+        lines.append(f"{statistic.size} bytes in {statistic.count} blocks\n")
+        lines.extend(f"    {line}\n" for line in statistic.traceback.format())
+    return "".join(lines)
@@ -0,0 +1,46 @@
+# Just enough of the protobuf wire format to encode the Prometheus messages
+# the exporter writes, without depending on generated code.
+import struct
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+_double = struct.Struct("<d")
+
+
+def varint(value):
+    """Base 128 varint, negative numbers as their 64 bit two's complement"""
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def tag(field, wire_type):
+    return varint((field << 3) | wire_type)
+
+
+def uint_field(field, value):
+    return tag(field, VARINT) + varint(value)
+
+
+def double_field(field, value):
+    return tag(field, FIXED64) + _double.pack(value)
+
+
+def bytes_field(field, data):
+    return tag(field, LENGTH_DELIMITED) + varint(len(data)) + data
+
+
+def string_field(field, text):
+    return bytes_field(field, text.encode("utf-8"))
+
+
+def delimited(message):
+    """Message prefixed with its length, as in a stream of messages"""
+    return varint(len(message)) + message
@@ -0,0 +1,269 @@
+# Push mode: ships scrapes to a Prometheus remote_write receiver for hosts
+# Prometheus cannot reach. Several intervals go into one request, requests
+# are written to a bounded on-disk log first and sent oldest first, so
+# nothing is lost or reordered while the receiver is down.
+import asyncio
+import http.client
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import protobuf
+import snappy_block
+from metrics import PREFIX_CACHE_SIZE, format_value, numeric_value
+
+logger = logging.getLogger(__name__)
+
+# MetricMetadata.MetricType
+METADATA_TYPES = {"counter": 1, "gauge": 2, "histogram": 3, "info": 6, "untyped": 0}
+
+HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "User-Agent": "only_prometheus_exporter",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+
+class WriteRequestEncoder(object):
+    """Encodes samples as a remote_write WriteRequest"""
+
+    def __init__(self, external_labels=()):
+        # Label pairs added to every series, e.g. job and instance
+        self.external_labels = tuple(external_labels)
+        # (family, label values, name suffix, le) -> encoded Label fields, sorted by name
+        self._labels = {}
+
+    def labels(self, family, labelvalues, suffix="", le=None):
+        key = (family, labelvalues, suffix, le)
+        labels = self._labels.get(key)
+        if labels is None:
+            pairs = [("__name__", family.name + suffix)]
+            pairs.extend((name, str(value)) for name, value in zip(family.labelnames, labelvalues))
+            if le is not None:
+                pairs.append(("le", format_value(le)))
+            own = {name for name, _ in pairs}
+            pairs.extend(pair for pair in self.external_labels if pair[0] not in own)
+            pairs.sort()
+            labels = b"".join(
+                protobuf.bytes_field(1, protobuf.string_field(1, name) + protobuf.string_field(2, value))
+                for name, value in pairs
+            )
+            if len(self._labels) >= PREFIX_CACHE_SIZE:
+                self._labels = {}
+            self._labels[key] = labels
+        return labels
+
+    @staticmethod
+    def values(family, labels, value):
+        """[((family, labels, suffix, le), float)] of the series a sample is sent as"""
+        if family.type == "histogram":
+            values = [((family, labels, "_bucket", bound), float(count)) for bound, count in value.cumulative()]
+            values.append(((family, labels, "_sum", None), value.sum))
+            values.append(((family, labels, "_count", None), float(value.count)))
+            return values
+        return [((family, labels, "", None), 1.0 if family.type == "info" else numeric_value(value))]
+
+    def encode(self, batches):
+        """WriteRequest from [(timestamp seconds, MetricSet)] in time order"""
+        series = {}
+        families = {}
+        for timestamp, metrics in batches:
+            timestamp_ms = int(timestamp * 1000)
+            for family, samples in metrics.families.items():
+                families[family.name] = family
+                for labels, value in samples:
+                    for key, number in self.values(family, labels, value):
+                        sample = protobuf.double_field(1, number) + protobuf.uint_field(2, timestamp_ms)
+                        if key in series:
+                            series[key].append(protobuf.bytes_field(2, sample))
+                        else:
+                            series[key] = [self.labels(*key), protobuf.bytes_field(2, sample)]
+        out = [protobuf.bytes_field(1, b"".join(parts)) for parts in series.values()]
+        for family in families.values():
+            out.append(protobuf.bytes_field(3, (
+                protobuf.uint_field(1, METADATA_TYPES.get(family.type, 0))
+                + protobuf.string_field(2, family.name)
+                + protobuf.string_field(4, family.documentation)
+            )))
+        return b"".join(out)
+
+
+class WAL(object):
+    """Compressed requests waiting to be sent, one file each, oldest dropped beyond max_bytes"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+        self._sequence = int(os.path.basename(existing[-1])[:-4]) + 1 if existing else 0
+
+    def segments(self):
+        """Paths of the stored requests, oldest first"""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".bin"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def append(self, body):
+        path = os.path.join(self.directory, f"{self._sequence:020d}.bin")
+        self._sequence += 1
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        self._trim()
+
+    def _trim(self):
+        segments = self.segments()
+        sizes = [os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        # The newest request is always kept, however large
+        for path, size in zip(segments[:-1], sizes):
+            if total <= self.max_bytes:
+                break
+            logger.warning("remote_write buffer over %d bytes, dropping %s", self.max_bytes, path)
+            os.remove(path)
+            total -= size
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def remove(path):
+        os.remove(path)
+
+
+class RemoteWriter(object):
+    """Scrapes the scheduler every interval and pushes every batch intervals"""
+
+    def __init__(self, url, scheduler, wal, interval=15.0, batch=4, timeout=10.0, external_labels=()):
+        self.url = urlsplit(url)
+        self.scheduler = scheduler
+        self.wal = wal
+        self.interval = interval
+        self.batch = batch
+        self.timeout = timeout
+        self.encoder = WriteRequestEncoder(external_labels)
+        # [(timestamp, MetricSet)] not yet written to the WAL, and the
+        # number of intervals they were collected in
+        self._pending = []
+        self._batches = 0
+        # collector -> timestamp of its last pushed snapshot, an unchanged
+        # snapshot is not pushed twice
+        self._pushed = {}
+        self._connection = None
+        # The WAL and the connection are used from worker threads, one at a time
+        self._lock = threading.Lock()
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self._shutdown)
+
+    def _shutdown(self):
+        with self._lock:
+            # Kept for the next start instead of being lost
+            if self._pending:
+                self._write_pending()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        while True:
+            next_run += self.interval
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            try:
+                await self.collect()
+                if self._batches >= self.batch:
+                    await asyncio.to_thread(self.write_and_flush)
+            except Exception:
+                logger.exception("remote_write failed")
+
+    async def collect(self):
+        self._batches += 1
+        scrape = await self.scheduler.scrape()
+        for snapshot in scrape.snapshots:
+            if snapshot.timestamp > self._pushed.get(snapshot.name, 0):
+                self._pushed[snapshot.name] = snapshot.timestamp
+                self._pending.append((snapshot.timestamp, snapshot.metrics))
+        now = time.time()
+        for metrics in scrape.dynamic():
+            self._pending.append((now, metrics))
+
+    def write_and_flush(self):
+        with self._lock:
+            self._write_pending()
+            return self.flush()
+
+    def _write_pending(self):
+        self._batches = 0
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        pending.sort(key=lambda batch: batch[0])
+        self.wal.append(snappy_block.compress(self.encoder.encode(pending)))
+
+    def _connect(self):
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+    def _post(self, body):
+        target = self.url.path or "/"
+        if self.url.query:
+            target += "?" + self.url.query
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.request("POST", target, body=body, headers=HEADERS)
+                response = self._connection.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                self._connection.close()
+                self._connection = None
+                # A kept-alive connection may have been closed by the
+                # receiver, a fresh one failing means it is down
+                if attempt:
+                    raise
+
+    def flush(self):
+        """Send stored requests oldest first, stopping at the first that has to be retried
+
+        Callers hold the lock.
+        """
+        for path in self.wal.segments():
+            try:
+                status = self._post(self.wal.read(path))
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning("remote_write to %s failed, keeping requests for later: %s", self.url.netloc, e)
+                return False
+            if status // 100 == 2:
+                self.wal.remove(path)
+            elif status // 100 == 4 and status != 429:
+                # Rejected for good, retrying would block everything after it
+                logger.error("remote_write rejected %s with status %d, dropping it", path, status)
+                self.wal.remove(path)
+            else:
+                logger.warning("remote_write returned %d, keeping requests for later", status)
+                return False
+        return True
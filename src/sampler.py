@@ -0,0 +1,48 @@
+# Base for internal samplers: read a counter source on a fixed interval and
+# keep deltas, so rates do not depend on who scrapes and how often.
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Sampler(object):
+    """Calls sample() every interval seconds on a daemon thread"""
+    name = "sampler"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def available(self):
+        return True
+
+    def sample(self):
+        raise NotImplementedError
+
+    def _sample(self):
+        try:
+            self.sample()
+        except Exception:
+            logger.exception("%s sample failed", self.name)
+
+    def start(self):
+        if not self.available():
+            return
+        self._stop.clear()
+        # Take the baseline right away so the first window ends one interval
+        # after startup
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
@@ -0,0 +1,265 @@
+# Runs collectors in the background and keeps a snapshot of their output
+# with its text exposition encoded, so serving /metrics never waits on a
+# slow collector.
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import MetricSet, gauge
+
+logger = logging.getLogger(__name__)
+
+# Name a scrape can ask for next to the collectors to get the exporter's
+# own instrumentation metrics, which unfiltered scrapes always include
+SELF_COLLECTOR = "exporter"
+
+COLLECTOR_LABELS = ("collector",)
+EXPORTER_COLLECTOR_AGE_SECONDS = gauge(
+    "exporter_collector_age_seconds", "Seconds since the served samples of a collector were collected",
+    COLLECTOR_LABELS)
+EXPORTER_COLLECTOR_DURATION_SECONDS = gauge(
+    "exporter_collector_duration_seconds", "Duration of the last run of a collector", COLLECTOR_LABELS)
+EXPORTER_COLLECTOR_SUCCESS = gauge(
+    "exporter_collector_success", "Whether the last run of a collector succeeded", COLLECTOR_LABELS)
+
+
+class CollectorSnapshot(object):
+    def __init__(self, name, timestamp, metrics, encoded):
+        self.name = name
+        self.timestamp = timestamp
+        self.metrics = metrics
+        # Prometheus text format, UTF-8 encoded
+        self.encoded = encoded
+        # Encodings of `encoded` kept for as long as this snapshot is served
+        self.encodings = {}
+
+
+class Scrape(object):
+    """Everything one /metrics response is made of"""
+
+    def __init__(self, snapshots, inline, status):
+        # Pre-rendered snapshots of background collectors, in collector order
+        self.snapshots = snapshots
+        # MetricSets of inline collectors collected for this scrape
+        self.inline = inline
+        # exporter_collector_* samples
+        self.status = status
+
+    def dynamic(self):
+        """MetricSets that were not pre-rendered"""
+        return self.inline + [self.status]
+
+
+class CollectorStatus(object):
+    def __init__(self, duration, success):
+        self.duration = duration
+        self.success = success
+
+
+class CollectorRun(object):
+    def __init__(self, name, task, started, deadline, cancellable):
+        self.name = name
+        self.task = task
+        self.started = started
+        self.deadline = deadline
+        # Coroutine collectors can be cancelled, a collector running on a
+        # worker thread keeps going until it returns
+        self.cancellable = cancellable
+        self.timed_out = False
+
+
+class Scheduler(object):
+    """Runs collectors on the event loop
+
+    Coroutine collectors run directly on the loop, plain functions run on a
+    bounded thread pool of our own so they never compete with the server's
+    threadpool. All bookkeeping happens on the loop thread.
+    """
+
+    def __init__(self, collectors, intervals, timeouts, workers=4, instrumentation=None):
+        # collectors: name -> function or coroutine function returning a
+        #             metrics.MetricSet
+        # intervals: name -> seconds between runs, 0 collects on every scrape
+        # timeouts: name -> seconds a run may take before it is dropped
+        # instrumentation: instrumentation.Instrumentation recording run
+        #                  durations, its metrics are served with the status
+        self.collectors = collectors
+        self.intervals = intervals
+        self.timeouts = timeouts
+        self.workers = workers
+        self.instrumentation = instrumentation
+        # (snapshots by collector name, snapshots in collector order),
+        # swapped as one reference
+        self._state = ({}, ())
+        self._status = {}
+        # At most one run per collector is in flight, so a hung collector
+        # holds on to a single worker instead of piling up every interval
+        self._running = {}
+        self._executor = None
+        self._task = None
+
+    def background(self):
+        return [name for name in self.collectors if self.intervals.get(name, 0) > 0]
+
+    def inline(self):
+        return [name for name in self.collectors if self.intervals.get(name, 0) <= 0]
+
+    def names(self):
+        """Names a scrape can be limited to"""
+        return list(self.collectors) + [SELF_COLLECTOR]
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="collector")
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for run in list(self._running.values()):
+            if run.cancellable:
+                run.task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _dispatch(self):
+        next_run = dict.fromkeys(self.background(), 0.0)
+        while True:
+            now = time.monotonic()
+            for name, due in next_run.items():
+                if now >= due:
+                    next_run[name] = now + self.intervals[name]
+                    run = self._submit(name, store=True)
+                    if run is not None:
+                        asyncio.get_running_loop().call_at(run.deadline, self._expire, run)
+            wake = min(next_run.values(), default=now + 1)
+            await asyncio.sleep(min(1.0, max(0.0, wake - time.monotonic())))
+
+    async def _call(self, name):
+        collector = self.collectors[name]
+        started = time.monotonic()
+        if asyncio.iscoroutinefunction(collector):
+            metrics = await collector()
+        else:
+            metrics = await asyncio.get_running_loop().run_in_executor(self._executor, collector)
+        return metrics, time.monotonic() - started
+
+    def _submit(self, name, store):
+        if name in self._running:
+            return None
+        timestamp = time.time()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        task = asyncio.ensure_future(self._call(name))
+        run = CollectorRun(
+            name, task, started, started + self.timeouts[name],
+            asyncio.iscoroutinefunction(self.collectors[name]),
+        )
+        self._running[name] = run
+        task.add_done_callback(lambda t: self._finished(run, timestamp, store))
+        return run
+
+    def _result(self, run):
+        """MetricSet of a finished run, or None if it failed"""
+        if run.task.cancelled():
+            return None
+        try:
+            metrics, duration = run.task.result()
+        except Exception:
+            logger.exception("collector %s failed", run.name)
+            self._set_status(run.name, CollectorStatus(asyncio.get_running_loop().time() - run.started, False))
+            return None
+        self._set_status(run.name, CollectorStatus(duration, True))
+        return metrics
+
+    def _set_status(self, name, status):
+        self._status[name] = status
+        if self.instrumentation is not None:
+            self.instrumentation.observe_collector(name, status.duration)
+
+    def _finished(self, run, timestamp, store):
+        self._running.pop(run.name, None)
+        # A run that missed its deadline was already reported as failed and
+        # its late result is dropped as well
+        if store and not run.timed_out:
+            metrics = self._result(run)
+            if metrics is not None:
+                self._store(run.name, timestamp, metrics)
+
+    def _expire(self, run):
+        if run.task.done() or run.timed_out:
+            return
+        run.timed_out = True
+        self._set_status(run.name, CollectorStatus(self.timeouts[run.name], False))
+        logger.warning("collector %s did not finish within %gs", run.name, self.timeouts[run.name])
+        if run.cancellable:
+            run.task.cancel()
+
+    def _store(self, name, timestamp, metrics):
+        encoded = metrics.render(timestamp).encode("utf-8")
+        # Readers only ever see a complete snapshot: the state is rebuilt
+        # and swapped, never mutated in place.
+        snapshots = dict(self._state[0])
+        snapshots[name] = CollectorSnapshot(name, timestamp, metrics, encoded)
+        ordered = tuple(snapshots[n] for n in self.collectors if n in snapshots)
+        self._state = (snapshots, ordered)
+
+    async def _wait(self, run):
+        remaining = run.deadline - asyncio.get_running_loop().time()
+        # asyncio.wait leaves the task running on timeout, the run stays
+        # registered until its worker thread really returns
+        await asyncio.wait({run.task}, timeout=max(0.0, remaining))
+        if not run.task.done():
+            self._expire(run)
+            return None
+        return self._result(run)
+
+    async def _collect_inline(self, names=None):
+        """Run inline collectors concurrently, dropping any that miss their deadline"""
+        runs = []
+        for name in self.inline():
+            if names is not None and name not in names:
+                continue
+            run = self._submit(name, store=False)
+            if run is None:
+                # Still stuck in a previous scrape
+                self._set_status(name, CollectorStatus(self.timeouts[name], False))
+            else:
+                runs.append(run)
+        results = await asyncio.gather(*(self._wait(run) for run in runs))
+        return [metrics for metrics in results if metrics]
+
+    def status_metrics(self, snapshots, names=None):
+        metrics = MetricSet()
+        now = time.time()
+        collectors = [name for name in self.collectors if names is None or name in names]
+        for name in self.background():
+            if name in snapshots and name in collectors:
+                metrics.add(EXPORTER_COLLECTOR_AGE_SECONDS, now - snapshots[name].timestamp, (name,))
+        status = self._status
+        for name in collectors:
+            if name in status:
+                metrics.add(EXPORTER_COLLECTOR_DURATION_SECONDS, status[name].duration, (name,))
+        for name in collectors:
+            if name in status:
+                metrics.add(EXPORTER_COLLECTOR_SUCCESS, status[name].success, (name,))
+        if self.instrumentation is not None and (names is None or SELF_COLLECTOR in names):
+            metrics.extend(self.instrumentation.metrics())
+        return metrics
+
+    async def scrape(self, names=None) -> Scrape:
+        """Snapshots and inline collections of the collectors in names, all of them for None
+
+        Inline collectors that were not asked for do not run.
+        """
+        snapshots, ordered = self._state
+        if names is not None:
+            ordered = [snapshot for snapshot in ordered if snapshot.name in names]
+        inline = await self._collect_inline(names)
+        return Scrape(list(ordered), inline, self.status_metrics(snapshots, names))
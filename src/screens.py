@@ -0,0 +1,117 @@
+# Lists screen sessions and the command running in each of them.
+# Sessions come from the screen socket directories and commands from one
+# walk over /proc, no subprocess is started however many sessions exist.
+import os
+import stat
+
+import config
+import procfs
+
+# Mode bit screen sets on a session socket while a display is attached
+ATTACHED_BIT = stat.S_IXUSR
+
+
+class ScreenSession(object):
+    def __init__(self, id, name, status, started=None):
+        self.id = id
+        self.name = name
+        self.status = status
+        # Unix time the session was started, None if unknown
+        self.started = started
+        self.command = ""
+
+    def open_time(self):
+        return float(self.started) if self.started is not None else ""
+
+    def __repr__(self):
+        return f"id: {self.id} | name: {self.name} | status: {self.status} | command: {self.command}"
+
+
+def socket_dirs(roots):
+    """Per-user socket directories (S-<user>) below each of roots"""
+    seen = set()
+    dirs = []
+    for root in roots:
+        try:
+            entries = os.listdir(root)
+        except OSError:
+            continue
+        for entry in entries:
+            if not entry.startswith("S-"):
+                continue
+            directory = os.path.join(root, entry)
+            # /var/run is usually a link to /run
+            real = os.path.realpath(directory)
+            if real not in seen:
+                seen.add(real)
+                dirs.append(directory)
+    return dirs
+
+
+def list_sockets(directory):
+    """Sessions from the <pid>.<name> sockets in one socket directory"""
+    sessions = []
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return sessions
+    for entry in entries:
+        pid, _, name = entry.name.partition(".")
+        if not pid.isdigit() or not name:
+            continue
+        try:
+            mode = entry.stat(follow_symlinks=False).st_mode
+        except OSError:
+            continue
+        if not stat.S_ISSOCK(mode):
+            continue
+        status = "Attached" if mode & ATTACHED_BIT else "Detached"
+        sessions.append(ScreenSession(pid, name, status))
+    return sessions
+
+
+def children_index(table):
+    """ppid -> [ProcessStat] from procfs.process_table()"""
+    children = {}
+    for process in table:
+        children.setdefault(process.ppid, []).append(process)
+    return children
+
+
+def _is_shell(comm):
+    return "bash" in comm
+
+
+def foreground_process(session_pid, children):
+    """Newest process started from the shell of a screen session, None at a bare prompt"""
+    foreground = None
+    for shell in children.get(int(session_pid), []):
+        if not _is_shell(shell.comm):
+            continue
+        for process in children.get(shell.pid, []):
+            if not _is_shell(process.comm) and (foreground is None or process.pid > foreground.pid):
+                foreground = process
+    return foreground
+
+
+def list_sessions(roots=None) -> list[ScreenSession]:
+    sessions = []
+    for directory in socket_dirs(config.SCREEN_DIRS if roots is None else roots):
+        sessions.extend(list_sockets(directory))
+    if not sessions:
+        return sessions
+    table = procfs.process_table()
+    processes = {process.pid: process for process in table}
+    children = children_index(table)
+    boot_time = procfs.boot_time()
+    for session in sessions:
+        process = processes.get(int(session.id))
+        if process is None:
+            # Socket left behind by a session that is gone, as `screen -ls` reports it
+            session.status = "Dead"
+            continue
+        session.started = int(boot_time + process.starttime / procfs.CLOCK_TICKS)
+        foreground = foreground_process(session.id, children)
+        if foreground is not None:
+            session.command = procfs.read_cmdline(foreground.pid) or foreground.comm
+    return sessions
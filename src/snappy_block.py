@@ -0,0 +1,89 @@
+# Snappy block format compression as remote_write expects it. Uses
+# python-snappy when it is installed, else a pure Python encoder that finds
+# repeats greedily. Its output is valid snappy, just less tightly packed
+# and a lot slower to produce than the C library's.
+from protobuf import varint
+
+try:
+    import snappy as _snappy
+except ImportError:
+    _snappy = None
+
+# The reference encoder compresses independent 64 KiB blocks, which keeps
+# every copy offset within two bytes
+BLOCK_SIZE = 1 << 16
+MIN_MATCH = 4
+
+
+def _literal(out, data, start, end):
+    length = end - start
+    if length <= 0:
+        return
+    n = length - 1
+    if n < 60:
+        out.append(n << 2)
+    elif n < 1 << 8:
+        out.append(60 << 2)
+        out.append(n)
+    elif n < 1 << 16:
+        out.append(61 << 2)
+        out += n.to_bytes(2, "little")
+    elif n < 1 << 24:
+        out.append(62 << 2)
+        out += n.to_bytes(3, "little")
+    else:
+        out.append(63 << 2)
+        out += n.to_bytes(4, "little")
+    out += data[start:end]
+
+
+def _copy(out, offset, length):
+    while length >= 68:
+        out.append((63 << 2) | 2)
+        out += offset.to_bytes(2, "little")
+        length -= 64
+    if length > 64:
+        out.append((59 << 2) | 2)
+        out += offset.to_bytes(2, "little")
+        length -= 60
+    if length <= 11 and offset < 2048:
+        out.append(((offset >> 8) << 5) | ((length - 4) << 2) | 1)
+        out.append(offset & 0xff)
+    else:
+        out.append(((length - 1) << 2) | 2)
+        out += offset.to_bytes(2, "little")
+
+
+def _compress_block(out, data, start, end):
+    table = {}
+    literal_start = position = start
+    misses = 0
+    last = end - MIN_MATCH
+    while position <= last:
+        key = data[position:position + MIN_MATCH]
+        candidate = table.get(key)
+        table[key] = position
+        if candidate is None:
+            # Skip ahead faster through data that does not compress
+            misses += 1
+            position += 1 + (misses >> 5)
+            continue
+        misses = 0
+        length = MIN_MATCH
+        while position + length < end and data[candidate + length] == data[position + length]:
+            length += 1
+        _literal(out, data, literal_start, position)
+        _copy(out, position - candidate, length)
+        position += length
+        literal_start = position
+    _literal(out, data, literal_start, end)
+
+
+def compress(data):
+    data = bytes(data)
+    if _snappy is not None:
+        return _snappy.compress(data)
+    out = bytearray(varint(len(data)))
+    for start in range(0, len(data), BLOCK_SIZE):
+        _compress_block(out, data, start, min(len(data), start + BLOCK_SIZE))
+    return bytes(out)